@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import requests
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vault_parse
+from vault_parse import parse_items
+from vault_transport import ReplayTransport, decode_response
+from bench_ingest import synthetic_payload
+
+"""
+
+Decode benchmark: time to turn the body of an API response into (reading_times, station_ids, block), for payloads of a few shapes:
+    live: 1 item of 60 stations (one poll of the live API)
+    day: 288 items of 60 stations (one date-parameterised request, e.g. a backfill)
+    wide: 1 item of 6000 stations
+
+through:
+    response.json(): requests' own decoding of the text of the response (the previous path), then vault_parse.parse_items
+    decode_response: vault_parse.loads on the raw bytes (orjson when installed, else json), then vault_parse.parse_items
+    replay: serving the payload from a recording file with vault_transport.ReplayTransport, then decode_response and parse_items
+
+Usage: python benchmarks/bench_decode.py [--repeats 50]
+
+"""
+
+shapes = {'live': (60, 1), 'day': (60, 288), 'wide': (6000, 1)}
+
+# Build the body of a response of num_items items of num_stations stations
+def payload_bytes(num_stations, num_items, rng):
+    payload = synthetic_payload(num_stations, 0, rng)
+    payload['items'] = [dict(payload['items'][0], timestamp=f'2021-07-07T{i // 12:02d}:{i % 12 * 5:02d}:00+08:00') for i in range(num_items)]
+    return json.dumps(payload).encode()
+
+# Build a requests.Response holding body (as received from the API: JSON without a charset)
+def make_response(body):
+    response = requests.models.Response()
+    response._content, response.status_code, response.encoding = body, 200, None
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+# Median time (ms) of repeats calls of func
+def median_ms(func, repeats):
+    latencies = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.median(latencies)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode benchmark: response.json() vs decode_response (orjson when installed).")
+    parser.add_argument('--repeats', type=int, default=50, help="calls timed per path (default: 50)")
+    args = parser.parse_args()
+
+    print(f"JSON decoder: {'orjson' if vault_parse.orjson is not None else 'json (orjson not installed)'}")
+    print(f"{'payload':>8} {'size (kB)':>10} {'response.json() (ms)':>21} {'decode_response (ms)':>21} {'replay (ms)':>12} {'speed-up':>9}")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (num_stations, num_items) in shapes.items():
+            body = payload_bytes(num_stations, num_items, rng)
+            response = make_response(body)
+
+            # The replayed record holds the same payload, repeats times
+            path_to_recording = os.path.join(tmp_dir, f'{name}.jsonl')
+            line = json.dumps({'data_type': 'air-temperature', 'url': '', 'params': None, 'received': 0, 'status_code': 200, 'headers': {}, 'payload': json.loads(body)})
+            with open(path_to_recording, 'w') as f:
+                f.write((line + '\n') * args.repeats)
+            transport = ReplayTransport(path_to_recording)
+
+            # Every path gives the same block
+            expected = parse_items(response.json())
+            assert np.array_equal(parse_items(decode_response(response))[2], expected[2], equal_nan=True)
+
+            json_ms = median_ms(lambda: parse_items(response.json()), args.repeats)
+            fast_ms = median_ms(lambda: parse_items(decode_response(response)), args.repeats)
+            replay_ms = median_ms(lambda: parse_items(decode_response(transport.get('/air-temperature'))), args.repeats)
+            print(f"{name:>8} {len(body) / 1000:>10,.0f} {json_ms:>21.3f} {fast_ms:>21.3f} {replay_ms:>12.3f} {json_ms / fast_ms:>8.1f}x")
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+import sqlite3 as sl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_vault import Collector
+
+"""
+
+Flush latency of Collector._send_to_wide_db (the send_to_db step of build_df) against the number of rows already in the target table.
+
+The dedup step (last stored date_time) and the column discovery step should take the same time whether the table holds a day or years of 5-minute readings.
+
+Usage: python benchmarks/bench_flush.py [max_rows]
+
+"""
+
+num_stations = 60
+table_sizes = [1_000, 10_000, 100_000, 300_000]         # 300,000 5-minute entries is close to 3 years of readings
+repeats = 20
+
+# Build a one-entry DataFrame at the given 5-minute slot after the start of the table
+def one_entry(slot, station_ids):
+    reading_time = (pd.Timestamp('2021-07-07T00:00:00+08:00') + pd.Timedelta(minutes=5 * slot)).isoformat()
+    return pd.DataFrame(np.random.uniform(20, 35, (1, len(station_ids))), index=[reading_time], columns=station_ids)
+
+# Grow the wide table to num_rows rows directly (bypassing the Collector, which would take far longer)
+def grow_table(con, db_table_name, station_ids, from_rows, num_rows):
+    cols = ', '.join(['date_time'] + station_ids)
+    marks = ', '.join(['?'] * (len(station_ids) + 1))
+    rows = ([one_entry(slot, station_ids).index[0]] + [f'{v:.1f}' for v in np.random.uniform(20, 35, len(station_ids))] for slot in range(from_rows, num_rows))
+    with con:
+        con.executemany(f"INSERT INTO {db_table_name} ({cols}) VALUES ({marks})", rows)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        table_sizes = [size for size in table_sizes if size <= int(sys.argv[1])]
+    station_ids = [f'S{100 + i}' for i in range(num_stations)]
+    collector = Collector(look_for='temp', build_format='V1', ping_interval=0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_db = os.path.join(tmp_dir, 'bench_vault.db')
+
+        # First flush creates the table and its station columns
+        with contextlib.redirect_stdout(io.StringIO()):
+            collector._send_to_wide_db(one_entry(0, station_ids), 'temperature', path_to_db)
+        con = sl.connect(path_to_db)
+        rows_in_table = 1
+
+        print(f"{'rows in table':>14} {'median flush (ms)':>18} {'max flush (ms)':>15}")
+        for size in table_sizes:
+            grow_table(con, 'temperature', station_ids, rows_in_table, size)
+            rows_in_table = size
+            latencies = list()
+            for _ in range(repeats):
+                df = one_entry(rows_in_table, station_ids)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    collector._send_to_wide_db(df, 'temperature', path_to_db)
+                latencies.append((time.perf_counter() - start) * 1000)
+                rows_in_table += 1
+            print(f"{size:>14,} {np.median(latencies):>18.2f} {np.max(latencies):>15.2f}")
+        con.close()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import random
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_vault import Collector
+
+"""
+
+Microbenchmark of Collector._get_reading (V1 build_format) over synthetic payloads with hundreds of stations, against the previous nested-loop join (reproduced below as legacy_get_reading).
+
+Readings in the synthetic payloads are shuffled (the API does not promise any order), which is the worst case for the nested loop.
+
+Usage: python benchmarks/bench_get_reading.py
+
+"""
+
+station_counts = [60, 200, 500, 1000]
+repeats = 20
+
+# Build a synthetic API payload with num_stations stations (and one reading per station)
+def synthetic_payload(num_stations):
+    stations = [{'id': f'S{i}', 'device_id': f'S{i}', 'name': f'Station {i}', 'location': {'latitude': 1.3 + i * 1e-4, 'longitude': 103.8 + i * 1e-4}} for i in range(1, num_stations + 1)]
+    readings = [{'station_id': station['id'], 'value': round(random.uniform(20, 35), 1)} for station in stations]
+    random.shuffle(readings)
+    return {'metadata': {'stations': stations, 'reading_unit': 'deg C'}, 'items': [{'timestamp': '2021-07-07T15:10:00+08:00', 'readings': readings}]}
+
+# The previous V1 join: nested while loop restarting the readings scan after every match, then a sort_index with a string-slicing key
+def legacy_get_reading(raw_reading, data_name):
+    stations = raw_reading['metadata']['stations']
+    readings = raw_reading['items'][0]['readings']
+    station_i, reading_i = 0, 0
+    while station_i <= len(stations) - 1:
+        if stations[station_i]['id'] == readings[reading_i]['station_id']:
+            stations[station_i][data_name] = readings[reading_i]['value']
+            station_i += 1
+            reading_i = 0
+        else:
+            reading_i += 1
+    column_header = [station['id'].strip() for station in stations]
+    entry = [float(station[data_name]) for station in stations]
+    df_entry = pd.DataFrame(np.array([entry]), columns=column_header)
+    df_entry.rename(index={0: raw_reading['items'][0]['timestamp']}, inplace=True)
+    df_entry.sort_index(axis=1, inplace=True, key=lambda x: x.to_series().str[1:].astype(int))
+    return df_entry
+
+# Median time (ms) of repeats calls of func
+def median_ms(func):
+    latencies = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.median(latencies)
+
+if __name__ == '__main__':
+    collector = Collector(look_for='temp', build_format='V1', ping_interval=0)
+
+    print(f"{'stations':>9} {'legacy (ms)':>12} {'_get_reading (ms)':>18} {'speed-up':>9}")
+    for num_stations in station_counts:
+        raw_reading = synthetic_payload(num_stations)
+        collector.raw_reading = raw_reading
+        collector.reading_time = raw_reading['items'][0]['timestamp']
+        collector.reading_unit = raw_reading['metadata']['reading_unit']
+
+        # Both joins must give the same row
+        assert legacy_get_reading(raw_reading, 'temperature').equals(collector._get_reading())
+
+        legacy_ms = median_ms(lambda: legacy_get_reading(raw_reading, 'temperature'))
+        new_ms = median_ms(collector._get_reading)
+        print(f"{num_stations:>9} {legacy_ms:>12.2f} {new_ms:>18.3f} {legacy_ms / new_ms:>8.1f}x")
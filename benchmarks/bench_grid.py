@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vault_grid
+from vault_grid import Grid, Interpolator, interpolator_for
+
+"""
+
+Grid interpolation benchmark: a day of readings (288 timestamps) of num_stations stations interpolated onto a Singapore grid of resolution_km cells:
+    per timestamp: neighbours and weights recomputed for every timestamp, one timestamp at a time (what a map per reading would do)
+    precomputed: one Interpolator (neighbours and weights computed once, reused through interpolator_for), every timestamp interpolated at once
+
+Usage: python benchmarks/bench_grid.py [--stations 60] [--resolutions 1 0.5 0.25] [--timestamps 288]
+
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Grid interpolation benchmark: per-timestamp vs precomputed, vectorised IDW.")
+    parser.add_argument('--stations', type=int, default=60, help="stations (default: 60)")
+    parser.add_argument('--resolutions', type=float, nargs='+', default=[1, 0.5, 0.25], help="grid cell sizes in km (default: 1 0.5 0.25)")
+    parser.add_argument('--timestamps', type=int, default=288, help="timestamps interpolated (default: 288, a day)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    south, west, north, east = vault_grid.singapore_bounds
+    station_ids = [f'S{i}' for i in range(1, args.stations + 1)]
+    lats, lons = rng.uniform(south, north, args.stations), rng.uniform(west, east, args.stations)
+    block = rng.uniform(24, 34, (args.timestamps, args.stations))
+    block[rng.random(block.shape) < 0.05] = np.nan
+
+    print(f"Neighbour search: {'scipy cKDTree' if vault_grid.cKDTree is not None else 'NumPy argpartition (scipy not installed)'}")
+    print(f"{'resolution (km)':>16} {'points':>8} {'per timestamp (s)':>18} {'precomputed (s)':>16} {'speed-up':>9}")
+    for resolution_km in args.resolutions:
+        grid = Grid(resolution_km=resolution_km)
+
+        start = time.perf_counter()
+        per_timestamp = np.stack([Interpolator(station_ids, lats, lons, grid).interpolate(block[t:t + 1])[0] for t in range(args.timestamps)])
+        per_timestamp_s = time.perf_counter() - start
+
+        vault_grid._interpolators.clear()
+        start = time.perf_counter()
+        precomputed = interpolator_for(station_ids, lats, lons, grid).interpolate(block)
+        precomputed_s = time.perf_counter() - start
+
+        assert np.allclose(per_timestamp, precomputed, equal_nan=True)
+        print(f"{resolution_km:>16} {grid.num_lats * grid.num_lons:>8,} {per_timestamp_s:>18.2f} {precomputed_s:>16.3f} {per_timestamp_s / precomputed_s:>8.1f}x")
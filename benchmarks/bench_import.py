@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_vault import Collector
+from vault_import import import_recordings
+from vault_transport import ReplayTransport
+from bench_ingest import write_recording
+
+"""
+
+Bulk import benchmark: num_entries captured payloads of air-temperature (a recording, as written by vault_transport.RecordingTransport) loaded into an empty database:
+    collector: replayed through a Collector (ReplayTransport + build_df, flushing every flush_every entries), single-threaded
+    import (N workers): vault_import.import_recordings, parsing in N worker processes (0: in the writing process)
+
+and reports payloads/sec (and readings/sec). Throughput with workers grows with the number of cores, up to the rate of the single writer.
+
+Usage: python benchmarks/bench_import.py [--entries 8640] [--stations 60] [--storage narrow] [--workers 0 1 2 4]
+
+"""
+
+## Load the recording at path_to_recording into a new database, in mode ('collector' or a number of workers). Returns the elapsed seconds.
+def run(mode, path_to_recording, num_entries, storage, shard_mb):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_db = os.path.join(tmp_dir, 'bench_vault.db')
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if mode == 'collector':
+                collector = Collector(look_for='temp', build_format='V1', ping_interval=0, session=ReplayTransport(path_to_recording))
+                for cnt in collector.build_df(db_table_name='temperature', limit=num_entries, path_to_db=path_to_db, send_to_db=True, storage=storage, flush_every=288):
+                    pass
+            else:
+                import_recordings([path_to_recording], path_to_db=path_to_db, storage=storage, max_workers=mode, shard_mb=shard_mb)
+        return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import benchmark: Collector replay vs vault_import with N parsing processes.")
+    parser.add_argument('--entries', type=int, default=8640, help="captured payloads to import (default: 8640, a month)")
+    parser.add_argument('--stations', type=int, default=60, help="stations per payload (default: 60)")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4], help="worker counts to run (default: 0 1 2 4)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_recording = os.path.join(tmp_dir, 'recording.jsonl')
+        write_recording(path_to_recording, args.stations, 0, args.entries, np.random.default_rng(0))
+        size_mb = os.path.getsize(path_to_recording) / 2 ** 20
+        shard_mb = size_mb / (4 * max(max(args.workers), 1))             # Enough shards to keep every worker busy
+
+        print(f"{args.entries:,} payloads ({size_mb:.0f} MB), {os.cpu_count()} cores")
+        print(f"{'mode':>20} {'payloads/sec':>13} {'readings/sec':>13} {'speed-up':>9}")
+        baseline = None
+        for mode in ['collector', *args.workers]:
+            elapsed = run(mode, path_to_recording, args.entries, args.storage, shard_mb)
+            baseline = baseline or elapsed
+            name = mode if mode == 'collector' else f'import ({mode} workers)'
+            print(f"{name:>20} {args.entries / elapsed:>13,.0f} {args.entries * args.stations / elapsed:>13,.0f} {baseline / elapsed:>8.1f}x")
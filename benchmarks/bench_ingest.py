@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_vault import Collector
+from vault_store import NarrowStore
+from vault_transport import ReplayTransport
+
+"""
+
+Ingestion benchmark suite: Collector._connect_to_api + _get_block + build_df(send_to_db=True), fed from a recording by ReplayTransport (no network).
+
+Each scenario replays num_entries captured payloads of air-temperature into a database already holding some history, streaming every entry to the database (flush_every=1), and reports:
+    readings/sec: readings ingested per second of wall time (decode, parse, buffer and write)
+    p50/p99 flush: latency of each Collector._send_to_db call
+    peak RSS: maximum resident memory of the (fresh) process running the scenario
+
+Scales multiply the normal station count (60) and the normal history length (1 day, 288 entries), one axis at a time:
+    stations axis: 60 x scale stations, 1 day of history
+    history axis: 60 stations, 288 x scale entries of history
+
+The default scales are 1 and 100. Pass --scales 1 100 10000 for the full suite (10000x history is ~27 years, i.e. 173 million narrow rows, and takes a long time to build). The wide backend is limited to 2000 columns by SQLite, so it skips larger station counts.
+
+Usage: python benchmarks/bench_ingest.py [--scales 1 100 10000] [--entries 12] [--storage narrow]
+
+"""
+
+base_stations, base_history = 60, 288
+sg_timezone = timezone(timedelta(hours=8))
+start_time = datetime(2021, 7, 7, tzinfo=sg_timezone)
+
+# reading_time of the slot-th 5-minute entry
+def reading_time_of(slot):
+    return (start_time + timedelta(minutes=5 * slot)).isoformat()
+
+# Build an API payload of num_stations stations, with one item at slot
+def synthetic_payload(num_stations, slot, rng):
+    stations = [{'id': f'S{i}', 'device_id': f'S{i}', 'name': f'Station {i}', 'location': {'latitude': 1.3, 'longitude': 103.8}} for i in range(1, num_stations + 1)]
+    values = np.round(rng.uniform(24, 34, num_stations), 1).tolist()
+    readings = [{'station_id': station['id'], 'value': value} for station, value in zip(stations, values)]
+    return {'metadata': {'stations': stations, 'reading_unit': 'deg C'}, 'items': [{'timestamp': reading_time_of(slot), 'readings': readings}]}
+
+# Write a recording of num_entries payloads (one per slot, after the history)
+def write_recording(path_to_recording, num_stations, first_slot, num_entries, rng):
+    with open(path_to_recording, 'w') as f:
+        for slot in range(first_slot, first_slot + num_entries):
+            record = {'data_type': 'air-temperature', 'url': 'https://api.data.gov.sg/v1/environment/air-temperature', 'params': None, 'received': 0, 'status_code': 200, 'headers': {}, 'payload': synthetic_payload(num_stations, slot, rng)}
+            f.write(json.dumps(record) + '\n')
+
+# Fill the database with num_entries of history (in day-sized blocks, straight through the storage backends)
+def write_history(path_to_db, storage, num_stations, num_entries, rng):
+    station_ids = [f'S{i}' for i in range(1, num_stations + 1)]
+    collector = Collector(look_for='temp', build_format='V1', ping_interval=0)
+    store = NarrowStore(path_to_db) if storage == 'narrow' else None
+    for first_slot in range(0, num_entries, base_history):
+        slots = range(first_slot, min(first_slot + base_history, num_entries))
+        reading_times = [reading_time_of(slot) for slot in slots]
+        block = np.round(rng.uniform(24, 34, (len(slots), num_stations)), 1)
+        if store is not None:
+            store.write_block('temperature', reading_times, station_ids, block)
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                collector._send_to_wide_db(pd.DataFrame(block, index=reading_times, columns=station_ids), 'temperature', path_to_db)
+    if store is not None:
+        store.close()
+
+## Run one scenario (in a fresh process) and put its results on results
+def run_scenario(num_stations, history_entries, num_entries, storage, results):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_db, path_to_recording = os.path.join(tmp_dir, 'bench_vault.db'), os.path.join(tmp_dir, 'recording.jsonl')
+        write_history(path_to_db, storage, num_stations, history_entries, rng)
+        write_recording(path_to_recording, num_stations, history_entries, num_entries, rng)
+
+        collector = Collector(look_for='temp', build_format='V1', ping_interval=0, session=ReplayTransport(path_to_recording))
+
+        # Time every flush
+        flush_latencies = list()
+        send_to_db = collector._send_to_db
+        def timed_send_to_db(*args, **kwargs):
+            start = time.perf_counter()
+            send_to_db(*args, **kwargs)
+            flush_latencies.append(time.perf_counter() - start)
+        collector._send_to_db = timed_send_to_db
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for cnt in collector.build_df(db_table_name='temperature', limit=num_entries, path_to_db=path_to_db, send_to_db=True, storage=storage, flush_every=1):
+                pass
+        elapsed = time.perf_counter() - start
+
+    results.put({
+        'readings_per_sec': num_stations * num_entries / elapsed,
+        'p50_flush_ms': np.percentile(flush_latencies, 50) * 1000,
+        'p99_flush_ms': np.percentile(flush_latencies, 99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,           # ru_maxrss is in KB on Linux
+        })
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingestion benchmark suite for the Collector.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 100], help="multiples of the normal station count and history length (default: 1 100)")
+    parser.add_argument('--entries', type=int, default=12, help="number of payloads replayed per scenario (default: 12, an hour of readings)")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage backend")
+    args = parser.parse_args()
+
+    scenarios = [('stations', scale, base_stations * scale, base_history) for scale in args.scales]
+    scenarios += [('history', scale, base_stations, base_history * scale) for scale in args.scales if scale != 1]
+
+    context = mp.get_context('spawn')
+    print(f"{'axis':>9} {'scale':>7} {'stations':>9} {'history':>10} {'readings/sec':>13} {'p50 flush (ms)':>15} {'p99 flush (ms)':>15} {'peak RSS (MB)':>14}")
+    for axis, scale, num_stations, history_entries in scenarios:
+        if args.storage == 'wide' and num_stations > 1900:
+            print(f"{axis:>9} {scale:>6}x {num_stations:>9,} {history_entries:>10,}   skipped (too many columns for a wide table)")
+            continue
+        results = context.Queue()
+        process = context.Process(target=run_scenario, args=(num_stations, history_entries, args.entries, args.storage, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f"{axis:>9} {scale:>6}x {num_stations:>9,} {history_entries:>10,} {result['readings_per_sec']:>13,.0f} {result['p50_flush_ms']:>15.2f} {result['p99_flush_ms']:>15.2f} {result['peak_rss_mb']:>14.1f}")
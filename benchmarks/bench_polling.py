@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import time
+import contextlib
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_nea import FakeNEA
+from weather_vault import Collector
+from vault_schedule import PollScheduler
+from vault_store import to_epoch
+
+"""
+
+Polling strategies of Collector.build_df against a local fake_nea server (offline), with time scaled down 100x (a 3 s cadence stands for the 5 min cadence of the API):
+    fixed: poll every ping_interval (0.6 s, standing for the 60 s used by main_psg.py)
+    scheduled: PollScheduler aligned to the cadence
+
+Both send conditional requests (ETag/If-Modified-Since), so polls returning the same reading are answered with an empty 304.
+
+Reports requests, 304 responses and body bytes per reading, and the lag between the publication of a reading and its collection.
+
+Usage: python benchmarks/bench_polling.py [num_entries]
+
+"""
+
+scale = 100                     # Real seconds per simulated second
+cadence, publish_lag = 300 // scale, 0.1
+
+# Collect num_entries with collector against server, returning the requests, 304 responses and bytes per reading, and the mean pick-up lag (in simulated seconds)
+def run(server, collector, num_entries):
+    counters = [server.request_counts, server.not_modified_counts, server.bytes_sent]
+    before = [counter.get('air-temperature', 0) for counter in counters]
+    lags = list()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for cnt in collector.build_df(db_table_name='temperature', limit=num_entries):
+            lags.append(time.time() - (to_epoch(collector.reading_time) + publish_lag))
+    per_reading = [(counter.get('air-temperature', 0) - count_before) / num_entries for counter, count_before in zip(counters, before)]
+    return per_reading + [sum(lags[1:]) / max(len(lags) - 1, 1) * scale]
+
+if __name__ == '__main__':
+    num_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    server = FakeNEA(cadence=cadence, publish_lag=publish_lag).start()
+    session = requests.Session()
+
+    fixed = Collector(look_for='temp', build_format='V1', ping_interval=60 / scale, session=session, base_url=server.url)
+    scheduled = Collector(look_for='temp', build_format='V1', ping_interval=60 / scale, session=session, base_url=server.url,
+                          scheduler=PollScheduler(cadence=cadence, lag=15 / scale, retry_interval=5 / scale, max_retry_interval=60 / scale))
+
+    print(f"{'strategy':>10} {'requests/reading':>17} {'304s/reading':>13} {'bytes/reading':>14} {'mean lag (s)':>13}")
+    for name, collector in [('fixed', fixed), ('scheduled', scheduled)]:
+        requests_per_reading, not_modified_per_reading, bytes_per_reading, lag = run(server, collector, num_entries)
+        print(f"{name:>10} {requests_per_reading:>17.2f} {not_modified_per_reading:>13.2f} {bytes_per_reading:>14,.0f} {lag:>13.1f}")
+    server.stop()
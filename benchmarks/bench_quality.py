@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import numpy as np
+import sqlite3 as sl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vault_quality import QualityFilter, checks, flag_range, flag_spike, flag_stuck
+from vault_store import NarrowStore
+from bench_ingest import reading_time_of
+
+"""
+
+Data-quality check benchmark: temperature readings of num_stations stations checked (range, spike and stuck over a window of 12 readings, and gaps):
+    per reading: every reading checked on its own in Python, against the window of its station
+    vectorised: vault_quality.QualityFilter.check, the whole block at once, with the window kept in process
+
+for live flushes (one entry at a time) and bulk writes (a week of entries at once), as the time per reading, and the share of a NarrowStore.write_block of the same entries spent in the check.
+
+Usage: python benchmarks/bench_quality.py [--stations 60] [--entries 2016]
+
+"""
+
+# Check every reading of block (rows: entries) against the window readings of its station before it, one reading at a time
+def check_per_reading(history, block, check, window=12):
+    flags = np.zeros(block.shape, dtype=np.uint8)
+    columns = [list(history[:, column_i]) for column_i in range(block.shape[1])]
+    for row_i in range(block.shape[0]):
+        for column_i in range(block.shape[1]):
+            value, before = block[row_i, column_i], columns[column_i][-window:]
+            if not value == value:
+                columns[column_i].append(value)
+                continue
+            if value < check['low'] or value > check['high']:
+                flags[row_i, column_i] |= flag_range
+                value = float('nan')
+            present = [reading for reading in before if reading == reading]
+            if len(present) >= window // 2 and abs(value - statistics.median(present)) > check['max_step']:
+                flags[row_i, column_i] |= flag_spike
+            if len(before) == window and all(reading == value for reading in before):
+                flags[row_i, column_i] |= flag_stuck
+            columns[column_i].append(value)
+    return flags
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Data-quality check benchmark: per reading vs vectorised.")
+    parser.add_argument('--stations', type=int, default=60, help="stations (default: 60)")
+    parser.add_argument('--entries', type=int, default=2016, help="entries of the bulk write (default: 2016, a week)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    station_ids = [f'S{i}' for i in range(1, args.stations + 1)]
+    block = np.round(rng.normal(28, 1, (args.entries + 12, args.stations)), 1)
+    block[rng.random(block.shape) < 0.02] = np.nan
+    epochs = 1625587200 + 300 * np.arange(len(block))
+    con = sl.connect(':memory:')
+
+    print(f"{'write':>6} {'entries':>8} {'per reading (us)':>17} {'vectorised (us)':>16} {'speed-up':>9} {'share of write_block':>21}")
+    for write, entries_per_write in (('live', 1), ('bulk', args.entries)):
+        num_writes = min(args.entries // entries_per_write, 288)
+        quality_filter = QualityFilter()
+        quality_filter.remember(*quality_filter.check(con.cursor(), ':memory:', 'temperature', epochs[:12], station_ids, block[:12])[1])            # Window kept in process, as in a running collector
+        start = time.perf_counter()
+        for write_i in range(num_writes):
+            rows = slice(12 + write_i * entries_per_write, 12 + (write_i + 1) * entries_per_write)
+            quality_filter.remember(*quality_filter.check(con.cursor(), ':memory:', 'temperature', epochs[rows], station_ids, block[rows])[1])
+        vectorised = time.perf_counter() - start
+        num_readings = num_writes * entries_per_write * args.stations
+
+        start = time.perf_counter()
+        check_per_reading(block[:12], block[12:12 + num_writes * entries_per_write], checks['temperature'])
+        per_reading = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = NarrowStore(os.path.join(tmp_dir, 'bench_vault.db'))
+            start = time.perf_counter()
+            for write_i in range(num_writes):
+                store.write_block('temperature', [reading_time_of(slot) for slot in range(write_i * entries_per_write, (write_i + 1) * entries_per_write)], station_ids,
+                                  block[12 + write_i * entries_per_write:12 + (write_i + 1) * entries_per_write])
+            written = time.perf_counter() - start
+            store.close()
+        print(f"{write:>6} {num_writes * entries_per_write:>8} {per_reading / num_readings * 1e6:>17.2f} {vectorised / num_readings * 1e6:>16.3f} {per_reading / vectorised:>8.1f}x {vectorised / written:>20.1%}")
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import http.client
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vault_parse import dumps
+from vault_reader import Reader
+from vault_serve import LatestCache, serve
+from vault_store import NarrowStore
+from bench_ingest import reading_time_of
+
+"""
+
+Current conditions benchmark: GET /latest/temperature from num_clients concurrent keep-alive clients, answered:
+    database: by a query of the last hour from the database (vault_reader.Reader) on every request, encoded on every request
+    cache: from a vault_serve.LatestCache (precomputed JSON, no database access)
+
+against a database holding days_of_history days of 60-station readings, and reports requests/sec and p50/p99 latency.
+
+Usage: python benchmarks/bench_serve.py [--clients 8] [--requests 2000] [--days 30]
+
+"""
+
+## Serve GET /latest/temperature with a database query per request
+def serve_from_db(path_to_db, port=0):
+    local = threading.local()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if not hasattr(local, 'reader'):
+                local.reader = Reader(path_to_db, storage='narrow')
+            epochs, station_ids, block = local.reader.query('temperature', last_epoch - 3600 + 1, last_epoch, as_frame=False)
+            present = ~np.isnan(block)
+            last_i = len(epochs) - 1 - np.argmax(present[::-1], axis=0)
+            body = dumps({'data_type': 'temperature', 'stations': {station_id: {'value': float(block[row_i, column_i])} for column_i, (station_id, row_i) in enumerate(zip(station_ids, last_i.tolist()))}})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+## Send num_requests requests from num_clients keep-alive clients. Returns (requests/sec, latencies in ms).
+def load(port, num_clients, num_requests):
+    latencies = list()
+    def client():
+        con = http.client.HTTPConnection('127.0.0.1', port)
+        for _ in range(num_requests // num_clients):
+            start = time.perf_counter()
+            con.request('GET', '/latest/temperature')
+            response = con.getresponse()
+            assert response.status == 200
+            response.read()
+            latencies.append((time.perf_counter() - start) * 1000)
+        con.close()
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies) / (time.perf_counter() - start), latencies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Current conditions benchmark: database query per request vs LatestCache.")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients (default: 8)")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per mode (default: 2000)")
+    parser.add_argument('--days', type=int, default=30, help="days of 5-minute history in the database (default: 30)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_db = os.path.join(tmp_dir, 'bench_vault.db')
+        store = NarrowStore(path_to_db)
+        station_ids = [f'S{i}' for i in range(1, 61)]
+        for day in range(args.days):
+            reading_times = [reading_time_of(slot) for slot in range(day * 288, (day + 1) * 288)]
+            store.write_block('temperature', reading_times, station_ids, np.round(rng.uniform(24, 34, (288, 60)), 1))
+        store.close()
+        last_epoch = int(np.datetime64(reading_times[-1][:19]).astype('datetime64[s]').astype(np.int64)) - 8 * 3600
+
+        print(f"{'mode':>9} {'requests/sec':>13} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for mode in ('database', 'cache'):
+            if mode == 'database':
+                server = serve_from_db(path_to_db)
+            else:
+                cache = LatestCache(path_to_db=path_to_db, storage='narrow')
+                server = serve(cache, port=0)
+            requests_per_sec, latencies = load(server.server_address[1], args.clients, args.requests)
+            server.shutdown()
+            print(f"{mode:>9} {requests_per_sec:>13,.0f} {np.percentile(latencies, 50):>9.2f} {np.percentile(latencies, 99):>9.2f}")
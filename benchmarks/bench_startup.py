@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+"""
+
+Startup benchmark: wall time of short runs in a fresh interpreter (as started by cron or a systemd timer), over num_runs runs each, net of the start of a bare interpreter:
+
+    import weather_vault, and build a Collector of every data type       (lazy: numpy, pandas and requests only imported on first use, see vault_lazy)
+    the same, with numpy, pandas and requests imported up front           (eager: what every start paid before)
+    python vault_daemon.py --help                                         (a CLI parsing its arguments)
+
+It also reports the time to build a Collector, now that look_for keywords are resolved through a precompiled table.
+
+Usage: python benchmarks/bench_startup.py [--runs 10]
+
+"""
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+collectors = "from weather_vault import Collector; [Collector(look_for=look_for, build_format='V1', ping_interval=0) for look_for in ('temp', 'rain', 'humid', 'direction', 'speed')]"
+
+# Median wall time (seconds) of running argv num_runs times in a fresh interpreter
+def wall_time(argv, num_runs):
+    times = list()
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=root, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup benchmark: lazy vs eager imports of the heavy libraries.")
+    parser.add_argument('--runs', type=int, default=10, help="runs of each command (default: 10)")
+    args = parser.parse_args()
+
+    baseline = wall_time([sys.executable, '-c', 'pass'], args.runs)
+    runs = [
+        ('collectors (lazy)', [sys.executable, '-c', collectors]),
+        ('collectors (eager)', [sys.executable, '-c', 'import numpy, pandas, requests; ' + collectors]),
+        ('vault_daemon --help', [sys.executable, 'vault_daemon.py', '--help']),
+        ]
+    print(f"Bare interpreter: {baseline * 1000:.1f} ms")
+    print(f"{'run':>20} {'startup (ms)':>13}")
+    for name, argv in runs:
+        print(f"{name:>20} {(wall_time(argv, args.runs) - baseline) * 1000:>13.1f}")
+
+    sys.path.insert(0, root)
+    from weather_vault import Collector
+    start = time.perf_counter()
+    for _ in range(10000):
+        Collector(look_for='speed', build_format='V1', ping_interval=0)
+    print(f"Collector construction: {(time.perf_counter() - start) / 10000 * 1e6:.1f} us")
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_nea import FakeNEA
+from vault_transport import ResilientTransport
+
+"""
+
+Transports against a local fake_nea server injecting faults (offline): of num_requests polls of one endpoint, 10% are answered 503, 2% are dropped, and 3% are answered slow_seconds late:
+    session: a plain requests.Session (no timeout, no retry: every fault fails the poll, or stalls it)
+    resilient: ResilientTransport without hedging (timeouts, jittered retries)
+    hedged: ResilientTransport with hedged requests (after the 95th percentile of the latencies of the endpoint)
+
+Reports the polls that succeeded, the p50, p99 and maximum latency of a poll (including its retries and their jittered delays), and the polls that took slow_seconds or more.
+
+Then, with the endpoint down (every request answered 503), the time a poll takes once the circuit of the endpoint is open, against a poll of the plain session.
+
+Usage: python benchmarks/bench_transport.py [--requests 300] [--slow-seconds 2]
+
+"""
+
+# Poll url num_requests times through transport: (share of polls answered 200, latencies of the polls in seconds)
+def run(transport, url, num_requests):
+    ok, latencies = 0, list()
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        try:
+            ok += transport.get(url).status_code == 200
+        except requests.exceptions.RequestException:
+            pass
+        latencies.append(time.perf_counter() - start)
+    return ok / num_requests, sorted(latencies)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Transport benchmark: success and tail latency of polls against injected faults.")
+    parser.add_argument('--requests', type=int, default=300, help="polls per transport (default: 300)")
+    parser.add_argument('--slow-seconds', type=float, default=2.0, help="delay of the slow responses (default: 2)")
+    args = parser.parse_args()
+
+    server = FakeNEA().start()
+    url = f"{server.url}/air-temperature"
+    transports = [
+        ('session', requests.Session()),
+        ('resilient', ResilientTransport(requests.Session(), hedge=False)),
+        ('hedged', ResilientTransport(requests.Session())),
+        ]
+
+    print(f"{'transport':>10} {'ok':>7} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} {'slow polls':>11}")
+    for name, transport in transports:
+        server.set_faults(error_rate=0.10, drop_rate=0.02, slow_rate=0.03, slow_seconds=args.slow_seconds, seed=1)
+        ok, latencies = run(transport, url, args.requests)
+        print(f"{name:>10} {ok:>7.1%} {latencies[len(latencies) // 2] * 1000:>9.1f} {latencies[int(len(latencies) * 0.99)] * 1000:>9.1f} {latencies[-1] * 1000:>9.1f} {sum(latency >= args.slow_seconds for latency in latencies):>11}")
+
+    # Outage: the circuit opens after failure_threshold failed attempts, then polls fail without any request
+    server.set_faults(down=['air-temperature'])
+    resilient = ResilientTransport(requests.Session(), hedge=False)
+    run(resilient, url, 5)
+    for name, transport in [('session', requests.Session()), ('resilient', resilient)]:
+        _, latencies = run(transport, url, 100)
+        print(f"Poll of an endpoint down ({name}): {latencies[len(latencies) // 2] * 1e6:,.0f} us")
+    print(f"Circuits: {resilient.report()}")
+    server.stop()
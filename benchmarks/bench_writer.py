@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+import sqlite3 as sl
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_vault import Collector
+from vault_engine import all_look_fors
+from vault_writer import DbWriter
+
+"""
+
+Concurrent write benchmark: num_entries entries of each of the 5 data types are written to one database by 5 threads at once (as by the collection threads of main_psg), either:
+    direct: every thread writes its own entries (Collector._send_to_db, one connection per write)
+    writer: every thread submits its entries to one shared vault_writer.DbWriter
+
+and reports the total write throughput (entries/sec over all data types) and the number of writes that failed (e.g. 'database is locked').
+
+Usage: python benchmarks/bench_writer.py [--entries 200] [--stations 60] [--storage wide]
+
+"""
+
+sg_timezone = timezone(timedelta(hours=8))
+start_time = datetime(2021, 7, 7, tzinfo=sg_timezone)
+
+# DataFrame of one entry (at slot) of num_stations stations
+def entry_df(slot, num_stations, rng):
+    reading_time = (start_time + timedelta(minutes=5 * slot)).isoformat()
+    return pd.DataFrame(np.round(rng.uniform(0, 100, (1, num_stations)), 1), index=[reading_time], columns=[f'S{i}' for i in range(1, num_stations + 1)])
+
+## Write num_entries entries per data type from 5 threads, directly or through a DbWriter. Returns (entries/sec, failed writes).
+def run(mode, num_entries, num_stations, storage):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_db = os.path.join(tmp_dir, 'bench_vault.db')
+        collectors = [Collector(look_for=look_for, build_format='V1', ping_interval=0) for look_for in all_look_fors]
+        for collector in collectors:
+            collector.stations = [{'id': f'S{i}', 'location': {}} for i in range(1, num_stations + 1)]
+        dfs = {collector.data_name: [entry_df(slot, num_stations, np.random.default_rng(slot)) for slot in range(num_entries)] for collector in collectors}
+        writer = DbWriter(path_to_db) if mode == 'writer' else None
+        failed = list()
+
+        def write_all(collector):
+            for df in dfs[collector.data_name]:
+                try:
+                    collector._send_to_db(df, collector.data_name, path_to_db, storage, writer=writer)
+                except sl.OperationalError:
+                    failed.append(1)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            threads = [threading.Thread(target=write_all, args=(collector,)) for collector in collectors]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if writer is not None:
+                writer.close()
+                failed += [1] * writer.num_failed
+        elapsed = time.perf_counter() - start
+    return len(collectors) * num_entries / elapsed, len(failed), (writer.num_transactions if writer is not None else len(collectors) * num_entries - len(failed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent write benchmark: one writer per thread vs a shared DbWriter.")
+    parser.add_argument('--entries', type=int, default=200, help="entries written per data type (default: 200)")
+    parser.add_argument('--stations', type=int, default=60, help="stations per entry (default: 60)")
+    parser.add_argument('--storage', default='wide', choices=['wide', 'narrow'], help="storage backend")
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'entries/sec':>12} {'transactions':>13} {'failed writes':>14}")
+    for mode in ('direct', 'writer'):
+        entries_per_sec, num_failed, num_transactions = run(mode, args.entries, args.stations, args.storage)
+        print(f"{mode:>8} {entries_per_sec:>12,.0f} {num_transactions:>13,} {num_failed:>14,}")
@@ -26,15 +26,11 @@ def extract_humidity_data():
     stations = _raw_data['metadata']['stations']              # Type: list. Format: [{'id': ..., 'device_id': ..., 'name': ..., 'location': {'latitude': ..., 'longitude': ...}}, {~~~}, ...]
     _data = _raw_data['items'][0]['readings']                 # Type: list. Format: [{'station_id': ..., 'value': ...}, {~~~}, ...]
 
-    _station_i, _data_i = 0, 0
+    # Index the readings by station id once, then look up the reading of every station (stations without a reading get None)
+    _data_by_station = {_reading['station_id']: _reading['value'] for _reading in _data}
     num_stations = len(stations)
-    while _station_i <= num_stations - 1:
-        if stations[_station_i]['id'] == _data[_data_i]['station_id']:
-            stations[_station_i]['relative_humidity'] = _data[_data_i]['value']       # Add relative humidity reading into processed dictionary
-            _station_i += 1
-            _data_i = 0
-        else:
-            _data_i += 1
+    for _station in stations:
+        _station['relative_humidity'] = _data_by_station.get(_station['id'], None)       # Add relative_humidity reading into processed dictionary
 
     humidity_data = {'reading_time': reading_time, 'reading_unit': reading_unit, 'stations': stations}
     return humidity_data, num_stations
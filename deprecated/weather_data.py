@@ -67,16 +67,11 @@ def extract_data(user_input):
     stations = _raw_data['metadata']['stations']              # Type: list. Format: [{'id': ..., 'device_id': ..., 'name': ..., 'location': {'latitude': ..., 'longitude': ...}}, {~~~}, ...]
     _data = _raw_data['items'][0]['readings']                 # Type: list. Format: [{'station_id': ..., 'value': ...}, {~~~}, ...]
 
-    # Modify the json data to the necessary structure
-    _station_i, _data_i = 0, 0
+    # Modify the json data to the necessary structure: index the readings by station id once, then look up the reading of every station (stations without a reading get np.nan)
+    _data_by_station = {_reading['station_id']: _reading['value'] for _reading in _data}
     num_stations = len(stations)
-    while _station_i <= num_stations - 1:
-        if stations[_station_i]['id'] == _data[_data_i]['station_id']:
-            stations[_station_i][f'{data_name}'] = _data[_data_i]['value']       # Add f'{data_name}' reading into processed dictionary
-            _station_i += 1
-            _data_i = 0
-        else:
-            _data_i += 1
+    for _station in stations:
+        _station[f'{data_name}'] = _data_by_station.get(_station['id'], np.nan)       # Add f'{data_name}' reading into processed dictionary
     data = {'reading_time': reading_time, 'reading_unit': reading_unit, 'stations': stations}
 
     # Prepare dataframe for requested data_type
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+import json
+import time
+import random
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from vault_transport import read_recording
+
+"""
+
+FakeNEA object is a local stand-in for the NEA API (https://api.data.gov.sg/v1/environment/{data_type}), so Collectors can be run offline.
+
+A new reading is published every cadence seconds (publish_lag seconds after its reading_time), with synthetic values for num_stations stations. Point a Collector at it with base_url=server.url.
+
+Like a server supporting conditional requests, every response carries an ETag and a Last-Modified header, and a request whose If-None-Match/If-Modified-Since shows the client already has the latest reading gets a 304 (Not Modified) with an empty body.
+
+A recording of captured responses (see vault_transport) can be served instead of synthetic readings with load_recording.
+
+Historical requests (?date=YYYY-MM-DD) return every reading of that day published so far, as items of one payload (not conditional).
+
+The server counts requests, 304 responses and body bytes sent per data type (request_counts, not_modified_counts, bytes_sent), to compare polling strategies.
+
+Faults can be injected (set_faults), to exercise retrying transports (see vault_transport.ResilientTransport). Each request is, at random (from seed):
+    answered 503 (Service Unavailable), with probability error_rate
+    dropped (the connection is closed without any response), with probability drop_rate
+    answered after slow_seconds more, with probability slow_rate
+and every request of the data types in down is answered 503 (an outage). Injected faults are counted per kind in fault_counts.
+
+Usage (standalone): python fake_nea.py --port 8080 --cadence 300 [--error-rate 0.1 --drop-rate 0.02 --slow-rate 0.05 --slow-seconds 5]
+
+"""
+
+# Range of synthetic values, and reading_unit, per data_type
+value_ranges = {
+    'air-temperature': (24.0, 34.0, 'deg C'),
+    'rainfall': (0.0, 2.0, 'mm'),
+    'relative-humidity': (55.0, 100.0, 'percentage'),
+    'wind-direction': (0.0, 360.0, 'degrees'),
+    'wind-speed': (0.0, 10.0, 'knots'),
+    }
+sg_timezone = timezone(timedelta(hours=8))
+
+
+class FakeNEA:
+    def __init__(self, host='127.0.0.1', port=0, cadence=300, publish_lag=5, num_stations=60):
+        self.cadence = cadence
+        self.publish_lag = publish_lag
+        self.stations = [{'id': f'S{100 + i}', 'device_id': f'S{100 + i}', 'name': f'Station {100 + i}', 'location': {'latitude': round(1.25 + 0.2 * ((i * 37) % 100) / 100, 4), 'longitude': round(103.65 + 0.35 * ((i * 61) % 100) / 100, 4)}} for i in range(num_stations)]
+        self.request_counts, self.not_modified_counts, self.bytes_sent = dict(), dict(), dict()
+        self.recordings = dict()                         # Recorded payloads to serve (in order) instead of synthetic readings, per data_type
+        self.set_faults()
+        self._lock = threading.Lock()
+
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake._handle(self)
+
+            def log_message(self, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    # Base URL to pass to Collector(base_url=...)
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/environment"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake_nea', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    ## Serve the payloads of a recording (see vault_transport) instead of synthetic readings, in order per data_type. The last payload of a data_type keeps being served once its recording runs out.
+    def load_recording(self, path_to_recording):
+        for record in read_recording(path_to_recording):
+            if record['status_code'] == 200:
+                self.recordings.setdefault(record['data_type'], deque()).append(record['payload'])
+        return self
+
+    ## Inject faults into the requests answered from now on (see above). Without arguments, no fault is injected.
+    def set_faults(self, error_rate=0.0, drop_rate=0.0, slow_rate=0.0, slow_seconds=5.0, down=(), seed=0):
+        self.error_rate, self.drop_rate, self.slow_rate, self.slow_seconds = error_rate, drop_rate, slow_rate, slow_seconds
+        self.down = set(down)                            # data_types answering 503 to every request
+        self.fault_counts = {'error': 0, 'drop': 0, 'slow': 0, 'down': 0}
+        self._faults = random.Random(seed)
+        return self
+
+    # Draw the fault injected into a request of data_type (None, 'error', 'drop', 'slow' or 'down')
+    def _fault(self, data_type):
+        if data_type in self.down:
+            fault = 'down'
+        else:
+            draw = self._faults.random()
+            if draw < self.error_rate:
+                fault = 'error'
+            elif draw < self.error_rate + self.drop_rate:
+                fault = 'drop'
+            elif draw < self.error_rate + self.drop_rate + self.slow_rate:
+                fault = 'slow'
+            else:
+                return None
+        self.fault_counts[fault] += 1
+        return fault
+
+    # Epoch of the latest published reading_time (slots are multiples of cadence)
+    def latest_slot(self, now=None):
+        now = time.time() if now is None else now
+        return int((now - self.publish_lag) // self.cadence * self.cadence)
+
+    ## Build the API payload of data_type for the reading_times (epochs) in slots
+    def payload(self, data_type, slots):
+        low, high, reading_unit = value_ranges[data_type]
+        items = list()
+        for slot in slots:
+            rng = random.Random(f'{data_type}/{slot}')           # Same slot, same values
+            readings = [{'station_id': station['id'], 'value': round(rng.uniform(low, high), 1)} for station in self.stations]
+            items.append({'timestamp': datetime.fromtimestamp(slot, sg_timezone).isoformat(), 'readings': readings})
+        return {'metadata': {'stations': self.stations, 'reading_unit': reading_unit}, 'items': items, 'api_info': {'status': 'healthy'}}
+
+    # Answer one GET request of the handler
+    def _handle(self, handler):
+        url = urlsplit(handler.path)
+        path, query = url.path.rstrip('/'), parse_qs(url.query)
+        data_type = path.rsplit('/', 1)[-1]
+        if not path.startswith('/v1/environment/') or data_type not in value_ranges:
+            handler.send_error(404)
+            return
+        with self._lock:
+            self.request_counts[data_type] = self.request_counts.get(data_type, 0) + 1
+            fault = self._fault(data_type)
+
+        # Injected faults
+        if fault in ('error', 'down'):
+            handler.send_error(503)
+            return
+        if fault == 'drop':
+            handler.close_connection = True              # Closed without a response (the client sees a connection error)
+            return
+        if fault == 'slow':
+            time.sleep(self.slow_seconds)
+
+        # Recorded payloads
+        if data_type in self.recordings:
+            with self._lock:
+                recording = self.recordings[data_type]
+                payload = recording.popleft() if len(recording) > 1 else recording[0]
+            self._send_json(handler, data_type, payload)
+            return
+
+        # Historical request (?date=YYYY-MM-DD): every reading of that day published so far
+        if 'date' in query:
+            try:
+                day_start = int(datetime.strptime(query['date'][0], '%Y-%m-%d').replace(tzinfo=sg_timezone).timestamp())
+            except ValueError:
+                handler.send_error(400)
+                return
+            slots = range(day_start, min(day_start + 86400 - 1, self.latest_slot()) + 1, self.cadence)
+            self._send_json(handler, data_type, self.payload(data_type, slots))
+            return
+
+        slot = self.latest_slot()
+        etag = f'"{data_type}-{slot}"'
+        last_modified = formatdate(slot + self.publish_lag, usegmt=True)
+
+        # Conditional request: 304 if the client already has the latest reading
+        if self._not_modified(handler.headers, etag, slot + self.publish_lag):
+            with self._lock:
+                self.not_modified_counts[data_type] = self.not_modified_counts.get(data_type, 0) + 1
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+
+        self._send_json(handler, data_type, self.payload(data_type, [slot]), {'ETag': etag, 'Last-Modified': last_modified})
+
+    # Send payload as a 200 response (with extra headers, if any)
+    def _send_json(self, handler, data_type, payload, headers=None):
+        body = json.dumps(payload).encode()
+        with self._lock:
+            self.bytes_sent[data_type] = self.bytes_sent.get(data_type, 0) + len(body)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or dict()).items():
+            handler.send_header(header, value)
+        handler.end_headers()
+        try:
+            handler.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass                                         # The client gave up on the request (e.g. it timed out, or a hedged request was answered first)
+
+    @staticmethod
+    def _not_modified(headers, etag, published):
+        if headers.get('If-None-Match') is not None:
+            return headers['If-None-Match'] == etag
+        if headers.get('If-Modified-Since') is not None:
+            try:
+                return parsedate_to_datetime(headers['If-Modified-Since']).timestamp() >= int(published)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve synthetic NEA API readings locally.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cadence', type=int, default=300, help="seconds between readings")
+    parser.add_argument('--publish-lag', type=float, default=5, help="seconds between a reading_time and its publication")
+    parser.add_argument('--stations', type=int, default=60, help="number of stations")
+    parser.add_argument('--replay', help="serve the payloads of this recording (JSON lines) instead of synthetic readings")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered 503")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of requests dropped without a response")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="share of requests answered slow_seconds late")
+    parser.add_argument('--slow-seconds', type=float, default=5.0, help="delay of slow requests (default: 5)")
+    parser.add_argument('--down', nargs='+', default=(), help="data types answering 503 to every request (e.g. rainfall)")
+    args = parser.parse_args()
+
+    server = FakeNEA(host=args.host, port=args.port, cadence=args.cadence, publish_lag=args.publish_lag, num_stations=args.stations)
+    server.set_faults(error_rate=args.error_rate, drop_rate=args.drop_rate, slow_rate=args.slow_rate, slow_seconds=args.slow_seconds, down=args.down)
+    if args.replay:
+        server.load_recording(args.replay)
+    print(f"Fake NEA API serving on {server.url}/{{data_type}}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
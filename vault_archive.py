@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+from vault_store import connect
+from vault_reader import Reader, merge_blocks, sg_timezone, to_bound_date_time
+from vault_quality import create_reading_flags_table
+from vault_rollup import narrow_prefix, series_ranges
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+Archive object keeps cold history (readings older than a configurable age) out of the database, as time-partitioned columnar NumPy files that are memory-mapped when read.
+
+One partition holds one month (Singapore time) of one series (as in the watermarks table: the db_table_name of a wide table, or 'readings/{data_type}' for the narrow readings table):
+
+    archive_dir/
+        manifest.json                                   (every partition: series, month, time span, number of rows and of flagged readings, station ids, files)
+        readings/temperature/2021-07.epochs.npy         (int64: ts_epoch of each row, sorted)
+        readings/temperature/2021-07.values.npy         (float32: rows x stations, NaN for missing readings)
+        readings/temperature/2021-07.flags.npy          (uint8: rows x stations, data-quality flags of the readings, see vault_quality, 0 if unflagged)
+        rainfall/2021-07.epochs.npy                     (wide table 'rainfall')
+        ...
+
+Values are kept as float32 (about 7 significant digits, far beyond the precision of the readings), 4 bytes per reading against a TEXT cell or a narrow row of the database.
+
+The data-quality flags of the readings (the flags column of the readings table, or the reading_flags table of a wide table) are archived with them, 1 byte per reading, and read with Archive.read_flags. Partitions archived before flags were kept read as unflagged.
+
+archive() moves every whole month older than older_than_days out of the database: the partition files are written first, then the manifest, and only then are the rows deleted from the database (and the month merged with an existing partition, if it was archived before). An interrupted run therefore never loses readings. Readings that are both archived and in the database are read from the database. The hourly/daily rollups (see vault_rollup) of archived months are kept in the database (but are recomputed from the database only, so a reading written late into an archived month leaves the rollups of its hour and day covering the rows still in the database).
+
+The archive is read together with the database by passing it to a Reader:
+
+    reader = Reader('vault.db', storage='narrow', archive=Archive('archive'))
+    df = reader.query('temperature', '2019-01-01T00:00:00+08:00', '2021-07-07T00:00:00+08:00')
+
+Usage: python vault_archive.py --db vault.db --archive-dir archive --older-than-days 365 [--series temperature readings/rainfall] [--vacuum]
+
+"""
+
+# Get the start of the month (Singapore time) epoch falls in, as seconds since the Unix epoch
+def month_start_of(epoch):
+    return int(datetime.fromtimestamp(epoch, sg_timezone).replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+# Get the start of the month after the month starting at month_start
+def next_month(month_start):
+    t = datetime.fromtimestamp(month_start, sg_timezone)
+    return int(t.replace(year=t.year + t.month // 12, month=t.month % 12 + 1).timestamp())
+
+# Get the 'YYYY-MM' name of the month starting at month_start
+def month_name(month_start):
+    return datetime.fromtimestamp(month_start, sg_timezone).strftime('%Y-%m')
+
+
+class Archive:
+    # Open (or create, on the first write) the archive at archive_dir
+    def __init__(self, archive_dir='archive'):
+        self.archive_dir = archive_dir
+        self.path_to_manifest = os.path.join(archive_dir, 'manifest.json')
+        if os.path.exists(self.path_to_manifest):
+            with open(self.path_to_manifest) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'version': 1, 'series': dict()}
+
+    ## Get the partitions of series with readings from start to end (epochs, both included, None for an open-ended range), oldest first
+    def partitions(self, series, start=None, end=None):
+        months = self.manifest['series'].get(series, dict())
+        return [months[month] for month in sorted(months)
+                if (start is None or months[month]['last_epoch'] >= start) and (end is None or months[month]['first_epoch'] <= end)]
+
+    ## Read the readings of a partition from start to end (epochs, both included), for stations (default: all), as (epochs, station_ids, block)
+    ## Without stations, epochs and block are views of the memory-mapped files (nothing is read from disk until used)
+    def read(self, partition, start=None, end=None, stations=None):
+        return self._read(partition, np.load(os.path.join(self.archive_dir, partition['values_file']), mmap_mode='r'), start, end, stations)
+
+    ## Read the data-quality flags (see vault_quality) of the readings of a partition, as read returns its readings: (epochs, station_ids, flags)
+    def read_flags(self, partition, start=None, end=None, stations=None):
+        if partition.get('flags_file') is None:
+            flags = np.zeros((partition['num_rows'], len(partition['station_ids'])), dtype=np.uint8)          # Archived before flags were kept
+        else:
+            flags = np.load(os.path.join(self.archive_dir, partition['flags_file']), mmap_mode='r')
+        return self._read(partition, flags, start, end, stations)
+
+    # Slice the rows from start to end and the columns of stations out of an array of a partition (rows: its epochs, columns: its station_ids)
+    def _read(self, partition, values, start, end, stations):
+        epochs = np.load(os.path.join(self.archive_dir, partition['epochs_file']), mmap_mode='r')
+        lo = 0 if start is None else int(np.searchsorted(epochs, start, side='left'))
+        hi = len(epochs) if end is None else int(np.searchsorted(epochs, end, side='right'))
+        station_ids = partition['station_ids']
+        if stations is None:
+            return epochs[lo:hi], station_ids, values[lo:hi]
+        wanted = {station_id.strip() for station_id in stations}
+        columns = [column_i for column_i, station_id in enumerate(station_ids) if station_id in wanted]
+        return epochs[lo:hi], [station_ids[column_i] for column_i in columns], values[lo:hi, columns]
+
+    ## Write the readings (epochs, station_ids, block) of series in the month starting at month_start, and their flags (uint8, as block; default: none), merged with the partition already archived for that month (if any)
+    def write_partition(self, series, month_start, epochs, station_ids, block, flags=None):
+        month = month_name(month_start)
+        partition = self.manifest['series'].get(series, dict()).get(month)
+        flags = np.zeros(np.shape(block), dtype=np.uint8) if flags is None else flags
+        if partition is not None:
+            # Readings of the new block replace the archived ones, and their flags with them
+            archived_epochs, archived_station_ids, archived_block = self.read(partition)
+            _, _, archived_flags = self.read_flags(partition)
+            merged_flags = merge_blocks([(archived_epochs, archived_station_ids, _flags_of_readings(archived_block, archived_flags)), (epochs, station_ids, _flags_of_readings(block, flags))])[2]
+            epochs, station_ids, block = merge_blocks([(archived_epochs, archived_station_ids, archived_block), (epochs, station_ids, block)])
+            flags = np.nan_to_num(merged_flags).astype(np.uint8)
+
+        partition = {
+            'series': series,
+            'month': month,
+            'month_start': month_start,
+            'month_end': next_month(month_start),
+            'first_epoch': int(epochs[0]),
+            'last_epoch': int(epochs[-1]),
+            'num_rows': len(epochs),
+            'num_flagged': int(np.count_nonzero(flags)),
+            'station_ids': list(station_ids),
+            'epochs_file': os.path.join(series, f'{month}.epochs.npy'),
+            'values_file': os.path.join(series, f'{month}.values.npy'),
+            'flags_file': os.path.join(series, f'{month}.flags.npy'),
+            }
+        os.makedirs(os.path.join(self.archive_dir, series), exist_ok=True)
+        self._save_array(partition['epochs_file'], np.asarray(epochs, dtype=np.int64))
+        self._save_array(partition['values_file'], np.asarray(block, dtype=np.float32))
+        self._save_array(partition['flags_file'], np.asarray(flags, dtype=np.uint8))
+        self.manifest['series'].setdefault(series, dict())[month] = partition
+        self._save_manifest()
+        return partition
+
+    # Write an array to the archive through a temporary file, so that a partition being read (memory-mapped) is never overwritten in place
+    def _save_array(self, file, array):
+        path = os.path.join(self.archive_dir, file)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+
+    def _save_manifest(self):
+        with open(self.path_to_manifest + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.path_to_manifest + '.tmp', self.path_to_manifest)
+
+
+# Flags as floats, NaN where there is no reading (so merge_blocks keeps the flags of the readings it keeps)
+def _flags_of_readings(block, flags):
+    return np.where(np.isnan(np.asarray(block, dtype=float)), np.nan, np.asarray(flags, dtype=float))
+
+# Get the data-quality flags (see vault_quality) of the readings (epochs, station_ids) of series in [month_start, month_end) from the database, as a uint8 block (0: unflagged)
+def read_flags(con, series, month_start, month_end, epochs, station_ids):
+    if series.startswith(narrow_prefix):
+        if 'flags' not in [col[1] for col in con.execute("PRAGMA table_info(readings) ;").fetchall()]:
+            rows = list()                               # Readings table written before flags existed
+        else:
+            rows = con.execute("SELECT station_id, ts_epoch, flags FROM readings WHERE data_type = ? AND ts_epoch >= ? AND ts_epoch < ? AND flags != 0 ;",
+                               (series[len(narrow_prefix):], month_start, month_end)).fetchall()
+    else:
+        con.execute(create_reading_flags_table)
+        rows = con.execute("SELECT station_id, ts_epoch, flags FROM reading_flags WHERE series = ? AND ts_epoch >= ? AND ts_epoch < ? ;", (series, month_start, month_end)).fetchall()
+
+    flags = np.zeros((len(epochs), len(station_ids)), dtype=np.uint8)
+    epochs = np.asarray(epochs, dtype=np.int64)
+    station_index = {station_id: column_i for column_i, station_id in enumerate(station_ids)}
+    for station_id, ts_epoch, flag in rows:
+        row_i = int(np.searchsorted(epochs, ts_epoch))
+        if station_id in station_index and row_i < len(epochs) and epochs[row_i] == ts_epoch:
+            flags[row_i, station_index[station_id]] = flag
+    return flags
+
+
+## Move the readings of series (default: every series in the database) of every whole month older than older_than_days from the database at path_to_db into the archive at archive_dir
+## Returns the number of rows (timestamps) archived per series
+def archive(path_to_db='vault.db', archive_dir='archive', older_than_days=365, series=None, vacuum=False, now=None):
+    cutoff = month_start_of((time.time() if now is None else now) - older_than_days * 86400)
+    store = Archive(archive_dir)
+    con = connect(path_to_db)
+    readers = {'narrow': Reader(path_to_db, storage='narrow'), 'wide': Reader(path_to_db, storage='wide')}
+    num_rows = dict()
+
+    try:
+        ranges = series_ranges(con.cursor())
+        for name in (series if series is not None else sorted(ranges)):
+            num_rows[name] = 0
+            if name not in ranges:
+                print(f"No readings of {name} in database - nothing to archive.")
+                continue
+            storage, data_type = ('narrow', name[len(narrow_prefix):]) if name.startswith(narrow_prefix) else ('wide', name)
+
+            first, last = ranges[name]
+            month_start = month_start_of(first)
+            while month_start < cutoff and month_start <= last:
+                month_end = next_month(month_start)
+                epochs, station_ids, block = readers[storage].query(data_type, month_start, month_end - 1, as_frame=False)
+                if len(epochs) != 0:
+                    store.write_partition(name, month_start, epochs, station_ids, block, flags=read_flags(con, name, month_start, month_end, epochs, station_ids))
+                    with con:
+                        if storage == 'narrow':
+                            con.execute("DELETE FROM readings WHERE data_type = ? AND ts_epoch >= ? AND ts_epoch < ? ;", (data_type, month_start, month_end))
+                        else:
+                            con.execute(f"DELETE FROM {data_type} WHERE date_time >= ? AND date_time < ? ;", (to_bound_date_time(month_start), to_bound_date_time(month_end)))
+                            con.execute("DELETE FROM reading_flags WHERE series = ? AND ts_epoch >= ? AND ts_epoch < ? ;", (name, month_start, month_end))          # Archived with the readings
+                    num_rows[name] += len(epochs)
+                    print(f"Archived {len(epochs)} rows of {name} from {month_name(month_start)}.")
+                month_start = month_end
+
+        # Deleted rows only leave free pages in the database file. VACUUM rebuilds the file without them (slow on large databases).
+        if vacuum:
+            con.execute("VACUUM ;")
+    finally:
+        for reader in readers.values():
+            reader.close()
+        con.close()
+    return num_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move readings older than a given age from the database into a memory-mappable columnar archive.")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--archive-dir', default='archive', help="directory of the archive")
+    parser.add_argument('--older-than-days', type=int, default=365, help="archive whole months older than this many days")
+    parser.add_argument('--series', nargs='+', default=None, help="series to archive, e.g. temperature (wide table) or readings/temperature (narrow) (default: all)")
+    parser.add_argument('--vacuum', action='store_true', help="shrink the database file once the rows are deleted")
+    args = parser.parse_args()
+
+    archive(args.db, args.archive_dir, older_than_days=args.older_than_days, series=args.series, vacuum=args.vacuum)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+import argparse
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from weather_vault import Collector
+from vault_engine import all_look_fors
+from vault_parse import parse_items
+from vault_quality import open_gaps, mark_backfilled
+from vault_rollup import sg_timezone
+from vault_store import connect, index_wide_table
+from vault_transport import ResilientTransport, decode_response
+from vault_lazy import lazy_import
+
+requests = lazy_import('requests')
+pd = lazy_import('pandas')
+
+"""
+
+Backfill readings that were missed (e.g. during downtime) from the date-parameterised NEA API, f"{base_url}/{data_type}?date=YYYY-MM-DD", which returns every reading of that day as items of one payload.
+
+For every data type, the days of the requested range are fetched in parallel (at most max_workers requests at a time, over one pooled session), every item of each payload is parsed with vault_parse.parse_items, and each day is written to the database in one go through the same Collector._send_to_db step that build_df uses.
+
+Readings already in the database are not duplicated:
+    'wide' storage: rows whose date_time is already in the table are dropped before writing (looked up through an index on date_time)
+    'narrow' storage: readings are upserted on (data_type, station_id, ts_epoch)
+
+A day that cannot be fetched (e.g. an HTTP error, or the circuit of its endpoint being open, see vault_transport) is printed and skipped: the other days are still backfilled.
+
+Gaps (5-minute slots missing from the readings written, see vault_quality) are backfilled with --gaps instead of a range of days: the days of every open gap are fetched, and the gaps are marked as backfilled (whether or not the API had the readings missing, so a gap is only fetched once). Gaps with a day that could not be fetched are left open, for a later run.
+
+Usage: python vault_backfill.py 2021-07-01 2021-07-07 --look-for temp rain --db vault.db
+       python vault_backfill.py --gaps --db vault.db
+
+"""
+
+# Get the days from start_date to end_date (both included, as 'YYYY-MM-DD')
+def date_range(start_date, end_date):
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+# Get the payload of one day of a data type
+def fetch_day(session, collector, day):
+    response = session.get(f"{collector.base_url}/{collector.data_type}", params={'date': day})
+    if response.status_code != 200:
+        error_msg = f"Connection to API failed for {collector.data_type} on {day} - Returned status code is not 200!"
+        raise requests.exceptions.HTTPError(error_msg)
+    return decode_response(response)
+
+# Get the payload of one day of a data type, or the error that prevented it (printed), so a day that cannot be fetched does not stop the other days
+def try_fetch_day(session, collector, day):
+    try:
+        return fetch_day(session, collector, day)
+    except (requests.exceptions.RequestException, ValueError) as e:          # e.g. an HTTP error, the circuit of the endpoint being open (see vault_transport), or a payload that is not JSON
+        print(f"Failed to fetch {collector.data_type} on {day} ({type(e).__name__}: {e}). Skipped.")
+        return e
+
+# Drop the rows of df whose date_time is already in the wide table db_table_name
+def drop_stored_rows(con, db_table_name, df):
+    if con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (db_table_name,)).fetchone() is None:
+        return df
+    index_wide_table(con, db_table_name)
+    stored = {row[0] for row in con.execute(f"SELECT date_time FROM {db_table_name} WHERE date_time BETWEEN ? AND ?", (min(df.index), max(df.index)))}
+    return df[~df.index.isin(stored)]
+
+## Backfill every day from start_date to end_date of the data types in look_fors. Returns the number of entries written per db_table_name.
+## Days that cannot be fetched are skipped (and appended to failures, if given, see backfill_days)
+def backfill(start_date, end_date, look_fors=all_look_fors, path_to_db='vault.db', storage='wide', max_workers=4, base_url='https://api.data.gov.sg/v1/environment', failures=None):
+    return backfill_days(date_range(start_date, end_date), look_fors, path_to_db=path_to_db, storage=storage, max_workers=max_workers, base_url=base_url, failures=failures)
+
+## Backfill the days (as 'YYYY-MM-DD') of the data types in look_fors. Returns the number of entries written per db_table_name.
+## A day that cannot be fetched is skipped, the other days are still backfilled. With a list as failures, (db_table_name, day, error) of every day skipped is appended to it.
+def backfill_days(days, look_fors=all_look_fors, path_to_db='vault.db', storage='wide', max_workers=4, base_url='https://api.data.gov.sg/v1/environment', failures=None):
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    # A day of readings is a large payload: a longer read timeout and budget, and no hedging (a day is fetched once)
+    session = ResilientTransport(session, read_timeout=60, budget_seconds=300, hedge=False)
+    con = connect(path_to_db)
+    num_entries = dict()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for look_for in look_fors:
+                collector = Collector(look_for=look_for, build_format='V1', ping_interval=0, session=session, base_url=base_url)
+                db_table_name = collector.data_name
+                num_entries[db_table_name] = 0
+                num_failed = 0
+
+                # Days are fetched in parallel, and written (in order) by this thread only
+                for day, raw_reading in zip(days, pool.map(lambda day: try_fetch_day(session, collector, day), days)):
+                    if isinstance(raw_reading, Exception):
+                        num_failed += 1
+                        if failures is not None:
+                            failures.append((db_table_name, day, raw_reading))
+                        continue
+                    if len(raw_reading['items']) == 0:
+                        print(f"No readings of {db_table_name} on {day}.")
+                        continue
+                    reading_times, station_ids, block = parse_items(raw_reading)
+                    df = pd.DataFrame(block, index=reading_times, columns=station_ids)
+                    df = df[~df.index.duplicated(keep='last')]
+                    if storage == 'wide':
+                        df = drop_stored_rows(con, db_table_name, df)
+                    if df.shape[0] == 0:
+                        print(f"All readings of {db_table_name} on {day} are already stored.")
+                        continue
+
+                    collector._send_to_db(df, db_table_name, path_to_db, storage, con=con, stations=raw_reading['metadata']['stations'])
+                    num_entries[db_table_name] += df.shape[0]
+                print(f"Backfilled {num_entries[db_table_name]} entries of {db_table_name} from {days[0]} to {days[-1]} ({len(days)} days{f', {num_failed} of which could not be fetched' if num_failed else ''}).")
+    finally:
+        con.close()
+        session.close()
+    return num_entries
+
+## Backfill the days of the open gaps (see vault_quality) of the data types in look_fors (data_names, e.g. 'temperature'; default: all), then mark those gaps as backfilled. Returns the number of entries written per db_table_name.
+def backfill_gaps(look_fors=None, path_to_db='vault.db', storage='wide', max_workers=4, base_url='https://api.data.gov.sg/v1/environment'):
+    con = connect(path_to_db)
+    try:
+        gaps = open_gaps(con.cursor(), look_fors)
+    finally:
+        con.close()
+
+    num_entries = dict()
+    for data_type in sorted({gap[0] for gap in gaps}):
+        of_type = [gap for gap in gaps if gap[0] == data_type]
+        gap_days = dict()                                   # Type: dict. start_epoch of every gap -> its days
+        for _, start_epoch, end_epoch, _ in of_type:
+            first, last = (datetime.fromtimestamp(epoch, sg_timezone).date() for epoch in (start_epoch, end_epoch))
+            gap_days[start_epoch] = date_range(first.isoformat(), last.isoformat())
+        failures = list()
+        num_entries.update(backfill_days(sorted(set().union(*gap_days.values())), [data_type], path_to_db=path_to_db, storage=storage, max_workers=max_workers, base_url=base_url, failures=failures))
+
+        # Gaps with a day that could not be fetched are left open, to be backfilled by a later run
+        failed_days = {day for _, day, _ in failures}
+        backfilled = [(data_type, start_epoch) for start_epoch, days in gap_days.items() if failed_days.isdisjoint(days)]
+        if len(backfilled) != len(gap_days):
+            print(f"{len(gap_days) - len(backfilled)} gaps of {data_type} left open (days that could not be fetched).")
+        con = connect(path_to_db)
+        try:
+            with con:
+                mark_backfilled(con.cursor(), backfilled)
+        finally:
+            con.close()
+    if not gaps:
+        print("No open gaps to backfill.")
+    return num_entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Backfill missed NEA readings into the database from the date-parameterised API.")
+    parser.add_argument('start_date', nargs='?', help="first day to backfill (YYYY-MM-DD)")
+    parser.add_argument('end_date', nargs='?', help="last day to backfill (YYYY-MM-DD, included)")
+    parser.add_argument('--gaps', action='store_true', help="backfill the days of the open gaps of the database instead (see vault_quality)")
+    parser.add_argument('--look-for', nargs='+', default=None, help="data types to backfill (default: all 5)")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='wide', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--workers', type=int, default=4, help="maximum number of days fetched at a time")
+    parser.add_argument('--base-url', default='https://api.data.gov.sg/v1/environment', help="base URL of the API")
+    args = parser.parse_args()
+
+    if args.gaps:
+        look_fors = [Collector(look_for=look_for, build_format='V1', ping_interval=0).data_name for look_for in args.look_for] if args.look_for else None
+        backfill_gaps(look_fors, path_to_db=args.db, storage=args.storage, max_workers=args.workers, base_url=args.base_url)
+    elif args.start_date and args.end_date:
+        backfill(args.start_date, args.end_date, look_fors=args.look_for or all_look_fors, path_to_db=args.db, storage=args.storage, max_workers=args.workers, base_url=args.base_url)
+    else:
+        parser.error("give start_date and end_date, or --gaps")
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+
+ReadingBuffer object is used to accumulate the entries of a Collector in memory, without copying the whole DataFrame on every new entry.
+
+Entries are kept in preallocated NumPy arrays (one row per reading_time, one column per station) and a DataFrame is only built when asked for (to_df), e.g. when the entries are passed to the database.
+
+There are 2 modes:
+    ring=False (default): the arrays double in size whenever they are full, so appending stays cheap (amortised) however many entries are collected
+    ring=True: the arrays never grow. Once capacity entries are held, each new entry overwrites the oldest one, so memory stays fixed however long the collection runs
+
+A new station only adds a column when it first appears (which is rare); the columns are kept sorted by value after S prefix, as in Collector._get_row.
+
+"""
+
+class ReadingBuffer:
+    # Initialize an empty buffer with room for capacity entries
+    def __init__(self, capacity=288, ring=False):
+        if capacity < 1:
+            raise ValueError("ReadingBuffer capacity must be at least 1!")
+        self.capacity = capacity
+        self.ring = ring
+        self.station_ids = list()                                   # Type: list. Column headers (sorted by value after S prefix)
+        self._station_index = dict()                                # Type: dict. Column position of each station id
+        self._times = np.empty(capacity, dtype=object)              # reading_time of each row
+        self._values = np.full((capacity, 0), np.nan)               # readings (rows: entries, columns: stations)
+        self._start, self.size = 0, 0                               # Position of the oldest entry, and number of entries held
+        self.last_time = None                                       # reading_time of the latest entry added (kept after clear, so the next entry can still be told apart from the latest one)
+
+    def __len__(self):
+        return self.size
+
+    ## Add one entry (reading_time, with the readings in entry ordered as station_ids)
+    def append(self, reading_time, station_ids, entry):
+        self.append_block([reading_time], station_ids, np.asarray(entry, dtype=float)[np.newaxis, :])
+
+    ## Add several entries at once (reading_times, oldest first, with the readings in the rows of block ordered as station_ids)
+    def append_block(self, reading_times, station_ids, block):
+        # Map the incoming stations onto the columns of the buffer (adding columns for new stations)
+        columns = self._columns_for(station_ids)
+        num_rows = len(reading_times)
+
+        if self.size + num_rows > self.capacity:
+            if self.ring:
+                # Drop the oldest entries to make room (if the block alone overfills the ring, only its latest rows are kept)
+                if num_rows > self.capacity:
+                    reading_times, block = reading_times[-self.capacity:], block[-self.capacity:]
+                    num_rows = self.capacity
+                num_dropped = min(self.size, self.size + num_rows - self.capacity)
+                self._start = (self._start + num_dropped) % self.capacity
+                self.size -= num_dropped
+            else:
+                capacity = self.capacity
+                while capacity < self.size + num_rows:
+                    capacity *= 2
+                self._resize(capacity, self._values.shape[1])
+
+        rows = (self._start + self.size + np.arange(num_rows)) % self.capacity
+        self._times[rows] = reading_times
+        self._values[rows, :] = np.nan
+        self._values[np.ix_(rows, columns)] = block
+        self.size += num_rows
+        self.last_time = reading_times[-1]
+
+    ## Build a DataFrame of the held entries, oldest first (index: reading_time, columns: station ids)
+    def to_df(self):
+        order = (self._start + np.arange(self.size)) % self.capacity
+        return pd.DataFrame(self._values[order], index=list(self._times[order]), columns=list(self.station_ids))
+
+    ## Remove all entries (the station columns, the allocated arrays and last_time are kept for the next entries)
+    def clear(self):
+        self._start, self.size = 0, 0
+
+    # Get the column positions of station_ids, adding (and re-sorting) columns for stations not held yet
+    def _columns_for(self, station_ids):
+        new_station_ids = [station_id for station_id in station_ids if station_id not in self._station_index]
+        if new_station_ids:
+            old_index = self._station_index
+            self.station_ids = sorted(self.station_ids + new_station_ids, key=lambda x: int(x[1:]))
+            self._station_index = {station_id: column_i for column_i, station_id in enumerate(self.station_ids)}
+
+            # Move the held readings to their new columns
+            old_values = self._values
+            self._values = np.full((self.capacity, len(self.station_ids)), np.nan)
+            self._values[:, [self._station_index[station_id] for station_id in old_index]] = old_values[:, list(old_index.values())]
+        return [self._station_index[station_id] for station_id in station_ids]
+
+    # Reallocate the arrays with room for capacity entries, moving the held entries to the front
+    def _resize(self, capacity, num_columns):
+        order = (self._start + np.arange(self.size)) % self.capacity
+        times = np.empty(capacity, dtype=object)
+        values = np.full((capacity, num_columns), np.nan)
+        times[:self.size] = self._times[order]
+        values[:self.size] = self._values[order]
+        self._times, self._values, self._start, self.capacity = times, values, 0, capacity
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import signal
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from vault_engine import Engine, all_look_fors
+from vault_reader import sg_timezone
+from vault_metrics import metrics
+
+"""
+
+Headless collection daemon: runs the data types (default: all 5) under one vault_engine.Engine, without any GUI, until it is stopped.
+
+    python vault_daemon.py --db vault.db --storage narrow
+
+Every entry is written to the database as soon as it arrives (or every --flush-every entries), so memory stays at a few entries per data type however long the daemon runs.
+
+On SIGTERM or SIGINT (e.g. docker stop, systemctl stop, Ctrl+C) every data type stops polling, writes the entries it still holds, and the daemon exits.
+
+With --serve-port, the latest readings of every data type (and a rolling window of the last hour) are served from memory at http://127.0.0.1:{port}/latest (see vault_serve).
+
+With --metrics-port, the metrics of the pipeline (see vault_metrics) are served at http://127.0.0.1:{port}/metrics. With --metrics-log, every poll and write is also logged as a JSON line.
+
+On start (and whenever a data type is restarted after a failure), collection resumes from the last reading stored in the database, so a restart never stores an entry twice. With --backfill, readings missed while the daemon was down are first fetched from the date-parameterised API (see vault_backfill).
+
+"""
+
+## Backfill the days from the last stored reading of each data type to today (readings already stored are skipped by vault_backfill)
+def backfill_gap(engine, path_to_db, storage):
+    from vault_backfill import backfill
+
+    today = datetime.now(sg_timezone).date()
+    for collector in engine.collectors:
+        last_stored = engine.last_stored(collector, path_to_db, storage)
+        if last_stored is None:
+            continue
+        last_day = datetime.fromisoformat(last_stored).date()
+        if datetime.now(sg_timezone) - datetime.fromisoformat(last_stored) > timedelta(minutes=10):
+            backfill(last_day.isoformat(), today.isoformat(), look_fors=[collector.data_name], path_to_db=path_to_db, storage=storage, base_url=collector.base_url)
+
+## Run the daemon until SIGTERM/SIGINT (or until limit entries of every data type are collected)
+async def run_daemon(engine, path_to_db='vault.db', storage='wide', flush_every=1, limit=None):
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(engine.run(limit, path_to_db=path_to_db, send_to_db=True, storage=storage, flush_every=flush_every, resume=True))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, engine.stop)
+    try:
+        await task
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+    print("Collection stopped. All collected entries are stored.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect NEA readings into the database until stopped (SIGTERM/SIGINT).")
+    parser.add_argument('--look-for', nargs='+', default=all_look_fors, help="data types to collect (default: all 5)")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='wide', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--flush-every', type=int, default=1, help="entries of a data type held in memory before they are written (default: 1)")
+    parser.add_argument('--limit', type=int, default=None, help="stop after this many entries per data type (default: run until stopped)")
+    parser.add_argument('--ping-interval', type=int, default=60, help="seconds between polls when the timestamp has not changed (with --no-schedule)")
+    parser.add_argument('--no-schedule', action='store_true', help="poll every ping_interval seconds instead of on the cadence of the API")
+    parser.add_argument('--backfill', action='store_true', help="backfill readings missed since the last stored reading before collecting")
+    parser.add_argument('--base-url', default='https://api.data.gov.sg/v1/environment', help="base URL of the API")
+    parser.add_argument('--metrics-port', type=int, default=None, help="serve Prometheus-style metrics on this local port")
+    parser.add_argument('--serve-port', type=int, default=None, help="serve the latest readings (see vault_serve) on this local port")
+    parser.add_argument('--metrics-log', default=None, help="append a structured (JSON lines) log of every poll and write to this file")
+    args = parser.parse_args()
+
+    if args.metrics_port is not None:
+        metrics.serve(port=args.metrics_port)
+    if args.metrics_log is not None:
+        metrics.start_log(args.metrics_log)
+
+    cache = None
+    if args.serve_port is not None:
+        from vault_serve import LatestCache, serve
+        cache = LatestCache(path_to_db=args.db, storage=args.storage)
+        serve(cache, port=args.serve_port)
+
+    engine = Engine(look_fors=args.look_for, ping_interval=args.ping_interval, schedule=not args.no_schedule, cache=cache)
+    for collector in engine.collectors:
+        collector.base_url = args.base_url
+    if args.backfill:
+        backfill_gap(engine, args.db, args.storage)
+    asyncio.run(run_daemon(engine, path_to_db=args.db, storage=args.storage, flush_every=args.flush_every, limit=args.limit))
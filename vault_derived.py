@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import argparse
+from vault_metrics import metrics
+from vault_parse import station_sort_key
+from vault_rollup import day, read_block, series_ranges, narrow_prefix
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+Derived series are computed from the readings of several data types, matched by timestamp and station, as those readings are written:
+
+    wind_u, wind_v      from wind_direction and wind_speed: eastward and northward components of the wind (in the unit of wind_speed, knots)
+                            u = -speed * sin(direction), v = -speed * cos(direction)        (direction: where the wind blows from, in degrees)
+    heat_index          from temperature and relative_humidity: apparent temperature (deg C), by the NOAA (Rothfusz) regression and its adjustments
+
+Every write of readings (NarrowStore.write_block, Collector._send_to_wide_db) calls derive with the timestamps written, in the same transaction as the readings (for both storages: wide rows are not committed on their own, see weather_vault.insert_wide_rows). The readings of every input of the derivations the data type is an input of are read back for those timestamps, and the derived values are computed (with NumPy, for all the timestamps and stations at once) wherever every input has a reading. Whichever input is written last therefore completes the derived readings of a timestamp, however far apart (or in whatever order) the data types are collected, and a late or repeated reading recomputes them.
+
+Derived series are stored in the narrow readings table (data_type: 'wind_u', 'wind_v', 'heat_index'), whatever the storage of their inputs, with watermarks and hourly/daily rollups as for any other data type:
+
+    reader = Reader('vault.db', storage='narrow')
+    df = reader.query('wind_u', '2021-07-07T00:00:00+08:00', '2021-07-07T23:59:59+08:00')
+
+Derived readings of inputs written before this module existed are computed with:
+
+Usage: python vault_derived.py --db vault.db --storage narrow [--window-days 30]
+
+"""
+
+## Get the u (eastward) and v (northward) components of wind blowing from direction (degrees) at speed
+def wind_components(direction, speed):
+    radians = np.radians(direction)
+    return {'wind_u': np.round(-speed * np.sin(radians), 3) + 0.0, 'wind_v': np.round(-speed * np.cos(radians), 3) + 0.0}          # + 0.0 turns -0.0 into 0.0
+
+## Get the heat index (deg C) of temperature (deg C) at relative_humidity (%), by the NOAA regression (Rothfusz, with the adjustments for low and high humidity)
+def heat_index(temperature, relative_humidity):
+    t, rh = temperature * 9 / 5 + 32, relative_humidity                                 # The regression is in deg F
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + rh * 0.094)
+    full = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 0.00683783 * t * t - 0.05481717 * rh * rh
+            + 0.00122874 * t * t * rh + 0.00085282 * t * rh * rh - 0.00000199 * t * t * rh * rh)
+    with np.errstate(invalid='ignore'):
+        full = np.where((rh < 13) & (t >= 80) & (t <= 112), full - (13 - rh) / 4 * np.sqrt(np.maximum(17 - np.abs(t - 95), 0) / 17), full)
+        full = np.where((rh > 85) & (t >= 80) & (t <= 87), full + (rh - 85) / 10 * (87 - t) / 5, full)
+        index = np.where((simple + t) / 2 >= 80, full, simple)                           # The regression only holds from 80 deg F
+    return {'heat_index': np.round((index - 32) * 5 / 9, 2)}
+
+# Derivations: (input data types, function of their aligned blocks returning {derived data type: block})
+derivations = [
+    (('wind_direction', 'wind_speed'), wind_components),
+    (('temperature', 'relative_humidity'), heat_index),
+    ]
+
+# Data types of the derived series (always stored in the narrow readings table)
+derived_types = ['wind_u', 'wind_v', 'heat_index']
+
+## Compute the derived series the data type (the data_name of a Collector, i.e. a narrow data type or a wide table) is an input of, at epochs (the timestamps just written)
+## Returns a list of (derived data type, epochs, station_ids, block) to be written (see NarrowStore.write_derived), empty if data_type is not an input or a partner input has no reading at epochs
+def derive(cur, data_type, epochs, storage='narrow'):
+    epochs = np.unique(np.asarray(epochs, dtype=np.int64))
+    if len(epochs) == 0 or not is_input(data_type):
+        return list()
+    derived = list()
+    with metrics.timer('vault_stage_seconds', stage='derive', data_type=data_type):
+        for inputs, function in derivations:
+            if data_type in inputs:
+                derived += derive_range(cur, inputs, function, int(epochs[0]), int(epochs[-1]) + 1, storage, epochs)
+    return derived
+
+## Whether data_type is an input of any derivation
+def is_input(data_type):
+    return any(data_type in inputs for inputs, _ in derivations)
+
+## Compute the derived series of a derivation (inputs, function) for the timestamps in [start, end) (only at epochs, if given)
+def derive_range(cur, inputs, function, start, end, storage='narrow', epochs=None):
+    blocks = [read_block(cur, data_type, start, end, storage) for data_type in inputs]
+
+    # Timestamps and stations with readings of every input
+    common_epochs = blocks[0][0]
+    for block_epochs, _, _ in blocks[1:]:
+        common_epochs = np.intersect1d(common_epochs, block_epochs)
+    if epochs is not None:
+        common_epochs = np.intersect1d(common_epochs, epochs)
+    common_stations = sorted(set(blocks[0][1]).intersection(*[block_station_ids for _, block_station_ids, _ in blocks[1:]]), key=station_sort_key)
+    if len(common_epochs) == 0 or len(common_stations) == 0:
+        return list()
+
+    aligned = list()
+    for block_epochs, block_station_ids, block in blocks:
+        station_index = {station_id: column_i for column_i, station_id in enumerate(block_station_ids)}
+        aligned.append(block[np.ix_(np.searchsorted(block_epochs, common_epochs), [station_index[station_id] for station_id in common_stations])])
+    # Timestamps without any derived reading (e.g. NULL cells of a wide table) are left out, so they do not move the watermark of the derived series
+    derived = list()
+    for derived_type, values in function(*aligned).items():
+        rows = ~np.all(np.isnan(values), axis=1)
+        if rows.any():
+            derived.append((derived_type, common_epochs[rows], common_stations, values[rows]))
+    return derived
+
+## Compute the derived series of every input already in the database at path_to_db (storage: of the inputs), a window of window_days days per transaction. Returns the number of derived readings written per derived data type.
+def rebuild(path_to_db='vault.db', storage='narrow', window_days=30):
+    from vault_store import NarrowStore
+
+    store = NarrowStore(path_to_db)
+    num_readings = dict()
+    try:
+        ranges = series_ranges(store.cur)
+        for inputs, function in derivations:
+            input_ranges = [ranges.get(f'{narrow_prefix}{data_type}' if storage == 'narrow' else data_type) for data_type in inputs]
+            if any(input_range is None for input_range in input_ranges):
+                continue
+            start, end = max(first for first, _ in input_ranges), min(last for _, last in input_ranges) + 1
+            for window_start in range(start, end, window_days * day):
+                with store.con:
+                    for derived_type, epochs, station_ids, block in store.write_derived(derive_range(store.cur, inputs, function, window_start, min(window_start + window_days * day, end), storage)):
+                        num_readings[derived_type] = num_readings.get(derived_type, 0) + int((~np.isnan(block)).sum())
+    finally:
+        store.close()
+    for derived_type, count in num_readings.items():
+        print(f"Derived {count} readings of {derived_type}.")
+    return num_readings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the derived series (wind components, heat index) of the readings already in the database.")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage of the input readings (derived series are always stored in the readings table)")
+    parser.add_argument('--window-days', type=int, default=30, help="days of readings derived per transaction (default: 30)")
+    args = parser.parse_args()
+
+    rebuild(args.db, storage=args.storage, window_days=args.window_days)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+import asyncio
+import argparse
+from weather_vault import Collector
+from vault_buffer import ReadingBuffer
+from vault_metrics import metrics
+from vault_schedule import PollScheduler
+from vault_store import connect, read_watermark
+from vault_transport import ResilientTransport
+from vault_writer import DbWriter, WriteFailed
+from vault_lazy import lazy_import
+
+requests = lazy_import('requests')
+
+"""
+
+Engine object is used to collect several data types at once. Instead of one thread (and one Collector making a new connection on every poll) per data type, all endpoints are polled concurrently from one asyncio event loop over a single requests.Session, whose pool keeps one keep-alive connection per endpoint.
+
+Each data type is still handled by its own Collector, so the readings go through the same _get_block, ReadingBuffer and _send_to_db steps that Collector.build_df uses.
+
+Every poll is bounded by the latency budget of the transport (see vault_transport.ResilientTransport), which retries transient failures itself. If an endpoint still fails (or its circuit is open), only that endpoint backs off (doubling its wait from ping_interval up to max_backoff); the other endpoints keep being polled.
+
+Engine.run can also collect without a limit (limit=None, e.g. as the headless daemon in vault_daemon), writing every flush_every entries to the database as they arrive (memory then stays at flush_every entries per data type), until Engine.stop is called. Each data type is supervised: if its collection fails unexpectedly, it is restarted (after a backoff) from the last reading stored in the database, without stopping the other data types.
+
+
+"""
+
+# look_for keywords of all 5 data types provided by the NEA API
+all_look_fors = ['temp', 'rain', 'humid', 'direction', 'speed']
+
+
+class Engine:
+    # Initialize an Engine with one Collector per requested data type, all sharing one pooled session
+    # If schedule is True, each endpoint is polled on the 5-minute cadence of the API by its own PollScheduler, instead of every ping_interval seconds
+    # A transport (see vault_transport) can be given as session instead of the pooled requests.Session (wrapped in a ResilientTransport)
+    # With a cache (vault_serve.LatestCache), every Collector updates it with its new entries
+    def __init__(self, look_fors=all_look_fors, build_format='V1', ping_interval=60, max_backoff=600, schedule=True, session=None, cache=None):
+        self.ping_interval = ping_interval
+        self.max_backoff = max_backoff
+
+        # One pooled, keep-alive connection per endpoint (all endpoints are on the same host), and one more per endpoint for hedged requests, with timeouts, retries and a circuit breaker per endpoint (see vault_transport.ResilientTransport)
+        self._own_session = session is None             # Only a session created by the Engine is closed by it (at the end of every run)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2 * len(look_fors)))
+            session = ResilientTransport(session)
+        self.session = session
+
+        self.collectors = [Collector(look_for=look_for, build_format=build_format, ping_interval=ping_interval, session=self.session, scheduler=PollScheduler() if schedule else None, cache=cache) for look_for in look_fors]
+        self._stopping = None                       # Type: asyncio.Event. Set by stop(), created by run() (in its event loop)
+
+    ## Ask a running Engine to stop: every data type stops polling, writes the entries it holds to the database, and run returns
+    # Safe to call from a signal handler of the event loop. Use loop.call_soon_threadsafe(engine.stop) from other threads.
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    # Sleep for delay seconds, or until stop() is called. Returns True if the Engine is stopping.
+    async def _sleep(self, delay):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        return self._stopping.is_set()
+
+    ## Collect limit entries (or, with limit=None, until stop() is called) of one data type, then pass them to the database (or return them as a DataFrame)
+    # With flush_every, entries are passed to the database every flush_every entries as they arrive (nothing is returned). Entries older than resume_from (a reading_time, e.g. the last one stored) are skipped.
+    async def _collect(self, collector, limit, path_to_db, send_to_db, storage, progress, flush_every=None, resume_from=None, writer=None):
+        db_table_name = collector.data_name
+        streaming = send_to_db == True and flush_every is not None
+        if streaming:
+            capacity = flush_every
+        else:
+            capacity = 288 if limit is None else max(1, min(limit, 288))
+        buffer = ReadingBuffer(capacity=capacity)
+        buffer.last_time = resume_from
+        num_entries = 0                             # Entries collected (including those already flushed)
+        backoff = self.ping_interval
+        try:
+            while (limit is None or num_entries < limit) and not self._stopping.is_set():
+                # The blocking request runs in a worker thread, so the other endpoints are polled meanwhile
+                try:
+                    await asyncio.to_thread(collector._connect_to_api)
+                except requests.exceptions.RequestException as e:
+                    print(f"({db_table_name}) Connection to API failed ({e}). Retrying in {backoff} seconds...")
+                    metrics.inc('vault_retries_total', data_type=db_table_name)
+                    await self._sleep(backoff)
+                    backoff = min(max(2 * backoff, 1), self.max_backoff)
+                    continue
+                backoff = self.ping_interval
+
+                # Only add entries if the API is returning an updated timestamp
+                max_entries = None if limit is None else limit - num_entries
+                new_entries = collector._buffer_new_entries(buffer, max_entries) if collector.reading_time not in (None, buffer.last_time) else 0         # None: no reading returned by the API yet
+                if new_entries != 0:
+                    num_entries += new_entries
+                    print(f"Built {num_entries}/{'-' if limit is None else limit} of DataFrame for (dbTable: {db_table_name}).")
+                    if progress is not None:
+                        progress(db_table_name, num_entries, limit)
+                    if streaming and len(buffer) >= flush_every:
+                        await asyncio.to_thread(collector._send_to_db, buffer.to_df(), db_table_name, path_to_db, storage, writer=writer)
+                        buffer.clear()
+                    if collector.scheduler is not None and (limit is None or num_entries < limit):
+                        # Sleep until shortly after the next reading is expected
+                        await self._sleep(collector.scheduler.next_delay(buffer.last_time, new_reading=True))
+                else:
+                    metrics.inc('vault_duplicate_polls_total', data_type=db_table_name)
+                    await self._sleep(self.ping_interval if collector.scheduler is None else collector.scheduler.next_delay(buffer.last_time, new_reading=False))
+        except asyncio.CancelledError:
+            pass                                    # Entries collected before the cancellation (e.g. KeyboardInterrupt) are still passed on below
+
+        if len(buffer) == 0:
+            return None
+        df = buffer.to_df()
+        if send_to_db == True:
+            await asyncio.to_thread(collector._send_to_db, df, db_table_name, path_to_db, storage, writer=writer)
+        return None if streaming else df
+
+    # Run _collect for one data type, restarting it (from the last reading stored) whenever it fails unexpectedly, until it completes or the Engine is stopping
+    async def _supervise(self, collector, limit, path_to_db, send_to_db, storage, progress, flush_every, resume, writer):
+        backoff = self.ping_interval
+        while True:
+            if resume and send_to_db == True:
+                if writer is not None:
+                    try:
+                        await asyncio.to_thread(writer.flush)       # Entries still queued to the writer are not in the database yet
+                    except WriteFailed as e:                        # Still held by the writer (and written again with its next batch): collection resumes from the last reading stored before them
+                        print(f"({collector.data_name}) {e}")
+                resume_from = self.last_stored(collector, path_to_db, storage)
+            else:
+                resume_from = None
+            try:
+                return await self._collect(collector, limit, path_to_db, send_to_db, storage, progress, flush_every=flush_every, resume_from=resume_from, writer=writer)
+            except Exception as e:
+                print(f"({collector.data_name}) Collection failed ({type(e).__name__}: {e}). Restarting in {backoff} seconds...")
+                metrics.inc('vault_restarts_total', data_type=collector.data_name)
+                if await self._sleep(backoff):
+                    return None
+                backoff = min(max(2 * backoff, 1), self.max_backoff)
+
+    ## Get the last reading_time of a data type stored in the database (None if nothing has been stored yet)
+    def last_stored(self, collector, path_to_db='vault.db', storage='wide'):
+        con = connect(path_to_db)
+        try:
+            return read_watermark(con.cursor(), f'readings/{collector.data_name}' if storage == 'narrow' else collector.data_name)
+        finally:
+            con.close()
+
+    ## Collect limit entries (or, with limit=None, until stop() is called) of every data type concurrently. Returns {db_table_name: DataFrame}.
+    # progress (optional) is called as progress(db_table_name, num_entries, limit) after every new entry
+    # flush_every (with send_to_db) passes the entries of each data type to the database every flush_every entries, as they arrive (the DataFrames returned are then None)
+    # resume (with send_to_db) skips entries up to the last reading already stored, e.g. when restarting after a shutdown
+    # writer (with send_to_db) is a vault_writer.DbWriter to pass the entries to (e.g. one shared with other Engines). By default, the Engine starts its own, so that all of its data types are written by one thread over one connection.
+    async def run(self, limit, path_to_db='vault.db', send_to_db=False, storage='wide', progress=None, flush_every=None, resume=False, writer=None):
+        self._stopping = asyncio.Event()
+        own_writer = send_to_db == True and writer is None
+        if own_writer:
+            writer = DbWriter(path_to_db)
+        try:
+            dfs = await asyncio.gather(*[self._supervise(collector, limit, path_to_db, send_to_db, storage, progress, flush_every, resume, writer) for collector in self.collectors])
+        finally:
+            if self._own_session:
+                self.session.close()
+            if own_writer:
+                await asyncio.to_thread(writer.close)
+        return {collector.data_name: df for collector, df in zip(self.collectors, dfs)}
+
+    ## Blocking version of run, for callers without an event loop (e.g. a GUI thread)
+    def run_sync(self, limit, path_to_db='vault.db', send_to_db=False, storage='wide', progress=None, flush_every=None, resume=False, writer=None):
+        return asyncio.run(self.run(limit, path_to_db=path_to_db, send_to_db=send_to_db, storage=storage, progress=progress, flush_every=flush_every, resume=resume, writer=writer))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect several NEA data types concurrently over one pooled connection.")
+    parser.add_argument('limit', type=int, help="number of entries to collect per data type")
+    parser.add_argument('--look-for', nargs='+', default=all_look_fors, help="data types to collect (default: all 5)")
+    parser.add_argument('--ping-interval', type=int, default=60, help="seconds between polls when the timestamp has not changed (with --no-schedule)")
+    parser.add_argument('--no-schedule', action='store_true', help="poll every ping_interval seconds instead of on the cadence of the API")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='wide', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--no-db', action='store_true', help="print the DataFrames instead of passing them to the database")
+    args = parser.parse_args()
+
+    engine = Engine(look_fors=args.look_for, ping_interval=args.ping_interval, schedule=not args.no_schedule)
+    try:
+        dfs = engine.run_sync(args.limit, path_to_db=args.db, send_to_db=not args.no_db, storage=args.storage)
+    except KeyboardInterrupt:
+        dfs = dict()
+    if args.no_db:
+        for db_table_name, df in dfs.items():
+            print(f"\n{db_table_name}:\n{df}")
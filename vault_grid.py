@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+import argparse
+from vault_reader import Reader
+from vault_store import connect, station_hash
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    from scipy.spatial import cKDTree      # Optional: nearest-neighbour search in O(log n) per grid point
+except ImportError:
+    cKDTree = None
+
+"""
+
+Spatial interpolation of station readings onto a regular latitude/longitude grid, by inverse distance weighting (IDW) of the k nearest stations:
+
+    field(point) = sum(w_i * value_i) / sum(w_i),  w_i = 1 / distance(point, station_i) ** power,  over the k stations nearest to point
+
+    grid = Grid(resolution_km=1)                                             # Singapore, 1 km cells
+    epochs, grid, fields = interpolate_history('vault.db', 'rainfall', '2021-07-07T00:00:00+08:00', '2021-07-07T23:59:59+08:00')
+    fields.shape                                                             # (timestamps, grid.num_lats, grid.num_lons)
+
+Station locations come from the stations table (the 'metadata' -> 'stations' of the API, stored by both storage backends). Stations without a location are left out.
+
+Interpolator precomputes, once per station set, the k nearest stations of every grid point and their weights (with scipy's cKDTree when installed, else by a partial sort of the distances with NumPy), and interpolates any number of timestamps at once: the readings of the neighbours of every point are gathered for a whole chunk of timestamps and weighted in a few array operations. A station without a reading at a timestamp (NaN) is left out of the points it is a neighbour of, and the weights of the other neighbours are renormalised. A point whose k neighbours all lack a reading is NaN.
+
+Directions (circular_data_types, e.g. wind_direction in degrees) are not weighted as plain numbers, which would average 350 and 10 degrees to 180: their unit vectors (sin, cos) are interpolated instead, and the direction of the interpolated vector is the field (Interpolator.interpolate_directions). A point where the vectors cancel out (no prevailing direction) is NaN.
+
+Interpolators are cached by station set, location, grid, k and power (interpolator_for), so a day of history (or successive calls while the station set is unchanged) reuses the same neighbours and weights.
+
+Distances are computed on an equirectangular projection (kilometres), which is exact to well under 0.1% over an area the size of Singapore.
+
+Usage: python vault_grid.py rainfall --db vault.db --start 2021-07-07T00:00:00+08:00 --end 2021-07-07T23:59:59+08:00 --out rainfall_2021-07-07.npz
+
+"""
+
+km_per_degree_lat = 110.574
+km_per_degree_lon = 111.320         # At the equator, times cos(latitude)
+singapore_bounds = (1.15, 103.60, 1.48, 104.10)         # (south, west, north, east)
+circular_data_types = {'wind_direction'}                # Data types in degrees, interpolated as unit vectors
+
+# Interpolators by (station set and locations, grid, k, power)
+_interpolators = dict()
+
+
+class Grid:
+    # Regular grid of cells of about resolution_km over bounds (south, west, north, east, in degrees), with a point at the centre of every cell
+    def __init__(self, bounds=singapore_bounds, resolution_km=1.0):
+        self.bounds = tuple(bounds)
+        self.resolution_km = resolution_km
+        south, west, north, east = self.bounds
+        self.origin_lat = (south + north) / 2
+        self.num_lats = max(int(round((north - south) * km_per_degree_lat / resolution_km)), 1)
+        self.num_lons = max(int(round((east - west) * km_per_degree_lon * np.cos(np.radians(self.origin_lat)) / resolution_km)), 1)
+        self.lats = south + (np.arange(self.num_lats) + 0.5) * (north - south) / self.num_lats
+        self.lons = west + (np.arange(self.num_lons) + 0.5) * (east - west) / self.num_lons
+
+    ## Project latitudes and longitudes (degrees) onto the plane of the grid, as (n, 2) kilometres
+    def project(self, lats, lons):
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        return np.column_stack(((lons - self.bounds[1]) * km_per_degree_lon * np.cos(np.radians(self.origin_lat)), (lats - self.bounds[0]) * km_per_degree_lat))
+
+    ## Projected points of the grid, row by row (latitudes), as (num_lats * num_lons, 2) kilometres
+    def points(self):
+        lon_grid, lat_grid = np.meshgrid(self.lons, self.lats)
+        return self.project(lat_grid.ravel(), lon_grid.ravel())
+
+    # Key of the grid in the interpolator cache
+    def key(self):
+        return (self.bounds, self.resolution_km)
+
+
+class Interpolator:
+    # Precompute the k nearest stations of every point of grid and their IDW weights
+    # station_ids: the stations (columns of the blocks to interpolate), lats and lons: their locations
+    def __init__(self, station_ids, lats, lons, grid, k=8, power=2):
+        self.station_ids = list(station_ids)
+        self.grid = grid
+        self.k = min(k, len(self.station_ids))
+        self.power = power
+        if self.k == 0:
+            raise ValueError("No station with a location to interpolate from!")
+
+        distances, self.neighbours = nearest(grid.project(lats, lons), grid.points(), self.k)
+        # A point on a station takes its reading (its weight dominates every other one)
+        self.weights = 1 / np.maximum(distances, 1e-9) ** power           # Type: ndarray. (points, k)
+
+    ## Interpolate a block of readings (rows: timestamps, columns: self.station_ids) onto the grid. Returns (timestamps, num_lats, num_lons).
+    ## Timestamps are interpolated chunk_size at a time (a chunk takes chunk_size x points x k x 8 bytes of memory per intermediate array)
+    def interpolate(self, block, chunk_size=None):
+        block = np.asarray(block, dtype=float)
+        num_points = len(self.neighbours)
+        if chunk_size is None:
+            chunk_size = max(2 ** 22 // (num_points * self.k), 1)
+        fields = np.empty((block.shape[0], num_points))
+        for start in range(0, block.shape[0], chunk_size):
+            values = block[start:start + chunk_size][:, self.neighbours]         # (chunk, points, k)
+            missing = np.isnan(values)
+            weights = np.where(missing, 0, self.weights)
+            total_weight = weights.sum(axis=2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fields[start:start + chunk_size] = np.where(missing, 0, values * weights).sum(axis=2) / total_weight
+        return fields.reshape(block.shape[0], self.grid.num_lats, self.grid.num_lons)
+
+    ## Interpolate a block of directions (degrees, e.g. wind_direction) onto the grid, as unit vectors. Returns directions in [0, 360), (timestamps, num_lats, num_lons), NaN where the vectors cancel out.
+    def interpolate_directions(self, block, chunk_size=None):
+        radians = np.radians(np.asarray(block, dtype=float))
+        east, north = self.interpolate(np.sin(radians), chunk_size), self.interpolate(np.cos(radians), chunk_size)
+        with np.errstate(invalid='ignore'):
+            return np.where(np.hypot(east, north) < 1e-6, np.nan, np.degrees(np.arctan2(east, north)) % 360)
+
+
+# Get the k nearest of the points in sources to every point in targets: (distances, indices), both (targets, k)
+def nearest(sources, targets, k):
+    if cKDTree is not None:
+        distances, indices = cKDTree(sources).query(targets, k=k)
+        return distances.reshape(len(targets), k), indices.reshape(len(targets), k)
+
+    # Without scipy: distances to every source, a chunk of targets at a time, and a partial sort (argpartition) of each row
+    distances, indices = np.empty((len(targets), k)), np.empty((len(targets), k), dtype=np.int64)
+    chunk_size = max(2 ** 22 // len(sources), 1)
+    for start in range(0, len(targets), chunk_size):
+        chunk = np.sqrt(((targets[start:start + chunk_size, np.newaxis, :] - sources[np.newaxis, :, :]) ** 2).sum(axis=2))
+        chunk_indices = np.argpartition(chunk, k - 1, axis=1)[:, :k] if k < len(sources) else np.broadcast_to(np.arange(len(sources)), chunk.shape)
+        distances[start:start + chunk_size] = np.take_along_axis(chunk, chunk_indices, axis=1)
+        indices[start:start + chunk_size] = chunk_indices
+    return distances, indices
+
+## Get the Interpolator of the stations (ids, and their latitudes and longitudes) on grid, reusing the one already built for the same station set, locations, grid, k and power
+def interpolator_for(station_ids, lats, lons, grid, k=8, power=2):
+    cache_key = (station_hash([list(station_ids), list(map(float, lats)), list(map(float, lons))]), grid.key(), k, power)
+    interpolator = _interpolators.get(cache_key)
+    if interpolator is None:
+        interpolator = _interpolators[cache_key] = Interpolator(station_ids, lats, lons, grid, k=k, power=power)
+    return interpolator
+
+## Get the location of every station in the stations table of the database at path_to_db: {station_id: (latitude, longitude)}
+def station_locations(path_to_db='vault.db'):
+    con = connect(path_to_db)
+    try:
+        if con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'stations'").fetchone() is None:
+            return dict()
+        rows = con.execute("SELECT station_id, latitude, longitude FROM stations WHERE latitude IS NOT NULL AND longitude IS NOT NULL ;").fetchall()
+    finally:
+        con.close()
+    return {station_id: (latitude, longitude) for station_id, latitude, longitude in rows}
+
+## Interpolate the readings of data_type (e.g. 'rainfall') from start to end (both included) onto grid (default: Singapore, 1 km cells)
+## Returns (epochs, grid, fields), fields being (timestamps, grid.num_lats, grid.num_lons)
+def interpolate_history(path_to_db, data_type, start=None, end=None, grid=None, k=8, power=2, storage='narrow', archive=None):
+    grid = grid if grid is not None else Grid()
+    locations = station_locations(path_to_db)
+    reader = Reader(path_to_db, storage=storage, archive=archive)
+    try:
+        epochs, station_ids, block = reader.query(data_type, start, end, as_frame=False)
+    finally:
+        reader.close()
+
+    # Only stations with a location are interpolated from
+    columns = [column_i for column_i, station_id in enumerate(station_ids) if station_id in locations]
+    located_ids = [station_ids[column_i] for column_i in columns]
+    interpolator = interpolator_for(located_ids, [locations[station_id][0] for station_id in located_ids], [locations[station_id][1] for station_id in located_ids], grid, k=k, power=power)
+    block = np.asarray(block, dtype=float)[:, columns]
+    return np.asarray(epochs), grid, interpolator.interpolate_directions(block) if data_type in circular_data_types else interpolator.interpolate(block)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Interpolate station readings onto a regular grid (inverse distance weighting).")
+    parser.add_argument('data_type', help="data type, e.g. temperature or rainfall")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--start', default=None, help="first reading_time (ISO 8601, default: first stored)")
+    parser.add_argument('--end', default=None, help="last reading_time (ISO 8601, default: last stored)")
+    parser.add_argument('--resolution-km', type=float, default=1.0, help="size of the grid cells (default: 1 km)")
+    parser.add_argument('--k', type=int, default=8, help="nearest stations weighted per point (default: 8)")
+    parser.add_argument('--power', type=float, default=2, help="power of the inverse distance (default: 2)")
+    parser.add_argument('--out', required=True, help="NumPy .npz file to write (epochs, lats, lons, fields)")
+    args = parser.parse_args()
+
+    epochs, grid, fields = interpolate_history(args.db, args.data_type, args.start, args.end, grid=Grid(resolution_km=args.resolution_km), k=args.k, power=args.power, storage=args.storage)
+    np.savez_compressed(args.out, epochs=epochs, lats=grid.lats, lons=grid.lons, fields=fields.astype(np.float32))
+    print(f"Interpolated {len(epochs)} timestamps of {args.data_type} onto a {grid.num_lats} x {grid.num_lons} grid ({args.out}).")
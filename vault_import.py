@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+import os
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from weather_vault import Collector
+from vault_backfill import drop_stored_rows
+from vault_parse import loads, parse_items
+from vault_reader import merge_blocks
+from vault_rollup import to_date_time
+from vault_store import NarrowStore, connect, to_epoch
+from vault_transport import split_record
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+
+Bulk import of captured API responses (recordings written by vault_transport.RecordingTransport, one JSON response per line) into the database.
+
+    python vault_import.py captures/2021-07-*.jsonl --db vault.db --storage narrow --workers 8
+
+Parsing is spread over a pool of worker processes, writing is done by this process only:
+    every input file is cut into shards of about shard_mb MB (at line boundaries), so a single large file is still parsed by every worker
+    a worker decodes the payloads of its shard (vault_parse.loads) and parses their items (vault_parse.parse_items, the vectorised form of Collector._get_reading) into one block per data type: epochs (int64), station ids, and readings (rows: epochs, columns: station ids)
+    the blocks (compact NumPy arrays, not payloads) are sent back to this process, merged per data type until batch_entries entries are pending, and written in one transaction per batch: upserted into the readings table (narrow) or appended to the wide table through Collector._send_to_db
+
+Shards are written in input order. The same reading_time captured several times (e.g. repeated polls, overlapping recordings) is only written once, and readings already in the database are not duplicated (as in vault_backfill).
+
+Import throughput grows with the number of workers until the writer is the bottleneck (see benchmarks/bench_import.py).
+
+"""
+
+# Get the shards (path, first byte, last byte) of the files in paths, of about shard_bytes each
+def shard_files(paths, shard_bytes):
+    shards = list()
+    for path in paths:
+        size = os.path.getsize(path)
+        shards += [(path, start, min(start + shard_bytes, size)) for start in range(0, max(size, 1), shard_bytes)]
+    return shards
+
+## Parse the records of a shard: every line starting in bytes [start, end) of the recording at path. Records of data types not in data_types (API names, e.g. 'air-temperature') are skipped (default: none).
+## Returns ({data_type: (epochs, station_ids, block, stations)}, number of payloads parsed), stations being the station metadata of the latest payload
+def parse_shard(path, start, end, data_types=None):
+    parsed, num_payloads = dict(), 0
+    with open(path, 'rb') as f:
+        # A shard starts at the first line starting at or after start (the line under way belongs to the previous shard)
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line.strip():
+                if not line:
+                    break
+                continue
+            record, content = split_record(line.decode())
+            if record['status_code'] != 200 or (data_types is not None and record['data_type'] not in data_types):
+                continue
+            raw_reading = record.get('payload') if content is None else loads(content)
+            if not raw_reading or len(raw_reading['items']) == 0:
+                continue
+            reading_times, station_ids, block = parse_items(raw_reading)
+            epochs = np.fromiter((to_epoch(reading_time) for reading_time in reading_times), dtype=np.int64, count=len(reading_times))
+            parsed.setdefault(record['data_type'], list()).append((epochs, station_ids, block, raw_reading['metadata']['stations']))
+            num_payloads += 1
+    return {data_type: merged(blocks) for data_type, blocks in parsed.items()}, num_payloads
+
+# Merge blocks (epochs, station_ids, block, stations) into one, sorted by epoch (the latest non-missing reading of an epoch and station wins), with the stations of the last block
+def merged(blocks):
+    if len(blocks) == 1:
+        epochs, station_ids, block, stations = blocks[0]
+        if len(epochs) < 2 or np.all(np.diff(epochs) > 0):
+            return blocks[0]
+    return (*merge_blocks([block[:3] for block in blocks]), blocks[-1][3])
+
+## Import the recordings at paths into the database at path_to_db, parsing shards of about shard_mb MB in max_workers processes (0: in this process)
+## Only the data types in look_fors are imported (default: all). Returns the number of entries written per db_table_name.
+def import_recordings(paths, path_to_db='vault.db', storage='wide', look_fors=None, max_workers=None, shard_mb=64, batch_entries=2016):
+    collectors = dict()                         # Type: dict. API data_type -> Collector (for its data_name, and its write step)
+    data_types = None
+    if look_fors is not None:
+        for look_for in look_fors:
+            collector = Collector(look_for=look_for, build_format='V1', ping_interval=0)
+            collectors[collector.data_type] = collector
+        data_types = set(collectors)
+
+    shards = shard_files(paths, int(shard_mb * 2 ** 20))
+    con = connect(path_to_db)
+    store = NarrowStore(path_to_db, con=con) if storage == 'narrow' else None
+    pending = dict()                            # Type: dict. API data_type -> blocks parsed but not written yet
+    num_entries, num_payloads = dict(), 0
+
+    # Write the pending blocks of a data type in one transaction
+    def write(data_type):
+        epochs, station_ids, block, stations = merged(pending.pop(data_type))
+        collector = collectors.get(data_type)
+        if collector is None:
+            collector = collectors[data_type] = Collector(look_for=data_type, build_format='V1', ping_interval=0)
+        db_table_name = collector.data_name
+        reading_times = [to_date_time(int(epoch)) for epoch in epochs]
+        if storage == 'narrow':
+            # Entries (timestamps) already stored are upserted again, but only new ones are counted as imported (as for wide tables, whose stored rows are dropped)
+            stored = [row[0] for row in con.execute("SELECT DISTINCT ts_epoch FROM readings WHERE data_type = ? AND ts_epoch BETWEEN ? AND ? ;", (db_table_name, int(epochs[0]), int(epochs[-1])))] if len(epochs) else list()
+            store.write_block(db_table_name, reading_times, station_ids, block, stations=stations)
+            written = int(np.count_nonzero(~np.isin(epochs, stored)))
+        else:
+            df = drop_stored_rows(con, db_table_name, pd.DataFrame(block, index=reading_times, columns=station_ids))
+            if df.shape[0] != 0:
+                collector._send_to_db(df, db_table_name, path_to_db, storage, con=con, stations=stations)
+            written = df.shape[0]
+        num_entries[db_table_name] = num_entries.get(db_table_name, 0) + written
+
+    # Queue the blocks of a parsed shard, writing the data types with batch_entries entries (or more) pending
+    def collect(result):
+        parsed, shard_payloads = result
+        for data_type, parsed_block in parsed.items():
+            pending.setdefault(data_type, list()).append(parsed_block)
+            if sum(len(epochs) for epochs, _, _, _ in pending[data_type]) >= batch_entries:
+                write(data_type)
+        return shard_payloads
+
+    try:
+        if max_workers == 0:
+            for shard in shards:
+                num_payloads += collect(parse_shard(*shard, data_types))
+        else:
+            # At most 2 shards per worker are in flight (parsed or being parsed, but not written yet), which bounds memory however many shards there are
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                in_flight, shards_left = deque(), deque(shards)
+                window = 2 * (max_workers or os.cpu_count() or 1)
+                while in_flight or shards_left:
+                    while shards_left and len(in_flight) < window:
+                        in_flight.append(pool.submit(parse_shard, *shards_left.popleft(), data_types))
+                    num_payloads += collect(in_flight.popleft().result())
+        for data_type in list(pending):
+            write(data_type)
+    finally:
+        con.close()
+
+    for db_table_name, entries in num_entries.items():
+        print(f"Imported {entries} entries of {db_table_name}.")
+    print(f"Imported {num_payloads} payloads from {len(paths)} files ({len(shards)} shards).")
+    return num_entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import captured NEA responses (JSON lines recordings) into the database.")
+    parser.add_argument('paths', nargs='+', help="recordings to import (JSON lines, see vault_transport)")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='wide', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--look-for', nargs='+', default=None, help="data types to import (default: all)")
+    parser.add_argument('--workers', type=int, default=None, help="parsing processes (default: one per core, 0: parse in the writing process)")
+    parser.add_argument('--shard-mb', type=float, default=64, help="size of the file shards handed to the workers (default: 64 MB)")
+    parser.add_argument('--batch-entries', type=int, default=2016, help="entries of a data type written per transaction (default: 2016, a week)")
+    args = parser.parse_args()
+
+    import_recordings(args.paths, path_to_db=args.db, storage=args.storage, look_fors=args.look_for, max_workers=args.workers, shard_mb=args.shard_mb, batch_entries=args.batch_entries)
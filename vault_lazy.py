@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+import sys
+import types
+import importlib
+
+"""
+
+Lazy imports of the heavy libraries (NumPy, pandas, requests, PySimpleGUI), so that importing the collector (and starting a CLI, e.g. to parse its arguments or print its help) does not pay for libraries the run may never use:
+
+    np = lazy_import('numpy')           # Nothing is imported yet
+    np.array([1, 2])                    # numpy is imported here, on first use of one of its attributes
+
+The first use imports the library with importlib.import_module (under the import lock of the library, so collectors polling from several threads import it once), then copies its attributes onto the lazy module, so later uses are plain attribute lookups. A library already imported is returned as it is.
+
+Libraries are only imported lazily by name (lazy_import('numpy'), then np.lib.stride_tricks...): 'from numpy import x' at module level imports numpy right away. A library that is not installed fails on first use (ModuleNotFoundError), not on import.
+
+python -X importtime -c "import weather_vault" lists what is still imported on start (see benchmarks/bench_startup.py).
+
+"""
+
+class LazyModule(types.ModuleType):
+    # Attributes not set yet (i.e. before the first use): import the library and take its attributes
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+## Get the module name, imported on first use of one of its attributes
+def lazy_import(name):
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+## Whether the module name has been imported
+def is_loaded(name):
+    return name in sys.modules
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+"""
+
+Metrics object collects the timings and counts of the collection pipeline (Collector, Engine, DbWriter), and exposes them:
+    as a Prometheus-style text endpoint (Metrics.serve, e.g. http://127.0.0.1:9105/metrics)
+    as a structured log (Metrics.start_log): one JSON object per line, for every poll and every write
+
+The pipeline records into the module-level registry, metrics:
+
+    vault_stage_seconds{stage, data_type}           histogram of the time spent in each stage:
+                                                        network (request to the API), decode (JSON), parse (items into a block), dataframe (block into a DataFrame),
+                                                        schema (table creation, and station columns of wide tables), dedup (latest stored entry lookup, wide tables only), insert (rows, watermark), rollup (see vault_rollup, part of insert for narrow storage), derive (see vault_derived, part of insert for narrow storage), quality (see vault_quality, part of insert for narrow storage)
+    vault_polls_total{data_type, status}            polls of the API by response (200, 304 or error)
+    vault_duplicate_polls_total{data_type}          polls that returned no new entry
+    vault_retries_total{data_type}                  polls retried after a failed connection (vault_engine.Engine, Collector.build_df)
+    vault_restarts_total{data_type}                 collections restarted after an unexpected failure (vault_engine.Engine)
+    vault_entries_total{data_type}                  new entries collected
+    vault_missing_readings_total{data_type}         stations of the metadata without a reading, over the new entries
+    vault_rows_written_total{data_type}             entries written to the database
+    vault_flagged_readings_total{data_type, flag}   readings flagged by the data-quality checks (flag: range, spike or stuck, see vault_quality)
+    vault_missing_slots_total{data_type}            5-minute slots found missing before or within the entries written (see vault_quality)
+    vault_ingestion_lag_seconds{data_type}          age of the latest reading, when it was collected
+    vault_write_lag_seconds{data_type}              age of the latest reading, when it was written to the database
+    vault_writer_pressure                           how full the queue of vault_writer.DbWriter is (0 to 1)
+    vault_writer_stalls_total                       submits that waited on a full DbWriter queue
+    vault_transport_attempts_total{endpoint, outcome}   requests sent by vault_transport.ResilientTransport, by outcome (status code, error or timeout)
+    vault_transport_retries_total{endpoint}         attempts retried after a failed one
+    vault_transport_hedges_total{endpoint}          attempts hedged (sent again) after the hedge delay
+    vault_transport_rejected_total{endpoint}        calls failed right away by an open circuit
+    vault_transport_budget_used{endpoint}           share of the latency budget used by the latest call (0 to 1)
+
+Recording is a dict update under a lock (and two perf_counter calls for a timing), so it is cheap enough for every poll and every write. The log is only written when started.
+
+"""
+
+class Metrics:
+    # Upper bounds (seconds) of the histogram buckets of timings
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict()                      # Type: dict. (name, labels) -> value
+        self.gauges = dict()                        # Type: dict. (name, labels) -> value
+        self.histograms = dict()                    # Type: dict. (name, labels) -> [count per bucket (+Inf last), count, sum]
+        self._log = None
+
+    ## Add value to a counter
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    ## Set a gauge to value
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    ## Add a timing (seconds) to a histogram
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        bucket_i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            histogram[0][bucket_i] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    ## Time the body of a with statement into a histogram
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    ## Write an event (with its fields) to the structured log, if started
+    def event(self, event, **fields):
+        if self._log is None:
+            return
+        line = json.dumps({'time': round(time.time(), 3), 'event': event, **fields})
+        with self._lock:
+            if self._log is not None:
+                self._log.write(line + '\n')
+                self._log.flush()
+
+    ## Start writing events to the structured log at path_to_log (JSON lines, appended)
+    def start_log(self, path_to_log):
+        with self._lock:
+            self._log = open(path_to_log, 'a')
+
+    def stop_log(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    ## Render every metric in the Prometheus text format
+    def render(self):
+        with self._lock:
+            counters, gauges = sorted(self.counters.items()), sorted(self.gauges.items())
+            histograms = sorted((key, ([*counts], count, total)) for key, (counts, count, total) in self.histograms.items())
+
+        lines, typed = list(), set()
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            type_line(name, 'counter')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            type_line(name, 'gauge')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, count, total) in histograms:
+            type_line(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    ## Serve the metrics (GET /metrics) from a background thread. Returns the server (server.shutdown() stops it).
+    def serve(self, host='127.0.0.1', port=9105):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer          # Only imported when metrics are served (see vault_lazy)
+
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass                                # Scrapes are not printed
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+        return server
+
+
+# Key of a metric: its name and its labels as sorted (name, str(value)) pairs
+def _key(name, labels):
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+# Format labels ((name, value), ...) as {name="value",...}
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# Registry of the collection pipeline
+metrics = Metrics()
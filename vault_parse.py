@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import json
+from itertools import chain
+from operator import itemgetter
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    import orjson                       # Optional: decodes payloads about twice as fast as the json module
+except ImportError:
+    orjson = None
+
+"""
+
+Vectorised parsing of NEA API payloads holding any number of items (e.g. the whole day returned by a date-parameterised request, or a replayed capture).
+
+parse_items turns the payload into a 2-D block (rows: reading_time of each item, columns: station ids sorted by value after S prefix) in one pass, instead of one Collector._get_row call per item:
+
+    raw_reading = {'metadata': {'stations': [...], 'reading_unit': ...}, 'items': [{'timestamp': ..., 'readings': [{'station_id': ..., 'value': ...}, ...]}, ...]}
+    reading_times, station_ids, block = parse_items(raw_reading)
+
+Stations without a reading in an item are NaN.
+
+Only the timestamp of each item and the station_id and value of each reading are extracted (into a list of reading times, and typed arrays of columns and values). The station metadata is only used for the column layout, which is cached by station set (station_layout), so a payload with the same stations as a previous one is never walked for its metadata again.
+
+Payloads are decoded with loads (or decode_payload, for a whole payload straight from the bytes of a response), and JSON is encoded with dumps: orjson when it is installed, the json module otherwise.
+
+"""
+
+## Decode JSON (bytes or str): orjson.loads when orjson is installed, else json.loads
+loads = orjson.loads if orjson is not None else json.loads
+
+## Encode an object (of JSON types) into JSON bytes: orjson.dumps when orjson is installed, else json.dumps
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+# Column layouts by station set (raw 'id' of every station of the metadata, in order)
+_layouts = dict()
+
+# Sort key of station ids (value after S prefix)
+def station_sort_key(station_id):
+    return int(station_id[1:])
+
+## Get the column layout of a station set (the 'stations' list of the metadata): station ids sorted by value after S prefix, and the column of each station id
+## Layouts are cached, as the station set rarely changes from one payload to the next
+def station_layout(stations):
+    layout_key = tuple(map(itemgetter('id'), stations))
+    layout = _layouts.get(layout_key)
+    if layout is None:
+        station_ids = sorted({station_id.strip() for station_id in layout_key}, key=station_sort_key)
+        layout = _layouts[layout_key] = (station_ids, {station_id: column_i for column_i, station_id in enumerate(station_ids)})
+    return layout
+
+## Parse all items of a payload into (reading_times, station_ids, block)
+def parse_items(raw_reading):
+    items = raw_reading['items']
+    reading_times = list(map(itemgetter('timestamp'), items))
+
+    # Flatten the readings of all items (with the row of each reading). None values become NaN.
+    readings = list(map(itemgetter('readings'), items))
+    counts = np.fromiter(map(len, readings), dtype=np.int64, count=len(items))
+    flat_readings = list(chain.from_iterable(readings))
+    flat_station_ids = list(map(itemgetter('station_id'), flat_readings))
+    flat_values = np.array(list(map(itemgetter('value'), flat_readings)), dtype=float)
+    rows = np.repeat(np.arange(len(items)), counts)
+
+    # Columns: every station of the metadata, plus any station only seen in the readings
+    station_ids, station_index = station_layout(raw_reading['metadata']['stations'])
+    seen = set(flat_station_ids)
+    unlisted = {station_id.strip() for station_id in seen}.difference(station_index)
+    if unlisted:
+        station_ids = sorted(unlisted.union(station_ids), key=station_sort_key)
+        station_index = {station_id: column_i for column_i, station_id in enumerate(station_ids)}
+    # Column of each distinct (unstripped) station id, so that ids are stripped once per payload rather than once per reading
+    column_of = {station_id: station_index[station_id.strip()] for station_id in seen}
+    columns = np.fromiter(map(column_of.__getitem__, flat_station_ids), dtype=np.int64, count=len(flat_station_ids))
+
+    block = np.full((len(items), len(station_ids)), np.nan)
+    block[rows, columns] = flat_values
+    return reading_times, station_ids, block
+
+## Decode a payload (bytes or str) and parse all its items into (reading_times, station_ids, block, metadata)
+def decode_payload(content):
+    raw_reading = loads(content)
+    return (*parse_items(raw_reading), raw_reading['metadata'])
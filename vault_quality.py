@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+import os
+import argparse
+import sqlite3 as sl
+from datetime import datetime
+from vault_metrics import metrics
+from vault_rollup import read_block, to_date_time
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+Data-quality checks of the readings of every write (NarrowStore.write_block, Collector._send_to_wide_db), in the same transaction as the readings (for both storages: a failed write stores neither the readings nor their flags and gaps), as NumPy operations over the whole block (rows: timestamps, columns: stations):
+
+    flag_range = 1      the reading is outside the plausible range of its data type (checks[data_type]: low, high)
+    flag_spike = 2      the reading is further than max_step from the median of the window readings of its station before it
+    flag_stuck = 4      the reading is equal to every one of the window readings of its station before it (sensor stuck at a value)
+
+The flags of a reading are OR-ed into a bitmask (0: no flag). Readings are stored whatever their flags (a check never drops a reading):
+    narrow storage: in the flags column of the readings table (e.g. SELECT ... FROM readings WHERE flags = 0, for clean readings only)
+    wide storage: in the reading_flags table (series: the db_table_name, station_id, ts_epoch, flags), flagged readings only
+
+Gaps: timestamps missing from the expected grid of interval_seconds (5 minutes), i.e. a reading_time at least two intervals after the one before it, are written to the gaps table, which vault_backfill consumes (python vault_backfill.py --gaps):
+
+gaps =
+    data_type           TEXT        (the data_name of the Collector, e.g. 'temperature')
+    start_epoch         INTEGER     (first missing slot)
+    end_epoch           INTEGER     (last missing slot)
+    start_date_time     TEXT
+    end_date_time       TEXT
+    missing             INTEGER     (number of missing slots)
+    detected_epoch      INTEGER
+    backfilled_epoch    INTEGER     (NULL until vault_backfill has fetched the days of the gap)
+    PRIMARY KEY (data_type, start_epoch)
+
+QualityFilter object (quality_filter) keeps the last window readings committed (and so the reading_time before a block) in process, per database and series, so live flushes of a few rows never read the database for them. They are read from the database (window x interval_seconds before the block) when a block does not directly follow them, e.g. after a restart, or for a backfill of older readings.
+
+Data types without checks (e.g. the derived series of vault_derived) are not checked. Gaps are looked for before and within a block (not after it, for a block older than the readings stored).
+
+Usage: python vault_quality.py --db vault.db --storage narrow            (open gaps, and flagged readings per data type)
+
+"""
+
+flag_range, flag_spike, flag_stuck = 1, 2, 4
+flag_names = {flag_range: 'range', flag_spike: 'spike', flag_stuck: 'stuck'}
+
+# Checks of every data type: plausible range (low, high), largest step from the median of the window before a reading (None: no spike check), and whether readings stuck at a value are flagged
+checks = {
+    'temperature': {'low': 15, 'high': 45, 'max_step': 5, 'stuck': True},                 # deg C
+    'relative_humidity': {'low': 10, 'high': 100, 'max_step': 25, 'stuck': True},         # %
+    'rainfall': {'low': 0, 'high': 50, 'max_step': None, 'stuck': False},                 # mm per 5 minutes: bursty, and 0 for days on end
+    'wind_speed': {'low': 0, 'high': 80, 'max_step': 25, 'stuck': True},                  # knots
+    'wind_direction': {'low': 0, 'high': 360, 'max_step': None, 'stuck': True},           # degrees: circular, so no spike check
+    }
+
+create_gaps_table = """
+    CREATE TABLE IF NOT EXISTS gaps (
+        data_type TEXT NOT NULL,
+        start_epoch INTEGER NOT NULL,
+        end_epoch INTEGER NOT NULL,
+        start_date_time TEXT NOT NULL,
+        end_date_time TEXT NOT NULL,
+        missing INTEGER NOT NULL,
+        detected_epoch INTEGER NOT NULL,
+        backfilled_epoch INTEGER,
+        PRIMARY KEY (data_type, start_epoch) ) ;
+    """
+# A gap found again (e.g. a re-import, or a backfill that found nothing to fill it with) is left as it is
+insert_gap = """
+    INSERT INTO gaps (data_type, start_epoch, end_epoch, start_date_time, end_date_time, missing, detected_epoch) VALUES (?, ?, ?, ?, ?, ?, strftime('%s', 'now'))
+    ON CONFLICT (data_type, start_epoch) DO NOTHING ;
+    """
+
+# Flags of the flagged readings of wide tables (readings of the narrow table carry their own flags column)
+create_reading_flags_table = """
+    CREATE TABLE IF NOT EXISTS reading_flags (
+        series TEXT NOT NULL,
+        station_id TEXT NOT NULL,
+        ts_epoch INTEGER NOT NULL,
+        flags INTEGER NOT NULL,
+        PRIMARY KEY (series, station_id, ts_epoch) ) WITHOUT ROWID ;
+    """
+
+
+class QualityFilter:
+    # Check readings against the window readings before them (window: readings per station, on the grid of interval_seconds)
+    def __init__(self, interval_seconds=300, window=12):
+        self.interval_seconds = interval_seconds
+        self.window = window
+        self._tails = dict()                # Type: dict. (database, storage, series) -> (epochs, station_ids, block): the last window readings written (out of range readings as NaN)
+
+    ## Check a block of readings of data_type (rows: epochs, columns: station_ids) written with cur to series (a wide table, or the data type of the narrow readings table) of storage, and write the gaps before and within it with cur
+    ## Returns the flags of every reading (uint8, the shape of block), or None if data_type has no checks, and what to pass to remember once the transaction is committed: (key, tail), or None if the block is not the newest of its series
+    ## The readings kept in process are not changed here, so a write rolled back (e.g. by vault_writer.DbWriter) leaves them at the last readings committed, and the slots of the next block are measured from those
+    def check(self, cur, path_to_db, data_type, epochs, station_ids, block, series=None, storage='narrow'):
+        check = checks.get(data_type)
+        epochs = np.asarray(epochs, dtype=np.int64)
+        if check is None or len(epochs) == 0:
+            return None, None
+        with metrics.timer('vault_stage_seconds', stage='quality', data_type=data_type):
+            station_ids = list(station_ids)
+            block = np.asarray(block, dtype=float)
+            order = None if len(epochs) < 2 or np.all(epochs[1:] >= epochs[:-1]) else np.argsort(epochs, kind='stable')        # Blocks are written in time order, almost always
+            if order is not None:
+                epochs, block = epochs[order], block[order]
+            key = (os.path.abspath(path_to_db), storage, series or data_type)
+            previous, stored, newest, history_epochs, history = self._before(cur, key, epochs, station_ids)
+
+            # Range: NaN (missing) readings compare False, so they are never flagged
+            stacked = np.concatenate([history, block])
+            with np.errstate(invalid='ignore'):
+                out_of_range = (stacked < check['low']) | (stacked > check['high'])
+            flags = np.where(out_of_range[len(history):], flag_range, 0).astype(np.uint8)
+            values = np.where(out_of_range, np.nan, stacked)            # Out of range readings are left out of the windows of the next ones
+
+            # Spike and stuck: the window readings before every reading of the block, as (rows, stations, window), NaN-padded where there is not enough history
+            if (check['max_step'] is not None or check['stuck']) and self.window > 0:
+                padded = np.concatenate([np.full((max(self.window - len(history), 0), len(station_ids)), np.nan), values])
+                windows = np.lib.stride_tricks.sliding_window_view(padded, self.window, axis=0)[-len(epochs) - 1:-1]
+                current = values[len(history):]
+                if check['max_step'] is not None:
+                    # Median of the readings present in every window: NaN sorts last, so it is the middle of the first count readings (np.nanmedian goes through masked arrays, ~10x slower on a row of a live flush)
+                    # The median of a window is only trusted with at least half of its readings present
+                    count = (~np.isnan(windows)).sum(axis=2)
+                    ordered = np.sort(windows, axis=2)
+                    middle = np.maximum(count - 1, 0)[:, :, np.newaxis]
+                    median = (np.take_along_axis(ordered, middle // 2, axis=2) + np.take_along_axis(ordered, (middle + 1) // 2, axis=2))[:, :, 0] / 2
+                    with np.errstate(invalid='ignore'):
+                        flags[(count >= max(self.window // 2, 1)) & (np.abs(current - median) > check['max_step'])] |= flag_spike
+                if check['stuck']:
+                    flags[np.all(windows == current[:, :, np.newaxis], axis=2)] |= flag_stuck
+
+            self._write_gaps(cur, data_type, previous, np.union1d(epochs, stored) if len(stored) else epochs)
+            tail = None
+            if newest:
+                stacked_epochs = np.concatenate([history_epochs, epochs])
+                tail = (key, (stacked_epochs[-self.window:], station_ids, values[-self.window:]))
+
+            for flag, name in flag_names.items():
+                count = int(np.count_nonzero(flags & flag))
+                if count:
+                    metrics.inc('vault_flagged_readings_total', count, data_type=data_type, flag=name)
+        if order is None:
+            return flags, tail
+        restored = np.empty_like(flags)
+        restored[order] = flags
+        return restored, tail
+
+    ## Keep the last window readings of a series (key, tail: as returned by check), once the block they end with is committed
+    def remember(self, key, tail):
+        self._tails[key] = tail
+
+    ## Forget the readings kept for every series of the database at path_to_db (e.g. the database was replaced)
+    def forget(self, path_to_db):
+        path_to_db = os.path.abspath(path_to_db)
+        for key in [key for key in self._tails if key[0] == path_to_db]:
+            del self._tails[key]
+
+    # Get the reading_time before the block at epochs (None if there is none), the reading_times already stored within the range of the block, whether the block is the newest of the series (no reading stored after it), and the window readings before it as (epochs, block) with the columns of station_ids (NaN for stations without readings)
+    # Readings already stored within the range of the block (e.g. a wide backfill only writes the rows missing from its table) are only looked up when the block does not directly follow the readings kept in process
+    def _before(self, cur, key, epochs, station_ids):
+        _, storage, series = key
+        first_epoch = int(epochs[0])
+        start = first_epoch - self.window * self.interval_seconds
+        tail = self._tails.get(key)
+        if tail is not None and tail[0][-1] < first_epoch:
+            previous, stored, newest = int(tail[0][-1]), np.empty(0, dtype=np.int64), True
+            history_epochs, history_ids, history = tail
+        else:
+            history_epochs, history_ids, history = read_block(cur, series, start, first_epoch, storage)
+            previous = int(history_epochs[-1]) if len(history_epochs) else _previous_epoch(cur, series, first_epoch, storage)
+            stored = _stored_epochs(cur, series, first_epoch, int(epochs[-1]), storage)
+            newest = _previous_epoch(cur, series, None, storage, after=int(epochs[-1])) is None        # A backfill of older readings does not replace the readings kept in process
+        keep = history_epochs >= start
+        history_epochs, history = history_epochs[keep], history[keep]
+        if history_ids != station_ids:
+            history = _aligned(history_ids, history, station_ids)
+        return previous, stored, newest, history_epochs, history.reshape(len(history_epochs), len(station_ids))
+
+    # Write the gaps of the grid of interval_seconds between previous (the reading_time before the block, if any) and the epochs of the block (sorted, with the reading_times already stored within its range)
+    def _write_gaps(self, cur, data_type, previous, epochs):
+        bounds = np.concatenate([[previous], epochs]) if previous is not None else epochs
+        steps = np.diff(bounds)
+        at = np.nonzero(steps >= 2 * self.interval_seconds)[0]
+        if len(at) == 0:
+            return
+        missing = steps[at] // self.interval_seconds - 1
+        starts = bounds[at] + self.interval_seconds
+        ends = starts + (missing - 1) * self.interval_seconds
+        cur.execute(create_gaps_table)
+        cur.executemany(insert_gap, [(data_type, start, end, to_date_time(start), to_date_time(end), slots) for start, end, slots in zip(starts.tolist(), ends.tolist(), missing.tolist())])
+        metrics.inc('vault_missing_slots_total', int(missing.sum()), data_type=data_type)
+
+
+# Checks of the readings written by this process, per database and series
+quality_filter = QualityFilter()
+
+# Reorder the columns of history (rows of readings of history_ids) as station_ids, NaN for the stations without readings in history
+def _aligned(history_ids, history, station_ids):
+    history_index = {station_id: column_i for column_i, station_id in enumerate(history_ids)}
+    aligned = np.full((len(history), len(station_ids)), np.nan)
+    columns = [(column_i, history_index[station_id]) for column_i, station_id in enumerate(station_ids) if station_id in history_index]
+    if columns:
+        to_columns, from_columns = zip(*columns)
+        aligned[:, list(to_columns)] = history[:, list(from_columns)]
+    return aligned
+
+# Get the last reading_time (epoch) of series before epoch (or, with after, the first one after it), None if there is none (looked up through the time index of the narrow readings table, or the date_time index of a wide table)
+def _previous_epoch(cur, series, epoch, storage, after=None):
+    aggregate, operator, bound = ('MAX', '<', epoch) if after is None else ('MIN', '>', after)
+    try:
+        if storage == 'narrow':
+            return cur.execute(f"SELECT {aggregate}(ts_epoch) FROM readings WHERE data_type = ? AND ts_epoch {operator} ? ;", (series, bound)).fetchone()[0]
+        date_time = cur.execute(f"SELECT {aggregate}(date_time) FROM {series} WHERE date_time {operator} ? ;", (to_date_time(bound),)).fetchone()[0]
+    except sl.OperationalError:             # Nothing written yet
+        return None
+    return int(datetime.fromisoformat(date_time).timestamp()) if date_time is not None else None
+
+# Get the reading_times (epochs) of series stored from start to end (both included), through the same indexes
+def _stored_epochs(cur, series, start, end, storage):
+    try:
+        if storage == 'narrow':
+            rows = cur.execute("SELECT DISTINCT ts_epoch FROM readings WHERE data_type = ? AND ts_epoch BETWEEN ? AND ? ;", (series, start, end)).fetchall()
+            return np.array([row[0] for row in rows], dtype=np.int64)
+        rows = cur.execute(f"SELECT DISTINCT date_time FROM {series} WHERE date_time BETWEEN ? AND ? ;", (to_date_time(start), to_date_time(end))).fetchall()
+    except sl.OperationalError:
+        return np.empty(0, dtype=np.int64)
+    return np.array([int(datetime.fromisoformat(row[0]).timestamp()) for row in rows], dtype=np.int64)
+
+## Write the flags (from QualityFilter.check) of a block of readings of the wide table series to the reading_flags table, flagged readings only. Returns the number of flagged readings.
+def write_flags(cur, series, epochs, station_ids, flags):
+    if flags is None:
+        return 0
+    row_i, col_i = np.nonzero(flags)
+    if len(row_i) == 0:
+        return 0
+    station_ids = np.asarray(station_ids, dtype=object)
+    cur.execute(create_reading_flags_table)
+    cur.executemany("INSERT OR REPLACE INTO reading_flags (series, station_id, ts_epoch, flags) VALUES (?, ?, ?, ?) ;",
+                    zip([series] * len(row_i), station_ids[col_i].tolist(), np.asarray(epochs, dtype=np.int64)[row_i].tolist(), flags[row_i, col_i].tolist()))
+    return len(row_i)
+
+## Get the gaps not backfilled yet of data_types (default: all) as a list of (data_type, start_epoch, end_epoch, missing), oldest first
+def open_gaps(cur, data_types=None):
+    cur.execute(create_gaps_table)
+    rows = cur.execute("SELECT data_type, start_epoch, end_epoch, missing FROM gaps WHERE backfilled_epoch IS NULL ORDER BY start_epoch ;").fetchall()
+    return [row for row in rows if data_types is None or row[0] in data_types]
+
+## Mark gaps (data_type, start_epoch) as backfilled
+def mark_backfilled(cur, gaps):
+    cur.execute(create_gaps_table)
+    cur.executemany("UPDATE gaps SET backfilled_epoch = strftime('%s', 'now') WHERE data_type = ? AND start_epoch = ? ;", gaps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the open gaps and the flagged readings of the database.")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage backend")
+    args = parser.parse_args()
+
+    con = sl.connect(args.db)
+    try:
+        gaps = open_gaps(con.cursor())
+        for data_type in sorted({gap[0] for gap in gaps}):
+            of_type = [gap for gap in gaps if gap[0] == data_type]
+            print(f"{data_type}: {len(of_type)} open gaps, {sum(gap[3] for gap in of_type)} missing slots (first: {to_date_time(of_type[0][1])}, last: {to_date_time(of_type[-1][2])})")
+        if args.storage == 'narrow':
+            sql = "SELECT data_type, flags, COUNT(*) FROM readings WHERE flags != 0 GROUP BY data_type, flags ;"
+        else:
+            con.execute(create_reading_flags_table)
+            sql = "SELECT series, flags, COUNT(*) FROM reading_flags GROUP BY series, flags ;"
+        for series, flags, count in con.execute(sql).fetchall():
+            print(f"{series}: {count} readings flagged {'+'.join(name for flag, name in flag_names.items() if flags & flag)}")
+    finally:
+        con.close()
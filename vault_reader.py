@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import sqlite3 as sl
+from datetime import datetime, timedelta, timezone
+from vault_parse import station_sort_key
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+"""
+
+Reader object is used to read the readings stored by the Collector back out of the database, for a data type, a time range and (optionally) a subset of stations, without loading whole tables.
+
+    reader = Reader('vault.db', storage='narrow')
+    df = reader.query('temperature', '2021-07-07T00:00:00+08:00', '2021-07-08T00:00:00+08:00', stations=['S109'])
+    epochs, station_ids, block = reader.query('temperature', start, end, as_frame=False)
+    for df in reader.iter_chunks('rainfall', start, end, chunk_size=100000):
+        ...
+
+Results are either a DataFrame (index: reading_time as a tz-aware DatetimeIndex, columns: station ids sorted by value after S prefix) or NumPy arrays (ts_epoch of each row, station ids, 2-D block of readings). Missing readings are NaN.
+
+start and end (both included) can be ISO strings as returned by the API, datetimes (naive ones are taken as Singapore time) or seconds since the Unix epoch. Either can be left out for an open-ended range.
+
+Both storage backends are served through indexes, so a single station-day is a small range scan:
+    'narrow': readings are looked up on (data_type, ts_epoch) (index readings_by_time), or on (data_type, station_id, ts_epoch) (primary key) when stations are given. ts_epoch is computed once, when the readings are written
+    'wide': rows are looked up on date_time (index {db_table_name}_date_time). All date_time strings carry the '+08:00' offset of the API, so their text order is their time order
+
+Hourly and daily aggregates (min/mean/max per station, and totals e.g. of rainfall) are read from the rollups table instead (Reader.rollups, see vault_rollup).
+
+Readings moved out of the database into an archive (see vault_archive) are read together with the database when the archive is passed to the Reader (Reader(..., archive=Archive('archive'))). Archived months are served from their memory-mapped partitions, one partition per chunk; readings also found in the database (e.g. late readings of an archived month) take precedence.
+
+"""
+
+sg_timezone = timezone(timedelta(hours=8))
+
+# Convert a bound of a time range (ISO string, datetime or epoch) into seconds since the Unix epoch
+def to_bound_epoch(bound):
+    if isinstance(bound, str):
+        bound = datetime.fromisoformat(bound)
+    if isinstance(bound, datetime):
+        if bound.tzinfo is None:
+            bound = bound.replace(tzinfo=sg_timezone)
+        return int(bound.timestamp())
+    return int(bound)
+
+## Merge blocks (epochs, station_ids, block) into one, over the union of their timestamps and stations (on overlaps, the readings of later blocks take precedence over earlier ones, except where they are missing)
+def merge_blocks(blocks):
+    epochs = np.unique(np.concatenate([np.asarray(block_epochs, dtype=np.int64) for block_epochs, _, _ in blocks]))
+    station_ids = sorted(set().union(*[block_station_ids for _, block_station_ids, _ in blocks]), key=station_sort_key)
+    station_index = {station_id: column_i for column_i, station_id in enumerate(station_ids)}
+
+    merged = np.full((len(epochs), len(station_ids)), np.nan)
+    for block_epochs, block_station_ids, block in blocks:
+        cells = np.ix_(np.searchsorted(epochs, block_epochs), [station_index[station_id] for station_id in block_station_ids])
+        block = np.asarray(block, dtype=float)
+        merged[cells] = np.where(np.isnan(block), merged[cells], block)
+    return epochs, station_ids, merged
+
+# Convert a bound of a time range into a date_time string of a wide table ('YYYY-MM-DDThh:mm:ss+08:00')
+def to_bound_date_time(bound):
+    return datetime.fromtimestamp(to_bound_epoch(bound), sg_timezone).isoformat()
+
+
+class Reader:
+    # Open the database at path_to_db for reading (storage: 'wide' or 'narrow', as used by the Collector that wrote it), together with an archive (vault_archive.Archive) of its cold history, if given
+    def __init__(self, path_to_db='vault.db', storage='narrow', archive=None):
+        if storage not in ('wide', 'narrow'):
+            raise ValueError(f"Unknown storage '{storage}' - Use 'wide' or 'narrow'!")
+        self.storage = storage
+        self.archive = archive
+        self.con = sl.connect(path_to_db)
+        self.con.execute("PRAGMA query_only = ON ;")
+
+    ## Get the readings of data_type (e.g. 'temperature') from start to end (both included), for stations (default: all)
+    ## Returns a DataFrame (as_frame=True) or (epochs, station_ids, block)
+    def query(self, data_type, start=None, end=None, stations=None, as_frame=True):
+        chunks = list(self._iter_blocks(data_type, start, end, stations, chunk_size=None))
+        if not chunks:
+            epochs, station_ids, block = np.empty(0, dtype=np.int64), list(), np.empty((0, 0))
+        elif len(chunks) == 1:
+            epochs, station_ids, block = chunks[0]
+        else:
+            epochs, station_ids, block = merge_blocks(chunks)
+        return self._to_frame(epochs, station_ids, block) if as_frame else (epochs, station_ids, block)
+
+    ## Stream the readings of data_type from start to end (both included), for stations (default: all), in chunks of about chunk_size readings (whole timestamps only)
+    ## Yields DataFrames (as_frame=True) or (epochs, station_ids, block)
+    def iter_chunks(self, data_type, start=None, end=None, stations=None, chunk_size=100000, as_frame=True):
+        for epochs, station_ids, block in self._iter_blocks(data_type, start, end, stations, chunk_size):
+            yield self._to_frame(epochs, station_ids, block) if as_frame else (epochs, station_ids, block)
+
+    ## Get the hourly or daily rollups (period: 'hour' or 'day', see vault_rollup) of data_type from start to end (both included), for stations (default: all)
+    ## Returns a DataFrame (index: bucket start as reading_time and station_id, columns: num_readings, total, mean, minimum, maximum)
+    def rollups(self, data_type, period='hour', start=None, end=None, stations=None):
+        sql = "SELECT bucket_epoch, station_id, num_readings, total, minimum, maximum FROM rollups WHERE series = ? AND period = ?"
+        params = [self._series(data_type), period]
+        if start is not None:
+            sql += " AND bucket_epoch >= ?"
+            params.append(to_bound_epoch(start))
+        if end is not None:
+            sql += " AND bucket_epoch <= ?"
+            params.append(to_bound_epoch(end))
+        if stations is not None:
+            stations = [station_id.strip() for station_id in stations]
+            sql += f" AND station_id IN ({', '.join('?' * len(stations))})"
+            params += stations
+        df = pd.read_sql(sql + " ORDER BY bucket_epoch ;", self.con, params=params)
+        df.insert(3, 'mean', df['total'] / df['num_readings'])
+        df['reading_time'] = pd.to_datetime(df.pop('bucket_epoch'), unit='s', utc=True).dt.tz_convert('Asia/Singapore')
+        return df.set_index(['reading_time', 'station_id'])
+
+    ## Get the ids of the stations with readings of data_type (in the database or the archive), sorted by value after S prefix
+    def station_ids(self, data_type):
+        if self.storage == 'narrow':
+            station_ids = {row[0] for row in self.con.execute("SELECT DISTINCT station_id FROM readings WHERE data_type = ? ;", (data_type,)).fetchall()}
+        else:
+            station_ids = set(self._wide_station_ids(data_type))
+        if self.archive is not None:
+            for partition in self.archive.partitions(self._series(data_type)):
+                station_ids.update(partition['station_ids'])
+        return sorted(station_ids, key=station_sort_key)
+
+    ## Get the station metadata stored by the narrow backend (index: station_id)
+    def stations(self):
+        if self.con.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'stations' ;").fetchone() is None:
+            return pd.DataFrame(columns=['device_id', 'name', 'latitude', 'longitude'], index=pd.Index([], name='station_id'))
+        return pd.read_sql("SELECT * FROM stations ;", self.con, index_col='station_id')
+
+    def close(self):
+        self.con.close()
+
+    # Get the series of data_type (as in the watermarks table)
+    def _series(self, data_type):
+        return f'readings/{data_type}' if self.storage == 'narrow' else data_type
+
+    # Yield (epochs, station_ids, block) of the readings in range, from the archive (one partition per block) and the database (in chunks of about chunk_size readings, all at once if chunk_size is None), in time order
+    def _iter_blocks(self, data_type, start, end, stations, chunk_size):
+        if self.archive is None:
+            yield from self._iter_db_blocks(data_type, start, end, stations, chunk_size)
+            return
+
+        start = None if start is None else to_bound_epoch(start)
+        end = None if end is None else to_bound_epoch(end)
+        cursor = start                  # Start of the range not served yet
+        for partition in self.archive.partitions(self._series(data_type), start, end):
+            # Readings in the database before the month of this partition
+            if cursor is None or cursor < partition['month_start']:
+                yield from self._iter_db_blocks(data_type, cursor, partition['month_start'] - 1, stations, chunk_size)
+
+            # The month of this partition, with any of its readings still in the database
+            month_start = partition['month_start'] if start is None else max(start, partition['month_start'])
+            month_end = partition['month_end'] - 1 if end is None else min(end, partition['month_end'] - 1)
+            blocks = [self.archive.read(partition, month_start, month_end, stations)]
+            blocks += list(self._iter_db_blocks(data_type, month_start, month_end, stations, None))
+            if len(blocks[0][0]) == 0:
+                blocks = blocks[1:]
+            if blocks:
+                yield blocks[0] if len(blocks) == 1 else merge_blocks(blocks)
+            cursor = partition['month_end']
+
+        # Readings in the database after the last partition
+        if cursor is None or end is None or cursor <= end:
+            yield from self._iter_db_blocks(data_type, cursor, end, stations, chunk_size)
+
+    # Yield (epochs, station_ids, block) of the readings in range in the database
+    def _iter_db_blocks(self, data_type, start, end, stations, chunk_size):
+        if self.storage == 'narrow':
+            yield from self._iter_narrow_blocks(data_type, start, end, stations, chunk_size)
+        else:
+            yield from self._iter_wide_blocks(data_type, start, end, stations, chunk_size)
+
+    # Narrow backend: fetch (ts_epoch, station_id, value) rows in time order and pivot them into blocks
+    def _iter_narrow_blocks(self, data_type, start, end, stations, chunk_size):
+        sql = "SELECT ts_epoch, station_id, value FROM readings WHERE data_type = ?"
+        params = [data_type]
+        if start is not None:
+            sql += " AND ts_epoch >= ?"
+            params.append(to_bound_epoch(start))
+        if end is not None:
+            sql += " AND ts_epoch <= ?"
+            params.append(to_bound_epoch(end))
+        if stations is not None:
+            stations = [station_id.strip() for station_id in stations]
+            sql += f" AND station_id IN ({', '.join('?' * len(stations))})"
+            params += stations
+        cur = self.con.execute(sql + " ORDER BY ts_epoch ;", params)
+
+        if chunk_size is None:
+            rows = cur.fetchall()
+            if rows:
+                yield self._pivot(rows)
+            return
+
+        # The last timestamp of a chunk may continue in the next one, so its rows are carried over
+        carry = list()
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            rows = carry + rows
+            last_epoch = rows[-1][0]
+            split = len(rows)
+            while split > 0 and rows[split - 1][0] == last_epoch:
+                split -= 1
+            if split == 0:
+                carry = rows
+                continue
+            carry = rows[split:]
+            yield self._pivot(rows[:split])
+        if carry:
+            yield self._pivot(carry)
+
+    # Wide backend: fetch (date_time, station columns...) rows in time order, one row per timestamp
+    def _iter_wide_blocks(self, data_type, start, end, stations, chunk_size):
+        station_ids = self._wide_station_ids(data_type)
+        if stations is not None:
+            wanted = {station_id.strip() for station_id in stations}
+            station_ids = [station_id for station_id in station_ids if station_id in wanted]
+        if not station_ids:
+            return
+
+        sql = f"SELECT date_time{''.join(f', {station_id}' for station_id in station_ids)} FROM {data_type} WHERE 1"
+        params = list()
+        if start is not None:
+            sql += " AND date_time >= ?"
+            params.append(to_bound_date_time(start))
+        if end is not None:
+            sql += " AND date_time <= ?"
+            params.append(to_bound_date_time(end))
+        cur = self.con.execute(sql + " ORDER BY date_time ;", params)
+
+        rows_per_chunk = None if chunk_size is None else max(1, chunk_size // max(1, len(station_ids)))
+        while True:
+            rows = cur.fetchall() if rows_per_chunk is None else cur.fetchmany(rows_per_chunk)
+            if not rows:
+                break
+            epochs = np.array([to_bound_epoch(row[0]) for row in rows], dtype=np.int64)
+            block = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(station_ids))          # Stored as TEXT (or NULL) - converted to float (NaN)
+            yield epochs, station_ids, block
+            if rows_per_chunk is None:
+                break
+
+    # Get the station columns of the wide table of data_type (empty if the table does not exist)
+    def _wide_station_ids(self, data_type):
+        cols = [col[1] for col in self.con.execute(f"PRAGMA table_info({data_type}) ;").fetchall()]
+        return sorted(cols[2:], key=station_sort_key)
+
+    # Pivot (ts_epoch, station_id, value) rows (sorted by ts_epoch) into (epochs, station_ids, block)
+    @staticmethod
+    def _pivot(rows):
+        row_epochs, row_station_ids, row_values = zip(*rows)
+        epochs, row_i = np.unique(np.array(row_epochs, dtype=np.int64), return_inverse=True)
+        station_ids = sorted(set(row_station_ids), key=station_sort_key)
+        station_index = {station_id: column_i for column_i, station_id in enumerate(station_ids)}
+        col_i = np.fromiter((station_index[station_id] for station_id in row_station_ids), dtype=np.int64, count=len(row_station_ids))
+
+        block = np.full((len(epochs), len(station_ids)), np.nan)
+        block[row_i, col_i] = np.array(row_values, dtype=float)
+        return epochs, station_ids, block
+
+    # Build a DataFrame (index: reading_time in Singapore time, columns: station ids) from a block
+    @staticmethod
+    def _to_frame(epochs, station_ids, block):
+        index = pd.DatetimeIndex(pd.to_datetime(epochs, unit='s', utc=True).tz_convert('Asia/Singapore'), name='reading_time')
+        return pd.DataFrame(block, index=index, columns=list(station_ids))
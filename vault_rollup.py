@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+import argparse
+from datetime import datetime, timedelta, timezone
+from vault_metrics import metrics
+from vault_parse import station_sort_key
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+Rollups are hourly and daily aggregates (per station) of the readings in the database, kept up to date as readings are written, so that long-range queries read one row per station-hour or station-day instead of every 5-minute reading.
+
+rollups =
+    series          TEXT        (as in the watermarks table: the db_table_name of a wide table, or 'readings/{data_type}' for the narrow readings table)
+    period          TEXT        ('hour' or 'day', in Singapore time)
+    bucket_epoch    INTEGER     (start of the hour/day as seconds since the Unix epoch)
+    station_id      TEXT
+    num_readings    INTEGER
+    total           REAL        (e.g. the rainfall total of the hour/day)
+    minimum         REAL
+    maximum         REAL
+    PRIMARY KEY (series, period, bucket_epoch, station_id)
+
+The mean of a bucket is total / num_readings.
+
+Every write of readings (Collector._send_to_wide_db, NarrowStore.write_block) calls update_rollups in the same transaction as the readings, with the timestamps written: wide rows are inserted on the connection of the write (weather_vault.insert_wide_rows), not committed on their own, so a write that fails leaves neither its readings nor their rollups behind. The hours those timestamps fall in are recomputed from the raw rows, then the days they fall in are recomputed from the hour rows. Since buckets are recomputed rather than incremented, late readings (a bucket written again later) and duplicate readings (upserted in narrow tables, repeated rows of the same date_time in wide tables, of which the last one counts) always leave them correct.
+
+Rollups of readings written before this module existed (or of a database edited by hand) are rebuilt with:
+
+Usage: python vault_rollup.py --db vault.db [--series temperature readings/rainfall]
+
+"""
+
+hour, day = 3600, 86400
+sg_offset = 8 * 3600                # Buckets start on the hour/midnight in Singapore time (UTC+8)
+sg_timezone = timezone(timedelta(hours=8))
+narrow_prefix = 'readings/'
+
+create_rollups_table = """
+    CREATE TABLE IF NOT EXISTS rollups (
+        series TEXT NOT NULL,
+        period TEXT NOT NULL,
+        bucket_epoch INTEGER NOT NULL,
+        station_id TEXT NOT NULL,
+        num_readings INTEGER NOT NULL,
+        total REAL,
+        minimum REAL,
+        maximum REAL,
+        PRIMARY KEY (series, period, bucket_epoch, station_id) ) WITHOUT ROWID ;
+    """
+
+# Get the start of the bucket (hour or day, as seconds) each epoch falls in
+def bucket_of(epochs, period_seconds):
+    return (np.asarray(epochs, dtype=np.int64) + sg_offset) // period_seconds * period_seconds - sg_offset
+
+# Group sorted unique bucket starts into runs of consecutive buckets, as [start, end) ranges
+def bucket_runs(buckets, period_seconds):
+    buckets = np.unique(buckets)
+    if len(buckets) == 0:
+        return list()
+    breaks = np.nonzero(np.diff(buckets) != period_seconds)[0]
+    starts = np.concatenate(([buckets[0]], buckets[breaks + 1]))
+    ends = np.concatenate((buckets[breaks], [buckets[-1]])) + period_seconds
+    return list(zip(starts.tolist(), ends.tolist()))
+
+# Convert seconds since the Unix epoch into a date_time string of a wide table ('YYYY-MM-DDThh:mm:ss+08:00')
+def to_date_time(epoch):
+    return datetime.fromtimestamp(epoch, sg_timezone).isoformat()
+
+## Recompute the rollups of series for the hours and days the readings at epochs (seconds since the Unix epoch) fall in
+def update_rollups(cur, series, epochs):
+    with metrics.timer('vault_stage_seconds', stage='rollup', data_type=series.split('/')[-1]):
+        cur.execute(create_rollups_table)
+        hours = bucket_of(epochs, hour)
+        for start, end in bucket_runs(hours, hour):
+            _recompute_hours(cur, series, start, end)
+        for start, end in bucket_runs(bucket_of(hours, day), day):
+            _recompute_days(cur, series, start, end)
+
+# Recompute the hour rows of series in [start, end) from the raw readings
+def _recompute_hours(cur, series, start, end):
+    cur.execute("DELETE FROM rollups WHERE series = ? AND period = 'hour' AND bucket_epoch >= ? AND bucket_epoch < ? ;", (series, start, end))
+    if series.startswith(narrow_prefix):
+        cur.execute(f"""
+            INSERT INTO rollups (series, period, bucket_epoch, station_id, num_readings, total, minimum, maximum)
+            SELECT ?, 'hour', (ts_epoch + {sg_offset}) / {hour} * {hour} - {sg_offset} AS bucket_epoch, station_id, COUNT(value), SUM(value), MIN(value), MAX(value)
+            FROM readings WHERE data_type = ? AND ts_epoch >= ? AND ts_epoch < ? AND value IS NOT NULL
+            GROUP BY bucket_epoch, station_id ;
+            """, (series, series[len(narrow_prefix):], start, end))
+    else:
+        cur.executemany("INSERT INTO rollups (series, period, bucket_epoch, station_id, num_readings, total, minimum, maximum) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ;",
+                        _wide_hour_rows(cur, series, start, end))
+
+# Recompute the day rows of series in [start, end) from its hour rows
+def _recompute_days(cur, series, start, end):
+    cur.execute("DELETE FROM rollups WHERE series = ? AND period = 'day' AND bucket_epoch >= ? AND bucket_epoch < ? ;", (series, start, end))
+    cur.execute(f"""
+        INSERT INTO rollups (series, period, bucket_epoch, station_id, num_readings, total, minimum, maximum)
+        SELECT series, 'day', (bucket_epoch + {sg_offset}) / {day} * {day} - {sg_offset} AS day_epoch, station_id, SUM(num_readings), SUM(total), MIN(minimum), MAX(maximum)
+        FROM rollups WHERE series = ? AND period = 'hour' AND bucket_epoch >= ? AND bucket_epoch < ?
+        GROUP BY day_epoch, station_id ;
+        """, (series, start, end))
+
+# Aggregate the rows of the wide table db_table_name in [start, end) into hour rows (series, 'hour', bucket_epoch, station_id, num_readings, total, minimum, maximum)
+def _wide_hour_rows(cur, db_table_name, start, end):
+    epochs, station_ids, block = read_wide_block(cur, db_table_name, start, end)
+    if len(epochs) == 0:
+        return list()
+
+    # Aggregate the rows of every hour at once (rows are in time order, so each hour is a contiguous slice)
+    buckets = bucket_of(epochs, hour)
+    bucket_starts, first_i = np.unique(buckets, return_index=True)
+    present = ~np.isnan(block)
+    counts = np.add.reduceat(present, first_i, axis=0)
+    totals = np.add.reduceat(np.where(present, block, 0.0), first_i, axis=0)
+    minimums = np.fmin.reduceat(block, first_i, axis=0)
+    maximums = np.fmax.reduceat(block, first_i, axis=0)
+
+    bucket_i, station_i = np.nonzero(counts)
+    return zip([db_table_name] * len(bucket_i), ['hour'] * len(bucket_i), bucket_starts[bucket_i].tolist(), [station_ids[i] for i in station_i],
+               counts[bucket_i, station_i].tolist(), totals[bucket_i, station_i].tolist(), minimums[bucket_i, station_i].tolist(), maximums[bucket_i, station_i].tolist())
+
+## Read the rows of the wide table db_table_name in [start, end) (epochs) as (epochs, station_ids, block), in time order
+## A repeated date_time keeps its last row (a repeated timestamp replaces the earlier one)
+def read_wide_block(cur, db_table_name, start, end):
+    station_ids = [col[1] for col in cur.execute(f"PRAGMA table_info({db_table_name}) ;").fetchall()][2:]           # First two columns from left are entry_id and date_time
+    rows = list()
+    if station_ids:
+        rows = cur.execute(f"SELECT date_time{''.join(f', {station_id}' for station_id in station_ids)} FROM {db_table_name} WHERE date_time >= ? AND date_time < ? ORDER BY entry_id ;",
+                           (to_date_time(start), to_date_time(end))).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), station_ids, np.empty((0, len(station_ids)))
+
+    epochs = np.array([int(datetime.fromisoformat(row[0]).timestamp()) for row in rows], dtype=np.int64)
+    block = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(station_ids))          # Stored as TEXT (or NULL) - converted to float (NaN)
+    epochs, last_i = np.unique(epochs[::-1], return_index=True)
+    return epochs, station_ids, block[::-1][last_i]
+
+## Read the readings of data_type (a data type of the narrow readings table, or a wide table) in [start, end) (epochs) as (epochs, station_ids, block), in time order (empty if there are none)
+def read_block(cur, data_type, start, end, storage):
+    if storage == 'narrow':
+        if cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'readings'").fetchone() is None:
+            return np.empty(0, dtype=np.int64), list(), np.empty((0, 0))
+        rows = cur.execute("SELECT ts_epoch, station_id, value FROM readings WHERE data_type = ? AND ts_epoch >= ? AND ts_epoch < ? ;", (data_type, start, end)).fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), list(), np.empty((0, 0))
+        row_epochs, row_station_ids, values = zip(*rows)
+        epochs, row_i = np.unique(np.array(row_epochs, dtype=np.int64), return_inverse=True)
+        station_ids = sorted(set(row_station_ids), key=station_sort_key)
+        station_index = {station_id: column_i for column_i, station_id in enumerate(station_ids)}
+        block = np.full((len(epochs), len(station_ids)), np.nan)
+        block[row_i, [station_index[station_id] for station_id in row_station_ids]] = np.array(values, dtype=float)
+        return epochs, station_ids, block
+
+    if cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (data_type,)).fetchone() is None:
+        return np.empty(0, dtype=np.int64), list(), np.empty((0, 0))
+    return read_wide_block(cur, data_type, start, end)
+
+# Get every series in the database (wide tables, and the data types of the narrow readings table) with its first and last reading as epochs
+def series_ranges(cur):
+    ranges = dict()
+    tables = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' ;").fetchall()]
+    for table in tables:
+        cols = [col[1] for col in cur.execute(f"PRAGMA table_info({table}) ;").fetchall()]
+        if cols[:2] == ['entry_id', 'date_time']:
+            first, last = cur.execute(f"SELECT MIN(date_time), MAX(date_time) FROM {table} ;").fetchone()
+            if first is not None:
+                ranges[table] = (int(datetime.fromisoformat(first).timestamp()), int(datetime.fromisoformat(last).timestamp()))
+    if 'readings' in tables:
+        for data_type, first, last in cur.execute("SELECT data_type, MIN(ts_epoch), MAX(ts_epoch) FROM readings GROUP BY data_type ;").fetchall():
+            ranges[f'{narrow_prefix}{data_type}'] = (first, last)
+    return ranges
+
+## Rebuild the rollups of series (default: every series in the database) from the raw readings, a window of window_days days per transaction
+def rebuild(con, series=None, window_days=30):
+    cur = con.cursor()
+    with con:
+        cur.execute(create_rollups_table)
+    ranges = series_ranges(cur)
+    for name in (series if series is not None else sorted(ranges)):
+        with con:
+            cur.execute("DELETE FROM rollups WHERE series = ? ;", (name,))
+        if name not in ranges:
+            print(f"No readings of {name} in database - nothing to roll up.")
+            continue
+        first, last = ranges[name]
+        for start in range(int(bucket_of(first, day)), last + 1, window_days * day):
+            with con:
+                _recompute_hours(cur, name, start, start + window_days * day)
+                _recompute_days(cur, name, start, start + window_days * day)
+        num_rows = cur.execute("SELECT COUNT(*) FROM rollups WHERE series = ? ;", (name,)).fetchone()[0]
+        print(f"Rebuilt {num_rows} rollup rows of {name}.")
+
+
+if __name__ == '__main__':
+    from vault_store import connect
+
+    parser = argparse.ArgumentParser(description="Rebuild the hourly/daily rollups of the readings in the database.")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--series', nargs='+', default=None, help="series to rebuild, e.g. temperature (wide table) or readings/temperature (narrow) (default: all)")
+    parser.add_argument('--window-days', type=int, default=30, help="days of readings recomputed per transaction")
+    args = parser.parse_args()
+
+    con = connect(args.db)
+    try:
+        rebuild(con, series=args.series, window_days=args.window_days)
+    finally:
+        con.close()
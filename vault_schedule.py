@@ -0,0 +1,40 @@
+#!/usr/bin/python
+
+import time
+from vault_store import to_epoch
+
+"""
+
+PollScheduler object is used to decide how long a Collector should wait before its next poll of the API.
+
+Although the NEA API claims a 1 min refresh, reading_time is reported in 5 min intervals (for all data types), so polling every ping_interval seconds mostly returns the same reading again. Instead:
+    1) After a new reading, sleep until shortly (lag seconds) after the next expected reading_time (reading_time + cadence)
+    2) If the poll still returns the same reading (the new one is late), retry after retry_interval seconds, doubling on every further miss up to max_retry_interval
+
+A reading published within lag seconds of its reading_time is then collected by the first poll after it (roughly 1 poll per 5 min, instead of 5 polls with a 60 s ping_interval), and a later one within a few short retries.
+
+"""
+
+class PollScheduler:
+    def __init__(self, cadence=300, lag=15, retry_interval=5, max_retry_interval=60):
+        self.cadence = cadence                          # Seconds between reading_times
+        self.lag = lag                                  # Seconds after the expected reading_time before polling (the API publishes readings a little after their reading_time)
+        self.retry_interval = retry_interval            # Seconds before the first retry, when a poll returns the same reading
+        self.max_retry_interval = max_retry_interval    # Upper bound on the (doubling) retry interval
+        self.misses = 0                                 # Number of polls in a row that returned the same reading
+
+    ## Seconds to wait before the next poll, given the reading_time of the latest reading and whether the latest poll returned a new reading
+    def next_delay(self, last_reading_time, new_reading, now=None):
+        now = time.time() if now is None else now
+        if new_reading:
+            self.misses = 0
+        else:
+            self.misses += 1
+
+        # Sleep until shortly after the next expected reading_time, if it is still ahead
+        next_poll = to_epoch(last_reading_time) + self.cadence + self.lag
+        if next_poll > now:
+            return next_poll - now
+
+        # The next reading is due (or late): retry soon, backing off on repeated misses
+        return min(self.retry_interval * 2 ** max(self.misses - 1, 0), self.max_retry_interval)
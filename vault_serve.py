@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from vault_derived import derived_types
+from vault_parse import dumps
+from vault_reader import Reader, merge_blocks
+from vault_rollup import to_date_time
+from vault_store import connect, read_watermark, to_epoch
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+LatestCache object keeps the latest readings of every data type in memory, for serving "current conditions" without touching the database or the API:
+    the latest reading of every station (and its reading_time)
+    a rolling window of the last window_seconds of readings, as NumPy arrays (epochs, station ids, readings)
+
+Collectors given a cache (Collector.cache, or Engine(cache=...)) update it with every new entry, as it is collected, and with the derived readings (wind_u, wind_v, heat_index, see vault_derived) of every write, once committed. The JSON of every endpoint is encoded once per update (vault_parse.dumps, orjson when installed), so a request is a dict lookup and a write of bytes that are already encoded.
+
+Read-through: a data type that has not been collected since the cache was created is loaded from the database (the window before its watermark) on its first request, then served from memory. A data type without readings is looked up again at most every retry_seconds.
+
+serve() answers, from a background thread:
+
+    GET /latest                     latest reading of every station, for every data type in the cache
+    GET /latest/{data_type}         latest reading of every station of data_type, e.g. /latest/temperature
+    GET /window/{data_type}         the rolling window of data_type: reading_times, station_ids, and values (rows: reading_times, null for missing readings)
+
+    cache = LatestCache(path_to_db='vault.db', storage='narrow')
+    server = serve(cache, port=9106)                                # server.shutdown() stops it
+    Engine(cache=cache).run_sync(...)
+
+Usage: python vault_serve.py --db vault.db --storage narrow --port 9106           (serves the readings stored by another process, refreshed every --refresh seconds)
+
+"""
+
+data_types = ['temperature', 'rainfall', 'relative_humidity', 'wind_direction', 'wind_speed'] + derived_types
+
+
+class LatestCache:
+    # Keep window_seconds of readings per data type. With path_to_db, data types not collected yet are read through from the database (stored with storage).
+    def __init__(self, window_seconds=3600, path_to_db=None, storage='narrow', retry_seconds=60):
+        self.window_seconds = window_seconds
+        self.path_to_db = path_to_db
+        self.storage = storage
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()          # Concurrent first requests of a data type wait for its read-through, rather than finding nothing to serve
+        self.windows = dict()                       # Type: dict. data_type -> (epochs, station_ids, block, reading_unit)
+        self.bodies = dict()                        # Type: dict. path (e.g. '/latest/temperature') -> encoded JSON
+        self.latest = dict()                        # Type: dict. data_type -> latest readings (as served by /latest/{data_type})
+        self._looked_up = dict()                    # Type: dict. data_type -> time of the last read-through
+
+    ## Add readings of data_type (rows: reading_times, columns: station_ids) to the cache, dropping readings older than the window
+    def update(self, data_type, reading_times, station_ids, block, reading_unit=None):
+        epochs = np.fromiter((to_epoch(reading_time) for reading_time in reading_times), dtype=np.int64, count=len(reading_times))
+        self._update(data_type, epochs, station_ids, np.asarray(block, dtype=float), reading_unit)
+
+    ## Add derived readings (as written by a write of their inputs: (derived data type, epochs, station_ids, block), see vault_derived.derive) to the cache
+    def update_derived(self, derived):
+        for derived_type, epochs, station_ids, block in derived:
+            self._update(derived_type, np.asarray(epochs, dtype=np.int64), station_ids, np.asarray(block, dtype=float), None)
+
+    ## Get the encoded JSON of path (None if there is nothing to serve at path), reading through from the database if the data type is not cached yet
+    def body(self, path):
+        body = self.bodies.get(path)
+        if body is None and self.path_to_db is not None:
+            data_type = path.rsplit('/', 1)[-1]
+            if data_type in data_types and data_type not in self.windows:
+                self.load(data_type)
+                body = self.bodies.get(path)
+        return body
+
+    ## Load the window before the watermark of data_type from the database (at most once every retry_seconds)
+    def load(self, data_type):
+        with self._load_lock:
+            now = time.time()
+            if now - self._looked_up.get(data_type, 0) < self.retry_seconds:
+                return
+            self._looked_up[data_type] = now
+            self._load(data_type)
+
+    # Read the window before the watermark of data_type from the database into the cache
+    # Derived series are stored in the narrow readings table whatever the storage of their inputs (see vault_derived)
+    def _load(self, data_type):
+        storage = 'narrow' if data_type in derived_types else self.storage
+        con = connect(self.path_to_db)
+        try:
+            last_stored = read_watermark(con.cursor(), f'readings/{data_type}' if storage == 'narrow' else data_type)
+        finally:
+            con.close()
+        if last_stored is None:
+            return
+        last_epoch = to_epoch(last_stored)
+        reader = Reader(self.path_to_db, storage=storage)
+        try:
+            epochs, station_ids, block = reader.query(data_type, last_epoch - self.window_seconds + 1, last_epoch, as_frame=False)
+        finally:
+            reader.close()
+        if len(epochs) != 0:
+            self._update(data_type, np.asarray(epochs, dtype=np.int64), station_ids, block, None)
+
+    # Merge readings into the window of data_type, then encode the endpoints that depend on it
+    def _update(self, data_type, epochs, station_ids, block, reading_unit):
+        if len(epochs) == 0:
+            return
+        with self._lock:
+            window = self.windows.get(data_type)
+            if window is not None:
+                epochs, station_ids, block = merge_blocks([window[:3], (epochs, station_ids, block)])
+                reading_unit = reading_unit or window[3]
+            else:
+                order = np.argsort(epochs, kind='stable')
+                epochs, station_ids, block = epochs[order], list(station_ids), block[order]
+            keep = epochs > epochs[-1] - self.window_seconds
+            epochs, block = epochs[keep], block[keep]
+            self.windows[data_type] = (epochs, station_ids, block, reading_unit)
+
+            # Latest reading of every station: its last non-missing row in the window
+            present = ~np.isnan(block)
+            last_i = len(epochs) - 1 - np.argmax(present[::-1], axis=0)
+            reading_times = [to_date_time(epoch) for epoch in epochs.tolist()]
+            self.latest[data_type] = {
+                'data_type': data_type,
+                'reading_unit': reading_unit,
+                'reading_time': reading_times[-1],
+                'stations': {station_id: {'value': float(block[row_i, column_i]), 'reading_time': reading_times[row_i]}
+                             for column_i, (station_id, row_i) in enumerate(zip(station_ids, last_i.tolist())) if present[row_i, column_i]},
+                }
+            bodies = {
+                f'/latest/{data_type}': dumps(self.latest[data_type]),
+                f'/window/{data_type}': dumps({'data_type': data_type, 'reading_unit': reading_unit, 'reading_times': reading_times, 'station_ids': list(station_ids),
+                                               'values': np.where(present, block, None).tolist()}),
+                '/latest': dumps(self.latest),
+                }
+            self.bodies.update(bodies)
+
+
+## Serve cache (GET /latest, /latest/{data_type}, /window/{data_type}) from a background thread. Returns the server (server.shutdown() stops it).
+def serve(cache, host='127.0.0.1', port=9106):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'               # Keep-alive: clients polling often reuse their connection
+        disable_nagle_algorithm = True              # Headers and body are written separately: without TCP_NODELAY, the body waits for the delayed ACK of the headers (~40 ms)
+
+        def do_GET(self):
+            body = cache.body(self.path.split('?')[0].rstrip('/'))
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass                                    # Requests are not printed
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='LatestCacheServer', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the latest readings stored in the database over a local HTTP/JSON API.")
+    parser.add_argument('--db', default='vault.db', help="path to the database")
+    parser.add_argument('--storage', default='narrow', choices=['wide', 'narrow'], help="storage backend")
+    parser.add_argument('--port', type=int, default=9106, help="local port to serve on (default: 9106)")
+    parser.add_argument('--window-seconds', type=int, default=3600, help="rolling window kept per data type (default: 3600)")
+    parser.add_argument('--refresh', type=int, default=60, help="seconds between reloads of the latest readings from the database (default: 60)")
+    args = parser.parse_args()
+
+    cache = LatestCache(window_seconds=args.window_seconds, path_to_db=args.db, storage=args.storage, retry_seconds=max(args.refresh - 1, 0))
+    server = serve(cache, port=args.port)
+    print(f"Serving the latest readings of {args.db} at http://127.0.0.1:{args.port}/latest")
+    try:
+        while True:
+            for data_type in data_types:
+                cache.load(data_type)
+            time.sleep(args.refresh)
+    except KeyboardInterrupt:
+        server.shutdown()
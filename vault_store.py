@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+import os
+import hashlib
+import sqlite3 as sl
+from datetime import datetime
+from vault_rollup import to_date_time, update_rollups
+from vault_derived import derive
+from vault_quality import quality_filter
+from vault_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+"""
+
+NarrowStore object is an optional storage backend for the Collector. Instead of one wide table per data type (one TEXT column per station), readings of all data types are kept in a single long-format table, with the station metadata kept in a separate table.
+
+readings =
+    data_type   TEXT        (e.g. 'temperature', i.e. the data_name of the Collector)
+    station_id  TEXT        (e.g. 'S109')
+    ts_epoch    INTEGER     (reading_time as seconds since the Unix epoch)
+    value       REAL
+    flags       INTEGER     (data-quality flags of the reading, 0 if none, see vault_quality)
+    PRIMARY KEY (data_type, station_id, ts_epoch)
+
+stations =                  (also written for wide tables)
+    station_id  TEXT PRIMARY KEY
+    device_id   TEXT
+    name        TEXT
+    latitude    REAL
+    longitude   REAL
+
+New stations therefore never change the schema, values are stored as numbers, and every flush is a single transaction of batched upserts (which also checks the readings and records the gaps before them, see vault_quality, brings the hourly/daily rollups of the data type up to date, see vault_rollup, and computes the derived series it is an input of, see vault_derived).
+
+StationRegistry object (station_registry) remembers which station sets are already in the database, so that the station set of a flush is only checked against the database when it changes (which is rare):
+    wide tables: the station columns of each table (series: its db_table_name), so the schema checks of Collector._send_to_wide_db are skipped
+    narrow storage: the station metadata of each data type last upserted into the stations table (series: 'stations/{data_type}'), so the metadata is not upserted again
+
+It is kept both in the station_registry table (one row per series: hash of the station set, and its station ids) and in process, as the hashes of the station sets known to be registered per database and series.
+
+"""
+
+# Watermarks: the last stored reading_time of every series, so that the latest entry of a table can be looked up without scanning it
+# A series is either a wide table (keyed by its db_table_name) or a data type in the narrow readings table (keyed by 'readings/{data_type}')
+create_watermarks_table = """
+    CREATE TABLE IF NOT EXISTS watermarks (
+        series TEXT NOT NULL PRIMARY KEY,
+        last_date_time TEXT NOT NULL,
+        last_ts_epoch INTEGER NOT NULL ) ;
+    """
+
+# Get the last stored reading_time of a series (None if nothing has been stored yet)
+def read_watermark(cur, series):
+    cur.execute(create_watermarks_table)
+    row = cur.execute("SELECT last_date_time FROM watermarks WHERE series = ?", (series,)).fetchone()
+    return row[0] if row else None
+
+# Move the watermark of a series forward to reading_time (never backwards, so late readings do not hide newer ones)
+def write_watermark(cur, series, reading_time):
+    cur.execute(create_watermarks_table)
+    cur.execute("""
+        INSERT INTO watermarks (series, last_date_time, last_ts_epoch) VALUES (?, ?, ?)
+        ON CONFLICT (series) DO UPDATE SET last_date_time = excluded.last_date_time, last_ts_epoch = excluded.last_ts_epoch
+        WHERE excluded.last_ts_epoch >= watermarks.last_ts_epoch ;
+        """, (series, reading_time, to_epoch(reading_time)))
+
+# Registered station set of every series (see StationRegistry)
+create_station_registry_table = """
+    CREATE TABLE IF NOT EXISTS station_registry (
+        series TEXT NOT NULL PRIMARY KEY,
+        station_hash TEXT NOT NULL,
+        station_ids TEXT NOT NULL,
+        updated_epoch INTEGER NOT NULL ) ;
+    """
+
+# Hash of a station set: a list of station ids (e.g. the columns of a DataFrame), or the 'metadata' -> 'stations' list of the API (ids, names and locations)
+def station_hash(stations):
+    return hashlib.blake2b(repr(stations).encode(), digest_size=16).hexdigest()
+
+
+class StationRegistry:
+    def __init__(self):
+        self._known = dict()                # Type: dict. (database, series) -> hashes of the station sets known to be registered
+
+    ## Whether the station set (station_hash) of series is known to be registered in the database at path_to_db, without querying the database
+    def known(self, path_to_db, series, set_hash):
+        return set_hash in self._known.get((os.path.abspath(path_to_db), series), ())
+
+    ## Whether the station set (station_hash) of series is the one in the persisted registry or, with station_ids, whether every station of station_ids is registered (remembered in process if so)
+    def check(self, cur, path_to_db, series, set_hash, station_ids=None):
+        cur.execute(create_station_registry_table)
+        row = cur.execute("SELECT station_hash, station_ids FROM station_registry WHERE series = ?", (series,)).fetchone()
+        if row is None or (row[0] != set_hash and (station_ids is None or not set(station_ids).issubset(row[1].split(',')))):
+            return False
+        self.remember(path_to_db, series, set_hash)
+        return True
+
+    ## Register the station set of series (station_ids: every station of the series in the database, e.g. all the columns of a wide table)
+    ## Written with cur, so it is committed together with the change it records. Call remember once committed.
+    def register(self, cur, path_to_db, series, set_hash, station_ids):
+        cur.execute(create_station_registry_table)
+        cur.execute("""
+            INSERT INTO station_registry (series, station_hash, station_ids, updated_epoch) VALUES (?, ?, ?, strftime('%s', 'now'))
+            ON CONFLICT (series) DO UPDATE SET station_hash = excluded.station_hash, station_ids = excluded.station_ids, updated_epoch = excluded.updated_epoch ;
+            """, (series, set_hash, ','.join(station_ids)))
+        self._known.pop((os.path.abspath(path_to_db), series), None)         # Older station sets may no longer be covered (e.g. changed metadata)
+
+    ## Forget the station sets of series (e.g. its table was just created), in process and in the database
+    def forget(self, cur, path_to_db, series):
+        cur.execute(create_station_registry_table)
+        cur.execute("DELETE FROM station_registry WHERE series = ?", (series,))
+        self._known.pop((os.path.abspath(path_to_db), series), None)
+
+    ## Remember that the station set (station_hash) of series is registered in the database at path_to_db
+    def remember(self, path_to_db, series, set_hash):
+        self._known.setdefault((os.path.abspath(path_to_db), series), set()).add(set_hash)
+
+
+# Registry of the station sets of every database written by this process
+station_registry = StationRegistry()
+
+# Station metadata of every data type (stored by both storage backends, e.g. for the station locations used by vault_grid)
+create_stations_table = """
+    CREATE TABLE IF NOT EXISTS stations (
+        station_id TEXT NOT NULL PRIMARY KEY,
+        device_id TEXT,
+        name TEXT,
+        latitude REAL,
+        longitude REAL ) ;
+    """
+upsert_station = """
+    INSERT INTO stations (station_id, device_id, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (station_id) DO UPDATE SET device_id = excluded.device_id, name = excluded.name, latitude = excluded.latitude, longitude = excluded.longitude ;
+    """
+
+# Flatten the 'metadata' -> 'stations' list of the API into rows of the stations table
+def station_rows(stations):
+    for station in stations:
+        location = station.get('location') or dict()
+        yield (station['id'].strip(), station.get('device_id'), station.get('name'), location.get('latitude'), location.get('longitude'))
+
+# Upsert the station metadata (the 'metadata' -> 'stations' list of the API) of data_type into the stations table, unless it is the metadata last upserted for data_type (see StationRegistry)
+# Returns what to pass to station_registry.remember once the transaction is committed: (series, station_hash), or None if nothing was upserted
+def write_stations(cur, path_to_db, data_type, stations):
+    set_hash, series = station_hash(stations), f'stations/{data_type}'
+    if station_registry.known(path_to_db, series, set_hash) or station_registry.check(cur, path_to_db, series, set_hash):
+        return None
+    rows = list(station_rows(stations))
+    cur.execute(create_stations_table)
+    cur.executemany(upsert_station, rows)
+    station_registry.register(cur, path_to_db, series, set_hash, [row[0] for row in rows])
+    return series, set_hash
+
+# Databases whose readings table is known to have the flags column (see NarrowStore.__init__)
+_flags_checked = set()
+
+# Open a connection to the database at path_to_db, with WAL journaling (readers are not blocked by the writer, and each commit only appends to the log)
+def connect(path_to_db='vault.db'):
+    con = sl.connect(path_to_db)
+    con.execute("PRAGMA journal_mode = WAL ;")
+    con.execute("PRAGMA synchronous = NORMAL ;")            # Safe with WAL: a crash may lose the last commits, but never corrupts the database
+    return con
+
+# Index the date_time column of a wide table, for time-range queries (see vault_reader) and timestamp lookups (see vault_backfill)
+# date_time strings all share the '+08:00' offset of the API, so their text order is their time order
+def index_wide_table(cur, db_table_name):
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {db_table_name}_date_time ON {db_table_name} (date_time) ;")
+
+# Convert a reading_time string (format: 'YYYY-MM-DDThh:mm:ss+hh:mm') into seconds since the Unix epoch
+def to_epoch(reading_time):
+    return int(datetime.fromisoformat(reading_time).timestamp())
+
+
+class NarrowStore:
+    create_readings_table = """
+        CREATE TABLE IF NOT EXISTS readings (
+            data_type TEXT NOT NULL,
+            station_id TEXT NOT NULL,
+            ts_epoch INTEGER NOT NULL,
+            value REAL,
+            flags INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (data_type, station_id, ts_epoch) ) WITHOUT ROWID ;
+        """
+    create_stations_table = create_stations_table
+    # Time-range queries over all stations of a data type (the primary key already serves queries by station)
+    create_time_index = """
+        CREATE INDEX IF NOT EXISTS readings_by_time ON readings (data_type, ts_epoch) ;
+        """
+    upsert_reading = """
+        INSERT INTO readings (data_type, station_id, ts_epoch, value, flags) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (data_type, station_id, ts_epoch) DO UPDATE SET value = excluded.value, flags = excluded.flags ;
+        """
+
+    # Open (or create) the database at path_to_db (or use an open connection, con) and make sure the narrow tables exist
+    def __init__(self, path_to_db='vault.db', con=None):
+        self.path_to_db = path_to_db
+        self.con = con if con is not None else connect(path_to_db)
+        self.cur = self.con.cursor()
+        with self.con:
+            self.cur.execute(self.create_readings_table)
+            self.cur.execute(self.create_time_index)
+            self.cur.execute(self.create_stations_table)
+            self.cur.execute(create_watermarks_table)
+            # Readings tables created before quality flags existed get the flags column (every reading unflagged), once per database and process
+            if os.path.abspath(path_to_db) not in _flags_checked:
+                if 'flags' not in [col[1] for col in self.cur.execute("PRAGMA table_info(readings) ;").fetchall()]:
+                    self.cur.execute("ALTER TABLE readings ADD COLUMN flags INTEGER NOT NULL DEFAULT 0 ;")
+                _flags_checked.add(os.path.abspath(path_to_db))
+
+    ## Upsert a DataFrame built by Collector.build_df (index: reading_time, columns: station ids) into the readings table, together with the station metadata (if given), in a single transaction
+    def write_df(self, data_type, df, stations=None, cache=None):
+        return self.write_block(data_type, list(df.index), list(df.columns), df.to_numpy(dtype=float), stations=stations, cache=cache)
+
+    ## Upsert a block of readings (rows: reading_times, columns: station_ids, e.g. from vault_parse.parse_items) into the readings table, together with the station metadata (if given), in a single transaction
+    ## The station metadata is only upserted when it differs from the metadata last upserted (see StationRegistry)
+    ## With a cache (vault_serve.LatestCache), the derived readings written are added to it once committed
+    def write_block(self, data_type, reading_times, station_ids, block, stations=None, cache=None):
+        epochs = np.array([to_epoch(reading_time) for reading_time in reading_times], dtype=np.int64)
+        registered = None
+        with self.con:
+            if stations:
+                registered = write_stations(self.cur, self.path_to_db, data_type, stations)
+            flags, tail = quality_filter.check(self.cur, self.path_to_db, data_type, epochs, station_ids, block)             # Data-quality flags and gaps (see vault_quality), in the same transaction
+            num_readings = self._upsert_block(data_type, epochs, reading_times, station_ids, block, flags)
+            derived = self.write_derived(derive(self.cur, data_type, epochs, 'narrow'))           # Derived series data_type is an input of (see vault_derived), in the same transaction
+        if registered is not None:
+            station_registry.remember(self.path_to_db, *registered)
+        if tail is not None:
+            quality_filter.remember(*tail)
+        if cache is not None and derived:
+            cache.update_derived(derived)
+        return num_readings
+
+    ## Upsert derived series (from vault_derived.derive: (derived data type, epochs, station_ids, block), ...) in the current transaction of the connection. Returns derived.
+    def write_derived(self, derived):
+        for derived_type, epochs, station_ids, block in derived:
+            self._upsert_block(derived_type, epochs, [to_date_time(epoch) for epoch in epochs.tolist()], station_ids, block)
+        return derived
+
+    # Upsert a block of readings (at epochs, i.e. reading_times) of data_type with their flags (default: none), move its watermark and recompute its rollups, in the current transaction. Returns the number of readings upserted.
+    def _upsert_block(self, data_type, epochs, reading_times, station_ids, block, flags=None):
+        station_ids = np.array([station_id.strip() for station_id in station_ids], dtype=object)
+        values = np.asarray(block, dtype=float)
+
+        # Missing readings (NaN) are not stored at all
+        row_i, col_i = np.nonzero(~np.isnan(values))
+        rows = zip([data_type] * len(row_i), station_ids[col_i].tolist(), epochs[row_i].tolist(), values[row_i, col_i].tolist(),
+                   flags[row_i, col_i].tolist() if flags is not None else [0] * len(row_i))
+
+        self.cur.executemany(self.upsert_reading, rows)
+        if len(epochs) != 0:
+            write_watermark(self.cur, f'readings/{data_type}', reading_times[int(np.argmax(epochs))])
+            update_rollups(self.cur, f'readings/{data_type}', epochs)
+        return len(row_i)
+
+    # Get the last stored reading_time of a data type (None if nothing has been stored yet)
+    def last_reading_time(self, data_type):
+        return read_watermark(self.cur, f'readings/{data_type}')
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from vault_metrics import metrics
+from vault_parse import loads
+from vault_lazy import lazy_import
+
+requests = lazy_import('requests')
+
+"""
+
+Transports are what a Collector uses to connect to the API (passed as Collector(..., session=transport)). Any object with the get method of requests.Session works:
+
+    response = transport.get(url, headers=..., params=...)          # response.status_code, response.headers, response.json()
+
+Besides requests.Session (the live API), this module provides:
+    RecordingTransport: wraps another transport and appends every response it returns to a recording
+    ReplayTransport: serves the responses of a recording, in order, without any network
+    ResilientTransport: wraps another transport with timeouts, retries, a circuit breaker per endpoint, hedged requests, and a latency budget per call (see below)
+
+A recording is a JSON lines file, one captured response per line:
+
+    {"data_type": "air-temperature", "url": "https://api.data.gov.sg/v1/environment/air-temperature", "params": null, "received": 1625642110.2, "status_code": 200, "headers": {"ETag": "..."}, "payload": {"metadata": ..., "items": [...]}}
+
+ReplayTransport answers each data_type from its own queue of captured responses (so one recording can hold several data types), and raises ReplayExhausted once a queue runs out. A recording can also be served over HTTP by a local fake_nea server (FakeNEA.load_recording).
+
+The Collector decodes responses through decode_response: the raw bytes of a requests.Response are decoded with vault_parse.loads (orjson when installed), skipping the text decoding (and charset detection) of response.json(). A ReplayTransport reading a recording file only decodes the header fields of each record up front, and keeps the payload as the bytes of the captured body, so replaying (or backfilling from) large captures decodes every payload once, the same way as a live response.
+
+ResilientTransport bounds the time a get can take, so a slow or failing endpoint never stalls its Collector past the 5-minute cadence of the API (Collectors and Engines use one by default):
+    every attempt has a connect and a read timeout (connect_timeout, read_timeout), clipped to what is left of the latency budget of the call (budget_seconds)
+    failed attempts (connection errors, timeouts, and 429/5xx responses) are retried up to max_retries times, after a jittered exponential delay (uniform from 0 to backoff * 2 ** retry, at most max_backoff, or the Retry-After of the response), as long as the budget allows
+    after failure_threshold failed attempts in a row, the circuit of the endpoint (the data_type of the URL) opens: calls fail right away (requests.exceptions.ConnectionError) for reset_seconds, then one call is let through to probe the endpoint, closing the circuit if it succeeds
+    an attempt still running after the hedge delay is hedged: the same request is sent again, and whichever response comes first is used. The hedge delay is hedge_after seconds, or (by default) the hedge_quantile of the latencies of the endpoint (once hedge_min_samples are known), so only the slowest ~5% of calls are sent twice
+The share of the budget used by the latest call of every endpoint is kept in budget_used (and the vault_transport_budget_used gauge, see vault_metrics). A budget used close to 1 means the endpoint is degraded: polls are taking as long as they are allowed to.
+
+Only idempotent requests should be sent through a ResilientTransport (every request of a Collector is a GET), and its transport must be safe to call from several threads (as requests.Session is) since attempts run in a pool of worker threads. A local fake_nea server injecting faults (FakeNEA.set_faults) exercises every path (see benchmarks/bench_transport.py).
+
+"""
+
+class ReplayExhausted(Exception):
+    pass
+
+
+class ReplayResponse:
+    # A captured response, with the parts of requests.Response used by the Collector
+    # The payload is either given decoded, or as the raw content (bytes) of the body, decoded on the first json() call
+    def __init__(self, status_code, headers, payload=None, content=None):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or dict())
+        self.payload = payload
+        self._content = content
+
+    def json(self):
+        if self.payload is None and self._content is not None:
+            self.payload = loads(self._content)
+        return self.payload
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = json.dumps(self.payload).encode()
+        return self._content
+
+
+## Decode the JSON body of a response: from its raw content for a requests.Response (with vault_parse.loads), through json() for any other response (e.g. ReplayResponse)
+def decode_response(response):
+    if isinstance(response, requests.Response):
+        return loads(response.content)
+    return response.json()
+
+
+# Split a recording line into its record (without the payload) and the raw payload (bytes), without decoding the payload
+# Records are written with the payload last (RecordingTransport), so the payload is whatever follows the first "payload" key. Lines of any other layout are decoded whole.
+def split_record(line):
+    head, separator, payload = line.rstrip().partition(', "payload": ')
+    if not separator or not payload.endswith('}'):
+        record = json.loads(line)
+        return record, None
+    return json.loads(head + '}'), payload[:-1].encode()
+
+# Get the data_type (last segment of the URL path) a request is for
+def data_type_of(url):
+    return url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+## Read a recording (JSON lines file) into a list of records
+def read_recording(path_to_recording):
+    with open(path_to_recording) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingTransport:
+    # Wrap transport (a requests.Session by default), appending every response to the recording at path_to_recording
+    def __init__(self, path_to_recording, transport=None):
+        self.transport = transport if transport is not None else requests.Session()
+        self.file = open(path_to_recording, 'a')
+        self._lock = threading.Lock()                   # Responses may come from several threads (e.g. vault_engine.Engine)
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        response = self.transport.get(url, headers=headers, params=params, **kwargs)
+        record = {'data_type': data_type_of(url), 'url': url, 'params': params, 'received': time.time(), 'status_code': response.status_code, 'headers': dict(response.headers),
+                  'payload': response.json() if response.status_code == 200 else None}
+        with self._lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        return response
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayTransport:
+    # Serve the records of a recording (a path, or a list of records already read), in order per data_type
+    # Payloads of records read from a path are kept as raw bytes and only decoded when served (like a response body), which also keeps large recordings compact in memory
+    def __init__(self, recording):
+        self.queues = dict()
+        if isinstance(recording, str):
+            with open(recording) as f:
+                for line in f:
+                    if line.strip():
+                        record, content = split_record(line)
+                        self.queues.setdefault(record['data_type'], deque()).append((record, content))
+        else:
+            for record in recording:
+                self.queues.setdefault(record['data_type'], deque()).append((record, None))
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        queue = self.queues.get(data_type_of(url))
+        if not queue:
+            raise ReplayExhausted(f"No more recorded responses for {url}!")
+        record, content = queue.popleft()
+        if content is not None and content != b'null':
+            return ReplayResponse(record['status_code'], record.get('headers'), content=content)
+        return ReplayResponse(record['status_code'], record.get('headers'), record.get('payload'))
+
+    def close(self):
+        pass
+
+
+class CircuitBreaker:
+    # Open after failure_threshold failed attempts in a row, then let one probe through every reset_seconds until one succeeds
+    def __init__(self, failure_threshold=5, reset_seconds=60):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'                           # 'closed', 'open', or 'half-open' (a probe is out)
+        self.failures = 0                               # Failed attempts in a row
+        self.retry_at = 0                               # Time (time.monotonic) from which the next probe is let through, when not closed
+        self._lock = threading.Lock()
+
+    ## Whether an attempt may be made now (an open circuit lets one probe through once reset_seconds have passed)
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now < self.retry_at:
+                return False
+            self.state, self.retry_at = 'half-open', now + self.reset_seconds          # Only one probe per reset_seconds (a probe that never records frees the next one)
+            return True
+
+    ## Record the outcome of an attempt
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.state, self.failures = 'closed', 0
+                return
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state, self.retry_at = 'open', time.monotonic() + self.reset_seconds
+
+    ## Seconds before the next probe (0 if the circuit is closed)
+    def retry_in(self):
+        return 0 if self.state == 'closed' else max(self.retry_at - time.monotonic(), 0)
+
+
+class ResilientTransport:
+    # Statuses of a failed attempt (retried, and counted by the circuit breaker). Any other status is returned as it is.
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    # Wrap transport (default: the requests module, i.e. a new connection per call) with timeouts, retries, circuit breakers and hedging, within budget_seconds per call
+    # hedge_after: seconds before an attempt is hedged (None: the hedge_quantile of the latencies of the endpoint). hedge=False never hedges.
+    def __init__(self, transport=None, connect_timeout=3.05, read_timeout=10, budget_seconds=60, max_retries=4, backoff=0.5, max_backoff=8,
+                 failure_threshold=5, reset_seconds=60, hedge=True, hedge_after=None, hedge_quantile=0.95, hedge_min_samples=20, max_workers=16):
+        self.transport = transport
+        self.connect_timeout, self.read_timeout = connect_timeout, read_timeout
+        self.budget_seconds = budget_seconds
+        self.max_retries, self.backoff, self.max_backoff = max_retries, backoff, max_backoff
+        self.failure_threshold, self.reset_seconds = failure_threshold, reset_seconds
+        self.hedge, self.hedge_after, self.hedge_quantile, self.hedge_min_samples = hedge, hedge_after, hedge_quantile, hedge_min_samples
+        self.max_workers = max_workers
+        self.breakers = dict()                          # Type: dict. endpoint -> CircuitBreaker
+        self.latencies = dict()                         # Type: dict. endpoint -> deque of the latest latencies (seconds) of successful attempts
+        self.budget_used = dict()                       # Type: dict. endpoint -> share of budget_seconds used by its latest call
+        self._pool = None                               # Type: ThreadPoolExecutor. Started on the first call
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        endpoint = data_type_of(url)
+        breaker = self._breaker(endpoint)
+        start = time.monotonic()
+        deadline = start + self.budget_seconds
+        try:
+            retry = 0
+            while True:
+                if not breaker.allow():
+                    metrics.inc('vault_transport_rejected_total', endpoint=endpoint)
+                    raise requests.exceptions.ConnectionError(f"Circuit of {endpoint} is open (after {breaker.failures} failed attempts) - next attempt in {breaker.retry_in():.1f} seconds!")
+                outcome = self._attempt(endpoint, url, headers, params, kwargs, deadline)
+                failed = isinstance(outcome, Exception) or outcome.status_code in self.retry_statuses
+                breaker.record(not failed)
+                metrics.inc('vault_transport_attempts_total', endpoint=endpoint, outcome=_outcome(outcome))
+                if not failed:
+                    return outcome
+
+                # Retry after a jittered exponential delay, if the budget allows
+                retry += 1
+                delay = self._retry_delay(retry, outcome)
+                if retry > self.max_retries or time.monotonic() + delay >= deadline or breaker.state == 'open':
+                    if isinstance(outcome, Exception):
+                        raise outcome
+                    return outcome
+                metrics.inc('vault_transport_retries_total', endpoint=endpoint)
+                time.sleep(delay)
+        finally:
+            used = (time.monotonic() - start) / self.budget_seconds
+            self.budget_used[endpoint] = used
+            metrics.set('vault_transport_budget_used', round(used, 4), endpoint=endpoint)
+
+    ## Open/closed state of the circuit of every endpoint called so far, with its failed attempts in a row and the share of the budget used by its latest call
+    def report(self):
+        return {endpoint: {'state': breaker.state, 'failures': breaker.failures, 'budget_used': round(self.budget_used.get(endpoint, 0), 4)} for endpoint, breaker in self.breakers.items()}
+
+    # A closed transport can still be used: its next call starts a new pool (as a closed requests.Session opens new connections)
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)                       # Abandoned attempts finish (within their timeouts) in the background
+        if self.transport is not None and hasattr(self.transport, 'close'):
+            self.transport.close()
+
+    # Make one attempt (hedged, if it is still running after the hedge delay), until deadline
+    # Returns the first successful response, else the last failed one (a response with a retry status, or the exception raised)
+    def _attempt(self, endpoint, url, headers, params, kwargs, deadline):
+        start = time.monotonic()
+        remaining = deadline - start
+        if remaining <= 0:
+            return requests.exceptions.Timeout(f"Latency budget of {endpoint} ({self.budget_seconds} seconds) exhausted!")
+        kwargs = dict(kwargs, timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)))
+        transport = self.transport if self.transport is not None else requests
+        submit = lambda: self._executor().submit(transport.get, url, headers=headers, params=params, **kwargs)
+
+        pending = {submit()}
+        hedge_delay = self._hedge_delay(endpoint)
+        hedge_at = start + hedge_delay if hedge_delay is not None else None
+        failure = None
+        while pending:
+            wake_at = deadline if hedge_at is None else min(hedge_at, deadline)
+            done, pending = wait(pending, timeout=max(wake_at - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is not None and not isinstance(error, requests.exceptions.RequestException):
+                    _discard(pending)
+                    raise error                                                 # Not a network failure (e.g. ReplayExhausted)
+                if error is None and future.result().status_code not in self.retry_statuses:
+                    _discard(pending | done - {future})
+                    self._latencies(endpoint).append(time.monotonic() - start)
+                    return future.result()
+                failure = error if error is not None else future.result()
+            if not done and time.monotonic() >= deadline:
+                _discard(pending)
+                return requests.exceptions.Timeout(f"Latency budget of {endpoint} ({self.budget_seconds} seconds) exhausted!")
+            if not done and hedge_at is not None and time.monotonic() >= hedge_at:
+                pending.add(submit())
+                hedge_at = None                                                 # At most one hedge per attempt
+                metrics.inc('vault_transport_hedges_total', endpoint=endpoint)
+            if failure is not None and hedge_at is not None:
+                break                                                           # Failed before the hedge delay: retried rather than hedged
+        return failure
+
+    # Seconds before the retry-th retry: the Retry-After of a failed response (if any, at most max_backoff), else uniform from 0 to backoff * 2 ** (retry - 1), at most max_backoff ("full jitter")
+    def _retry_delay(self, retry, outcome):
+        retry_after = getattr(outcome, 'headers', dict()).get('Retry-After')
+        if retry_after is not None and str(retry_after).isdigit():
+            return min(int(retry_after), self.max_backoff)
+        return self._random.uniform(0, min(self.backoff * 2 ** (retry - 1), self.max_backoff))
+
+    # Seconds before an attempt is hedged (None: not hedged)
+    def _hedge_delay(self, endpoint):
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        latencies = sorted(self._latencies(endpoint))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[min(int(len(latencies) * self.hedge_quantile), len(latencies) - 1)]
+
+    # CircuitBreaker of endpoint
+    def _breaker(self, endpoint):
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.setdefault(endpoint, CircuitBreaker(self.failure_threshold, self.reset_seconds))
+        return breaker
+
+    # Latest latencies of endpoint (the last 100 successful attempts)
+    def _latencies(self, endpoint):
+        latencies = self.latencies.get(endpoint)
+        if latencies is None:
+            with self._lock:
+                latencies = self.latencies.setdefault(endpoint, deque(maxlen=100))
+        return latencies
+
+    # Pool of the threads running the attempts
+    def _executor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ResilientTransport')
+        return self._pool
+
+
+# Close the responses of attempts that are no longer waited for, once they complete (a pooled connection is only released once its response is closed)
+def _discard(futures):
+    for future in futures:
+        future.add_done_callback(lambda future: future.exception() is None and hasattr(future.result(), 'close') and future.result().close())
+
+# Label of the outcome of an attempt (for vault_transport_attempts_total)
+def _outcome(outcome):
+    if isinstance(outcome, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(outcome, Exception):
+        return 'error'
+    return str(outcome.status_code)
+
+
+if __name__ == '__main__':
+    from vault_engine import Engine, all_look_fors
+
+    parser = argparse.ArgumentParser(description="Record live NEA API responses for later replay.")
+    parser.add_argument('path_to_recording', help="recording to append to (JSON lines)")
+    parser.add_argument('limit', type=int, help="number of readings to record per data type")
+    parser.add_argument('--look-for', nargs='+', default=all_look_fors, help="data types to record (default: all 5)")
+    args = parser.parse_args()
+
+    transport = RecordingTransport(args.path_to_recording)
+    try:
+        Engine(look_fors=args.look_for, session=transport).run_sync(args.limit)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
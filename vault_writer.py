@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+import time
+import queue
+import threading
+import sqlite3 as sl
+from vault_store import connect
+from vault_metrics import metrics
+from vault_lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+"""
+
+DbWriter object is the single writer of a database shared by several collectors (e.g. the data types of a vault_engine.Engine, or the collection threads of main_psg). Instead of every collector opening its own connection and writing on its own (and waiting on 'database is locked' while another one writes), collectors submit their built DataFrames to the DbWriter, whose thread writes them over one connection.
+
+    writer = DbWriter('vault.db')
+    writer.submit(collector, df, db_table_name, storage='wide')       # returns once queued (or waits, if the queue is full)
+    writer.close()                                                      # waits until every submitted DataFrame is written
+
+Whatever has been queued while the writer was busy is written together: the DataFrames of the same table are concatenated and written through one Collector._send_to_db call (one transaction), so the more the collectors write at once, the fewer (and larger) the transactions.
+
+A write failing on a locked database (sl.OperationalError, e.g. another process writing) is rolled back and retried up to max_retries times. Retries never store a row twice: every _send_to_db is a single transaction, including the rows of wide tables (see weather_vault.insert_wide_rows), so a rolled back write leaves nothing behind.
+
+A write that still fails (out of retries, or any other error) is not dropped: its DataFrames are held and written again with the next batch (the collectors have already let go of them). flush() and close() retry them once more and raise WriteFailed if some are still not written, and every failed write is counted (num_failed, vault_writer_failures_total).
+
+Back-pressure: the queue holds at most max_pending DataFrames. Once it is full, submit waits until the writer catches up (counted in stalls), so a slow disk slows the collectors down instead of growing memory. pressure() reports how full the queue is (0 to 1).
+
+"""
+
+_stop = object()                    # Queued by close() to stop the writer thread
+_retry = object()                   # Queued by flush() to write the held DataFrames again
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class DbWriter:
+    # Start the writer thread of the database at path_to_db, with room for max_pending queued DataFrames
+    def __init__(self, path_to_db='vault.db', max_pending=64, max_retries=3):
+        self.path_to_db = path_to_db
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.num_submitted, self.num_transactions, self.num_failed, self.stalls = 0, 0, 0, 0
+        self.last_error = None
+        self._held = list()                 # Type: list. Queued items whose write failed, written again with the next batch
+        self._thread = threading.Thread(target=self._run, name='DbWriter', daemon=True)
+        self._thread.start()
+
+    ## Queue a DataFrame built by collector (index: reading_time, columns: station ids) to be written to db_table_name (storage: 'wide' or 'narrow')
+    # Waits while the queue is full (back-pressure). With a timeout, raises queue.Full if the queue is still full after timeout seconds.
+    # stations: the station metadata of df (see Collector._send_to_db), written with it (the Collector itself is not changed by the writer thread)
+    def submit(self, collector, df, db_table_name, storage='wide', timeout=None, stations=None):
+        if df.shape[0] == 0:
+            return
+        item = (collector, df, db_table_name, storage, stations)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.stalls += 1
+            metrics.inc('vault_writer_stalls_total')
+            self._queue.put(item, timeout=timeout)
+        self.num_submitted += 1
+        metrics.set('vault_writer_pressure', self.pressure())
+
+    ## How full the queue is (0: empty, 1: full - submit waits)
+    def pressure(self):
+        return self._queue.qsize() / self.max_pending
+
+    ## Wait until every DataFrame submitted so far is written
+    # Raises WriteFailed if some of them could not be written (they are still held, and written again with the next batch)
+    def flush(self):
+        self._queue.join()
+        if self._held:
+            self._queue.put(_retry)
+            self._queue.join()
+            self._raise_held()
+
+    ## Write every DataFrame submitted so far, then stop the writer thread
+    # Raises WriteFailed if some of them could not be written (they are then lost with the writer)
+    def close(self):
+        self._queue.put(_stop)
+        self._thread.join()
+        self._raise_held()
+
+    ## Number of entries submitted but not written yet because their write failed
+    def num_held(self):
+        return sum(item[1].shape[0] for item in self._held)
+
+    # Raise WriteFailed if some submitted DataFrames are still held
+    def _raise_held(self):
+        if self._held:
+            raise WriteFailed(f"{self.num_held()} entries could not be written to {self.path_to_db} ({type(self.last_error).__name__}: {self.last_error})!")
+
+    # Writer thread: take everything queued (at least one item), write it, repeat
+    def _run(self):
+        con = connect(self.path_to_db)
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                metrics.set('vault_writer_pressure', self.pressure())
+                stopping = any(item is _stop for item in batch)
+                try:
+                    held, self._held = self._held, list()
+                    self._write(con, held + [item for item in batch if item is not _stop and item is not _retry])          # Held items first, so that newer entries of the same table win
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+                if stopping:
+                    break
+        finally:
+            con.close()
+
+    # Write a batch of queued items, one transaction per table. The items of a table that could not be written are held.
+    def _write(self, con, batch):
+        # Group the DataFrames by (collector, table, storage), in order of arrival
+        groups = dict()
+        for item in batch:
+            collector, df, db_table_name, storage, stations = item
+            groups.setdefault((id(collector), db_table_name, storage), list()).append(item)
+
+        for (_, db_table_name, storage), items in groups.items():
+            collector, stations = items[-1][0], items[-1][4]
+            df = pd.concat([item[1] for item in items]) if len(items) > 1 else items[0][1]
+            df = df[~df.index.duplicated(keep='last')]
+            for attempt in range(self.max_retries + 1):
+                try:
+                    collector._send_to_db(df, db_table_name, self.path_to_db, storage, con=con, stations=stations)
+                    self.num_transactions += 1
+                    break
+                except sl.OperationalError as e:             # e.g. 'database is locked' by a process outside of this writer. Nothing of the write is committed, so it can be retried as a whole.
+                    if con.in_transaction:
+                        con.rollback()
+                    if attempt == self.max_retries:
+                        self._failed(db_table_name, df, e, items)
+                    else:
+                        time.sleep(0.1 * 2 ** attempt)
+                except Exception as e:
+                    if con.in_transaction:
+                        con.rollback()
+                    self._failed(db_table_name, df, e, items)
+                    break
+
+    # Record a DataFrame that could not be written, and hold its items to write them again with the next batch
+    def _failed(self, db_table_name, df, e, items):
+        self.num_failed += 1
+        self.last_error = e
+        self._held.extend(items)
+        metrics.inc('vault_writer_failures_total', data_type=db_table_name)
+        print(f"(DbWriter) Failed to write {df.shape[0]} entries to {db_table_name} ({type(e).__name__}: {e}), held to be written again!")
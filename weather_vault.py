@@ -1,11 +1,21 @@
 #!/usr/bin/python
 
 import re
-import requests
-import numpy as np
-import pandas as pd
 import time
 import sqlite3 as sl
+from vault_buffer import ReadingBuffer
+from vault_metrics import metrics
+from vault_parse import parse_items, station_layout
+from vault_derived import derive, is_input
+from vault_rollup import update_rollups
+from vault_quality import quality_filter, write_flags
+from vault_store import NarrowStore, connect, index_wide_table, read_watermark, write_watermark, to_epoch, station_hash, station_registry, write_stations
+from vault_transport import ResilientTransport, decode_response
+from vault_lazy import lazy_import
+
+requests = lazy_import('requests')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 """
 
@@ -23,190 +33,403 @@ all_data_types = {
 
 """
 
-class Collector:
-    # Define regex patterns to match to look_for
-    temp_pattern, rain_pattern, humid_pattern, wind_d_pattern, wind_s_pattern = r"temp", r"^rain", r"humid", r"direction", r"speed"
+# look_for patterns (compiled once, in order of precedence) and the data type each one resolves to: (pattern, data_type (the argument passed into the API URL), data_name (the key under which the value is stored))
+look_for_table = [
+    (re.compile(r"temp", re.IGNORECASE), 'air-temperature', 'temperature'),                 # Air temperature: look_for contains 'temp'
+    (re.compile(r"^rain", re.IGNORECASE), 'rainfall', 'rainfall'),                          # Rainfall: look_for starts with 'rain' (no character before rain - i.e. no 'train', 'brain' etc.)
+    (re.compile(r"humid", re.IGNORECASE), 'relative-humidity', 'relative_humidity'),        # Relative humidity: look_for contains 'humid'
+    (re.compile(r"direction", re.IGNORECASE), 'wind-direction', 'wind_direction'),          # Wind direction: look_for contains 'direction'
+    (re.compile(r"speed", re.IGNORECASE), 'wind-speed', 'wind_speed'),                      # Wind speed: look_for contains 'speed'
+    ]
+# (data_type, data_name) of every look_for resolved so far
+_resolved = dict()
+
+## Resolve a look_for keyword (e.g. 'temp', 'rain', or a data_name such as 'relative_humidity') into (data_type, data_name), through look_for_table (each keyword is only matched once per process)
+def resolve_look_for(look_for):
+    resolved = _resolved.get(look_for)
+    if resolved is None:
+        for pattern, data_type, data_name in look_for_table:
+            if pattern.search(look_for):
+                resolved = _resolved[look_for] = (data_type, data_name)
+                break
+        else:
+            raise NameError("Data type not found! Please check if keyword exists!")
+    return resolved
+
+
+## Insert the rows of df (index: reading_time, columns: station ids) into the wide table db_table_name, in the current transaction of cur (missing readings, NaN, are stored as NULL)
+def insert_wide_rows(cur, db_table_name, df):
+    columns = ', '.join(f'"{station_id}"' for station_id in df.columns)
+    values = df.to_numpy(dtype=float)
+    values = np.where(np.isnan(values), None, values)
+    cur.executemany(f"INSERT INTO {db_table_name} (date_time, {columns}) VALUES ({', '.join('?' * (df.shape[1] + 1))}) ;",
+                    [(reading_time, *row) for reading_time, row in zip(df.index, values.tolist())])
 
+
+class Collector:
     # Initialize an instance of the data Collector
-    def __init__(self, look_for, build_format, ping_interval):
+    def __init__(self, look_for, build_format, ping_interval, session=None, scheduler=None, base_url='https://api.data.gov.sg/v1/environment', cache=None):
         # Store the requested build_format as a Collector attribute
         self.build_format = build_format
 
         # Store the ping_interval as a Collector attribute
         self.ping_interval = ping_interval
 
-        # Initialize a previous_collection attribute
-        # self.previous_collection = None
+        # Store the (optional) requests.Session used to connect to the API. Collectors sharing a session share its pool of keep-alive connections (see vault_engine.Engine). Without a session, every call opens a new connection, through a vault_transport.ResilientTransport (timeouts, retries, circuit breaker and hedging, within a latency budget).
+        # Any transport with the get method of requests.Session can be used instead, e.g. to record or replay API responses (see vault_transport).
+        self.session = session if session is not None else ResilientTransport()
 
-        # Air temperature: Check if the look_for contains 'temp'
-        match_temp = re.search(self.temp_pattern, look_for, re.IGNORECASE)
+        # Store the (optional) vault_schedule.PollScheduler deciding when to poll next. Without a scheduler, the API is polled every ping_interval seconds until the timestamp changes.
+        self.scheduler = scheduler
 
-        # Rainfall: Check if the look_for starts with 'rain' (no character before rain - i.e. no 'train', 'brain' etc.)
-        match_rain = re.search(self.rain_pattern, look_for, re.IGNORECASE)
+        # Store the base URL of the API (the data_type is appended to it), e.g. to point the Collector at a local fake_nea server
+        self.base_url = base_url
 
-        # Relative humidity: Check if the look_for contains 'humid'
-        match_humid = re.search(self.humid_pattern, look_for, re.IGNORECASE)
+        # Store the (optional) vault_serve.LatestCache updated with every new entry, e.g. to serve the latest readings over HTTP
+        self.cache = cache
 
-        # Wind direction: Check if the look_for contains 'direction'
-        match_wind_d = re.search(self.wind_d_pattern, look_for, re.IGNORECASE)
+        # Validators of the latest response, sent back with the next request so the API can answer 304 (Not Modified) instead of the full payload
+        self.etag, self.last_modified = None, None
 
-        # Wind speed: Check if the look_for contains 'speed'
-        match_wind_s = re.search(self.wind_s_pattern, look_for, re.IGNORECASE)
+        # Latest payload of the API and its reading_time and reading_unit (None until a _connect_to_api call returns a reading)
+        self.raw_reading, self.reading_time, self.reading_unit = None, None, None
 
-        # Match data_type (the argument passed into the API URL) to data_name (the key under which the value is stored)
-        if match_temp:
-            self.data_type, self.data_name = 'air-temperature', 'temperature'
-        elif match_rain:
-            self.data_type, self.data_name = 'rainfall', 'rainfall'
-        elif match_humid:
-            self.data_type, self.data_name = 'relative-humidity', 'relative_humidity'
-        elif match_wind_d:
-            self.data_type, self.data_name = 'wind-direction', 'wind_direction'
-        elif match_wind_s:
-            self.data_type, self.data_name = 'wind-speed', 'wind_speed'
-        else:
-            raise NameError("Data type not found! Please check if keyword exists!")
+        # Initialize a previous_collection attribute
+        # self.previous_collection = None
+
+        # Match data_type (the argument passed into the API URL) to data_name (the key under which the value is stored), through the precompiled look_for table
+        self.data_type, self.data_name = resolve_look_for(look_for)
 
     ## Connect to API, saving reading_time, reading_unit, and raw_reading as an (temporary) attribute of the Collector instance
     def _connect_to_api(self):
         # Connect to API for an instance of the Collector object to obtain raw_data of the data type of the Collector instance from the server
-        response = requests.get(f"https://api.data.gov.sg/v1/environment/{self.data_type}")
+        # The request is conditional (If-None-Match/If-Modified-Since) when the previous response carried an ETag/Last-Modified header
+        headers = dict()
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        # Time spent in each stage, and the outcome of every poll, are recorded in vault_metrics.metrics
+        start = time.perf_counter()
+        try:
+            response = self.session.get(f"{self.base_url}/{self.data_type}", headers=headers)
+        except requests.exceptions.RequestException:
+            metrics.inc('vault_polls_total', data_type=self.data_name, status='error')
+            raise
+        network_seconds = time.perf_counter() - start
+        metrics.observe('vault_stage_seconds', network_seconds, stage='network', data_type=self.data_name)
+        metrics.inc('vault_polls_total', data_type=self.data_name, status=response.status_code if response.status_code in (200, 304) else 'error')
+        metrics.event('poll', data_type=self.data_name, status=response.status_code, network_seconds=round(network_seconds, 6))
         if response.status_code == 200:
-            self.raw_reading = response.json()
-            self.reading_time = self.raw_reading['items'][0]['timestamp']         # Type: str. Format: 'YYYY-MM-DDThh:mm:ss+hh:mm' (e.g., '2021-07-07T15:10:00+08:00')
+            with metrics.timer('vault_stage_seconds', stage='decode', data_type=self.data_name):
+                raw_reading = decode_response(response)                           # orjson from the raw bytes when installed (see vault_parse.loads)
+            if len(raw_reading['items']) == 0:
+                return                                                            # No reading in the payload (as vault_backfill and vault_import skip it): raw_reading, reading_time and reading_unit of the previous call are still current
+            self.raw_reading = raw_reading
+            self.reading_time = max(item['timestamp'] for item in self.raw_reading['items'])     # Type: str. Format: 'YYYY-MM-DDThh:mm:ss+hh:mm' (e.g., '2021-07-07T15:10:00+08:00'). Latest reading_time of the payload (the live API returns a single item)
             self.reading_unit = self.raw_reading['metadata']['reading_unit']      # Type: str. 
+            self.etag, self.last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        elif response.status_code == 304:
+            pass                                                                  # Not modified: raw_reading, reading_time and reading_unit of the previous call are still current
         else:
             error_msg = "Connection to API failed - Returned status code is not 200!"
             raise requests.exceptions.HTTPError(error_msg)
 
     def _get_reading(self):
+        # Get the readings of every item as a block (rows ordered as reading_times, columns as station_ids), then format it into an appropriate pandas DataFrame (as requested by the user when calling extract_data function) for storage purposes
+        block = self._get_block()
+        if block is not None:
+            # Prepare dataframe for requested data_type, using 'reading_time' as index (row_label). Columns are already sorted by the column layout.
+            reading_times, station_ids, values = block
+            with metrics.timer('vault_stage_seconds', stage='dataframe', data_type=self.data_name):
+                df_entry = pd.DataFrame(values, index=reading_times, columns=station_ids)
+
+            return df_entry
+
+    # Get the readings of every item of the latest _connect_to_api call as (reading_times, station_ids, block), where block is a 2-D NumPy array (rows: reading_times, columns: station_ids)
+    # A single item (the live API) goes through _get_row. Several items (e.g. bulk or historical payloads) are parsed in one vectorised pass by vault_parse.parse_items.
+    def _get_block(self):
+        with metrics.timer('vault_stage_seconds', stage='parse', data_type=self.data_name):
+            return self._parse_block()
+
+    # Parse the items of the latest _connect_to_api call (see _get_block)
+    def _parse_block(self):
+        items = self.raw_reading['items']
+        if len(items) == 1:
+            entry = self._get_row()
+            if entry is not None:
+                return [items[0]['timestamp']], self.station_ids, entry[np.newaxis, :]
+        elif re.search(r"v1", self.build_format, re.IGNORECASE):
+            self.stations = self.raw_reading['metadata']['stations']
+            self.num_stations = len(self.stations)
+            reading_times, self.station_ids, block = parse_items(self.raw_reading)
+            return reading_times, self.station_ids, block
+
+    # Get the readings of the first item of the latest _connect_to_api call as a NumPy row, ordered as self.station_ids
+    def _get_row(self):
         # Store reading_time, reading_unit, stations (data), and readings as attributes of a Collector instance (these attributes are updated everytime extract_data is called successfully)
-        stations = self.raw_reading['metadata']['stations']                                                          # Type: list. Format: [{'id': ..., 'device_id': ..., 'name': ..., 'location': {'latitude': ..., 'longitude': ...}}, {~~~}, ...]. Note that stations is modified on the fly in the subsequent lines
+        stations = self.raw_reading['metadata']['stations']                                                          # Type: list. Format: [{'id': ..., 'device_id': ..., 'name': ..., 'location': {'latitude': ..., 'longitude': ...}}, {~~~}, ...]
         readings = self.raw_reading['items'][0]['readings']                                                          # Type: list. Format: [{'station_id': ..., 'value': ...}, {~~~}, ...]
         self.num_stations = len(stations)                                                                            # Type: int. Get number of stations
-        self.station_ids = sorted(list(stations[i]['id'] for i in range(len(stations))), key=lambda x: int(x[1:]))  # Type: list. Get list of station ids (sorted by value after S prefix)
+        self.stations = stations                                                                                     # Type: list. Station metadata kept for storage backends that store it (e.g. vault_store.NarrowStore)
+        self.station_ids, station_index = station_layout(stations)                                                   # Type: list, dict. Station ids (sorted by value after S prefix) and their column positions (cached by station set)
         
-        # Format the raw_data into an appropriate pandas DataFrame (as requested by the user when calling extract_data function) for storage purposes
         if re.search(r"v1", self.build_format, re.IGNORECASE):
-            # Modify the json data to the necessary structure
-            station_i, reading_i = 0, 0
-            while station_i <= self.num_stations - 1:
-                if stations[station_i]['id'] == readings[reading_i]['station_id']:
-                    stations[station_i][f'{self.data_name}'] = readings[reading_i]['value']       # Add f'{data_name}' reading into processed dictionary
-                    station_i += 1
-                    reading_i = 0
-                else:
-                    reading_i += 1
-            processed_reading = {'reading_time': self.reading_time, 'reading_unit': self.reading_unit, 'stations': stations}
-
-            # Prepare dataframe for requested data_type
-            column_header = list()
-            entry = list()
-            for station in processed_reading['stations']:
-                column_header.append(station['id'].strip())
-                entry.append(float(station[f'{self.data_name}']))             
-            df_entry = pd.DataFrame(np.array([entry]), columns=column_header)
-            df_entry.rename(index={0: processed_reading['reading_time']}, inplace=True)                       # Use 'reading_time' as index (row_label)
-            df_entry.sort_index(axis=1, inplace=True, key=lambda x: x.to_series().str[1:].astype(int))        # Sort by column headers (by value after S prefix)
+            # Fill a preallocated row by looking up the column of each reading's station (one pass over readings). Stations without a reading (or with a null value, as in vault_parse.parse_items) are left as NaN.
+            # Values are not validated here: implausible readings are flagged when written (see vault_quality)
+            entry = np.full(len(self.station_ids), np.nan)
+            for reading in readings:
+                column_i = station_index.get(reading['station_id'].strip())
+                value = reading.get('value')
+                if column_i is not None and value is not None:
+                    entry[column_i] = float(value)
 
-            return df_entry
+            return entry
+
+    # Add the entries of the latest _connect_to_api call that are newer than the latest entry in buffer (at most max_entries, oldest first). Returns the number of entries added.
+    def _buffer_new_entries(self, buffer, max_entries):
+        reading_times, station_ids, block = self._get_block()
+        if buffer.last_time is not None:
+            last_epoch = to_epoch(buffer.last_time)
+            new_rows = [row_i for row_i, reading_time in enumerate(reading_times) if to_epoch(reading_time) > last_epoch]
+        else:
+            new_rows = list(range(len(reading_times)))
+        new_rows = sorted(new_rows, key=lambda row_i: reading_times[row_i])[:max_entries]
+        if new_rows:
+            buffer.append_block([reading_times[row_i] for row_i in new_rows], station_ids, block[new_rows])
+            if self.cache is not None:
+                self.cache.update(self.data_name, [reading_times[row_i] for row_i in new_rows], station_ids, block[new_rows], self.reading_unit)
+            metrics.inc('vault_entries_total', len(new_rows), data_type=self.data_name)
+            metrics.inc('vault_missing_readings_total', int(np.isnan(block[new_rows]).sum()), data_type=self.data_name)
+            metrics.set('vault_ingestion_lag_seconds', round(time.time() - to_epoch(buffer.last_time), 3), data_type=self.data_name)
+        return len(new_rows)
+
+    ## Build DataFrame (by calling _get_block function after a _connect_to_api call)
+    # Entries are accumulated in a ReadingBuffer and only turned into a DataFrame once collection stops. If ring_size is given, only the latest ring_size entries are kept in memory (older entries are dropped), so memory stays fixed however large limit is.
+    # If flush_every is given (with send_to_db=True), entries are instead streamed to the database: every flush_every new entries are committed over one persistent (WAL journaled) connection and dropped from memory, so a crash loses at most one micro-batch.
+    # If a writer (vault_writer.DbWriter, shared with other collectors) is given, entries are passed to the writer instead of being written by this Collector.
+    def build_df(self, db_table_name, limit, path_to_db='vault.db', send_to_db=False, storage='wide', ring_size=None, flush_every=None, writer=None):
+        streaming = send_to_db == True and flush_every is not None
+        if streaming:
+            buffer = ReadingBuffer(capacity=flush_every)
+            con = connect(path_to_db) if writer is None else None
+        elif ring_size is None:
+            buffer = ReadingBuffer(capacity=max(1, min(limit, 288)))             # Grows as needed (288 entries is a day of 5-minute readings)
+        else:
+            buffer = ReadingBuffer(capacity=ring_size, ring=True)
 
-    ## Build DataFrame (by calling _get_reading function after a _connect_to_api call)
-    def build_df(self, db_table_name, limit, path_to_db='vault.db', send_to_db=False):
         # Try to build the dataframe as far as possible, barring KeyboardInterrupt
+        # A payload usually holds one entry, but every new item of a payload holding several is added at once (num_entries then grows by more than 1)
+        num_entries = 0
         try:
-            for i in range(limit): #tqdm.tqdm(range(limit), desc=f"{db_table_name}", position=0, leave=True):
-                if i == 0:
+            while num_entries < limit: #tqdm.tqdm(range(limit), desc=f"{db_table_name}", position=0, leave=True):
+                if num_entries == 0:
                     # Get first entry
-                    self._connect_to_api()
-                    df = self._get_reading()
+                    self._poll(db_table_name)
+                    num_entries += self._buffer_new_entries(buffer, limit)
                     print(f"First entry of DataFrame for (dbTable: {db_table_name}) built!")
                 else:
                     # For subsequent entries, check if API is returning an updated timestamp
-                    print(f"Building {i+1}/{limit} of DataFrame for (dbTable: {db_table_name}).")
+                    print(f"Building {num_entries+1}/{limit} of DataFrame for (dbTable: {db_table_name}).")
+                    if self.scheduler is not None:
+                        # Sleep until shortly after the next reading is expected
+                        time.sleep(self.scheduler.next_delay(buffer.last_time, new_reading=True))
                     while True:
-                        self._connect_to_api()
-                        if self.reading_time != df.index[-1]:
-                            new_df_entry = self._get_reading()
-                            df = df.append(new_df_entry)
-                            #print(df)
+                        self._poll(db_table_name)
+                        new_entries = self._buffer_new_entries(buffer, limit - num_entries) if self.reading_time != buffer.last_time else 0
+                        if new_entries != 0:
+                            num_entries += new_entries
                             break
                         else:
+                            metrics.inc('vault_duplicate_polls_total', data_type=self.data_name)
                             #print(f"({db_table_name}) Latest ping returned the same reading as latest entry in built DataFrame. Waiting for next ping in {self.ping_interval} seconds...")
-                            time.sleep(self.ping_interval)
-                yield i+1
+                            time.sleep(self.ping_interval if self.scheduler is None else self.scheduler.next_delay(buffer.last_time, new_reading=False))
+
+                # Streaming mode: commit the micro-batch once it is full
+                if streaming and len(buffer) >= flush_every:
+                    self._send_to_db(buffer.to_df(), db_table_name, path_to_db, storage, con=con, writer=writer)
+                    buffer.clear()
+                yield num_entries
         except KeyboardInterrupt:
-            pass                                    # df will be retained in memory up to the previous successful while True iteration.
+            pass                                    # buffer will be retained in memory up to the previous successful while True iteration.
+        df = buffer.to_df()
 
-        # If send_to_db == True:
+        # If send_to_db == True, pass the built DataFrame to the requested storage backend:
+            # 'wide' (default): one table per data type, with one column per station (see _send_to_wide_db)
+            # 'narrow': one long-format readings table shared by all data types, with station metadata kept separately (see vault_store.NarrowStore)
+        if streaming:
+            # Commit whatever is left of the last micro-batch
+            if df.shape[0] != 0:
+                self._send_to_db(df, db_table_name, path_to_db, storage, con=con, writer=writer)
+            if con is not None:
+                con.close()
+        elif send_to_db == True:
+            self._send_to_db(df, db_table_name, path_to_db, storage, writer=writer)
+        else:
+            print("DataFrame construction completed! Constructed DataFrame not passed into database.")
+            return df
+
+    # Call _connect_to_api until it succeeds and a reading has been returned (a payload without items is not one), so a failed poll (e.g. the API being down, or the circuit of its endpoint being open) does not end build_df: it is retried after ping_interval seconds (at least 1)
+    def _poll(self, db_table_name):
+        while True:
+            try:
+                self._connect_to_api()
+                if self.reading_time is not None:
+                    return
+                print(f"({db_table_name}) No reading returned by the API yet. Retrying in {max(self.ping_interval, 1)} seconds...")
+            except requests.exceptions.RequestException as e:
+                print(f"({db_table_name}) Connection to API failed ({e}). Retrying in {max(self.ping_interval, 1)} seconds...")
+                metrics.inc('vault_retries_total', data_type=self.data_name)
+            time.sleep(max(self.ping_interval, 1))
+
+    ## Send a built DataFrame to the requested storage backend (also used by vault_engine.Engine, which builds its DataFrames outside of build_df)
+    # If an open connection (con) is given, it is used and left open. Otherwise a connection to path_to_db is opened for this DataFrame only.
+    # If a writer (vault_writer.DbWriter) is given, the DataFrame is queued to it instead, and written by its thread.
+    # stations is the station metadata of df (default: that of the latest _connect_to_api call). It is passed along rather than read from the Collector, as the write may run on another thread (e.g. vault_writer.DbWriter) while the Collector keeps polling.
+    def _send_to_db(self, df, db_table_name, path_to_db='vault.db', storage='wide', con=None, writer=None, stations=None):
+        stations = stations if stations is not None else getattr(self, 'stations', None)
+        if writer is not None:
+            writer.submit(self, df, db_table_name, storage, stations=stations)
+            return
+        start = time.perf_counter()
+        if re.search(r"narrow", storage, re.IGNORECASE):
+            self._send_to_narrow_db(df, path_to_db, con=con, stations=stations)
+        else:
+            self._send_to_wide_db(df, db_table_name, path_to_db, con=con, stations=stations)
+        if df.shape[0] != 0:
+            write_lag = time.time() - to_epoch(df.index[-1])
+            metrics.inc('vault_rows_written_total', df.shape[0], data_type=self.data_name)
+            metrics.set('vault_write_lag_seconds', round(write_lag, 3), data_type=self.data_name)
+            metrics.event('write', data_type=self.data_name, table=db_table_name, storage=storage, rows=df.shape[0], seconds=round(time.perf_counter() - start, 6), write_lag_seconds=round(write_lag, 3))
+
+    ## Send a built DataFrame to its own wide table (db_table_name) in the database
+    def _send_to_wide_db(self, df, db_table_name, path_to_db, con=None, stations=None):
+        # Steps:
             # 1) Make connection with database
             # 2) Prune top row of dataframe if its datetime is the same as the latest row in the database target table
             # 3) Make the dataframe and target table in the database compatible with each other (i.e. ensure the stations in the database should be equal to or larger than the number of incoming stations)
             # 4) Pass modified dataframe to database
-        if send_to_db == True:
-            # 1) Make connection with database and try to build a blank table (with only entry_id and date_time columns)
-            self.con = sl.connect(path_to_db)
-            self.cur = self.con.cursor()
-            try:
-                create_blank_table = f"""
-                    CREATE TABLE {db_table_name} (
-                        entry_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-                        date_time TEXT ) ;
-                    """
-                self.cur.execute(create_blank_table)
-                self.con.commit()
-                print(f"Empty table '{db_table_name}' created with 'entry_id' and 'date_time' as headers! No station headers created!")
-            except sl.OperationalError:
-                print(f"Table '{db_table_name}' already exists in vault.db!")
+        # 1) Make connection with database (unless an open connection is given) and try to build a blank table (with only entry_id and date_time columns)
+        # The connection and cursor are local to this call (not attributes of the Collector), so a write on another thread never shares them with the Collector
+        # The time spent in steps 1 and 3 (schema), 2 (dedup) and 4 (insert) is recorded in vault_metrics.metrics
+        # Steps 1 and 3 are skipped while the station set (columns of df) is one the table is known to have (see vault_store.StationRegistry), i.e. on almost every flush
+        stage_start = time.perf_counter()
+        own_con = con is None
+        con = con if con is not None else connect(path_to_db)
+        cur = con.cursor()
+        set_hash = station_hash(list(df.columns))
+        schema_known = station_registry.known(path_to_db, db_table_name, set_hash)
+        if not schema_known:
+            self._create_wide_table(cur, db_table_name, path_to_db)
+        derived_store = NarrowStore(path_to_db, con=con) if is_input(db_table_name) else None          # Derived series (see vault_derived) are stored in the readings table
+        schema_seconds = time.perf_counter() - stage_start
 
-            # 2) Prune top row of dataframe if its datetime is the same as the latest row in the database target table
-            # Since in the dataframe building process, each entry added is unique, and time only increases in one direction, checking the top row of the incoming dataframe against the last row of the existing table would do in ensuring a chronological order of entries
+        # 2) Prune top row of dataframe if its datetime is the same as the latest row in the database target table
+        # Since in the dataframe building process, each entry added is unique, and time only increases in one direction, checking the top row of the incoming dataframe against the last row of the existing table would do in ensuring a chronological order of entries
+        # The latest row is looked up from the watermarks table (constant time). Tables written before watermarks existed fall back to a lookup of the row with the largest entry_id (the rowid, so this is an index lookup, not a scan).
+        stage_start = time.perf_counter()
+        last_row_datetime_in_dbTable = read_watermark(cur, db_table_name)
+        if last_row_datetime_in_dbTable is None:
+            last_row = cur.execute(f"SELECT date_time FROM {db_table_name} ORDER BY entry_id DESC LIMIT 1").fetchone()
+            last_row_datetime_in_dbTable = last_row[0] if last_row else None
+        if last_row_datetime_in_dbTable is not None:
+            earliest_entry_in_df = df.index[0]
+            if earliest_entry_in_df == last_row_datetime_in_dbTable:
+                df = df.drop([f'{earliest_entry_in_df}'])
+            dbTable_empty = False
+        else:                       # No rows in the target table in the database. It is very likely that there are no station headers as well (only entry_id and date_time).
+            dbTable_empty = True
+        metrics.observe('vault_stage_seconds', time.perf_counter() - stage_start, stage='dedup', data_type=self.data_name)
+
+        # 3) Make the dataframe and target table in the database compatible with each other (i.e. ensure the stations in the database should be equal to or larger than the number of incoming stations)
+        # The columns of the table are read from the schema (PRAGMA table_info), which does not depend on the number of rows in the table
+        # Once checked, the full station set of the table is registered (see vault_store.StationRegistry), so the next flushes of the same station set skip this step (the persisted registry also spares a new process the PRAGMA)
+        stage_start = time.perf_counter()
+        incoming_stations = list(df.keys())
+        if not schema_known and not station_registry.check(cur, path_to_db, db_table_name, set_hash, incoming_stations):
+            self._add_station_columns(cur, db_table_name, path_to_db, incoming_stations, set_hash, dbTable_empty)
+        metrics.observe('vault_stage_seconds', schema_seconds + time.perf_counter() - stage_start, stage='schema', data_type=self.data_name)
+
+        # 4) Pass modified dataframe to database
+        # Now the stations in the database should be equal to or larger than the number of incoming stations
+        # In other words, the incoming stations should all be represented in the database now
+        # It is possible however, that the dataframe is empty at this stage, if only one entry was made and that entry pruned in step 2 above due to matching with the latest entry in the target table in the database.
+        # The rows, their watermark, flags, rollups and derived series are committed together: if any of them fails, none of them is stored (so a retry, e.g. by vault_writer.DbWriter, does not insert the rows twice)
+        if df.shape[0] != 0:
             try:
-                last_row_datetime_in_dbTable = self.cur.execute(f"SELECT * FROM {db_table_name}").fetchall()[-1][1]
-                earliest_entry_in_df = df.index[0]
-                if earliest_entry_in_df == last_row_datetime_in_dbTable:
-                    df = df.drop([f'{earliest_entry_in_df}'])
-                dbTable_empty = False
-            except IndexError:          # An index error could be raised to show that there are no rows in the target table in the database. It is very likely that there are no station headers as well (only entry_id and date_time).
-                dbTable_empty = True
+                stage_start = time.perf_counter()
+                insert_wide_rows(cur, db_table_name, df)
+                write_watermark(cur, db_table_name, df.index[-1])
+                metrics.observe('vault_stage_seconds', time.perf_counter() - stage_start, stage='insert', data_type=self.data_name)
+                epochs = [to_epoch(reading_time) for reading_time in df.index]
+                flags, tail = quality_filter.check(cur, path_to_db, self.data_name, epochs, list(df.columns), df.to_numpy(dtype=float), series=db_table_name, storage='wide')
+                write_flags(cur, db_table_name, epochs, list(df.columns), flags)                                 # Data-quality flags and gaps (see vault_quality), in the same commit
+                update_rollups(cur, db_table_name, epochs)                                                        # Hourly/daily rollups of the hours written, in the same commit
+                derived = derived_store.write_derived(derive(cur, db_table_name, epochs, 'wide')) if derived_store is not None else None       # Derived series db_table_name is an input of, in the same commit
+                registered = write_stations(cur, path_to_db, self.data_name, stations) if stations else None      # Station metadata (locations), as for narrow storage
+                cur.connection.commit()
+            except BaseException:
+                con.rollback()
+                if own_con:
+                    con.close()
+                raise
+            if registered is not None:
+                station_registry.remember(path_to_db, *registered)
+            if tail is not None:
+                quality_filter.remember(*tail)
+            if self.cache is not None and derived:
+                self.cache.update_derived(derived)                      # Derived series are not collected, so the cache (see vault_serve) learns about them here
+            print(f"\nAdded DataFrame to (dbTable: {db_table_name}): \n")
+            print(df, "\n")
+        else:
+            print("DataFrame not added due to it being empty from pruning!")
+        if own_con:
+            con.close()
 
+    # Step 1 of _send_to_wide_db: try to build a blank table (with only entry_id and date_time columns), and index its date_time column
+    def _create_wide_table(self, cur, db_table_name, path_to_db):
+        try:
+            create_blank_table = f"""
+                CREATE TABLE {db_table_name} (
+                    entry_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                    date_time TEXT ) ;
+                """
+            cur.execute(create_blank_table)
+            station_registry.forget(cur, path_to_db, db_table_name)              # A new table has no station columns, whatever was registered before
+            cur.connection.commit()
+            print(f"Empty table '{db_table_name}' created with 'entry_id' and 'date_time' as headers! No station headers created!")
+        except sl.OperationalError:
+            print(f"Table '{db_table_name}' already exists in vault.db!")
+        index_wide_table(cur, db_table_name)
 
-            # 3) Make the dataframe and target table in the database compatible with each other (i.e. ensure the stations in the database should be equal to or larger than the number of incoming stations)
-            incoming_stations = list(df.keys())
-            if dbTable_empty:
-                for i in range(len(incoming_stations)):
-                    # Add the incoming station name as a column into the existing database. The horizontal location where the incoming station name is inserted does not matter.
-                    sql_add_station = """ALTER TABLE {}
-                                        ADD COLUMN {} TEXT ;
-                                    """.format(db_table_name, incoming_stations[i])
-                    self.cur.execute(sql_add_station)
+    # Step 3 of _send_to_wide_db: add the incoming stations not present in the table yet as columns, then register the station set of the table
+    # The columns of the table are read from the schema (PRAGMA table_info), which does not depend on the number of rows in the table
+    def _add_station_columns(self, cur, db_table_name, path_to_db, incoming_stations, set_hash, dbTable_empty):
+        colsInDb_names = [col_info[1] for col_info in cur.execute(f"PRAGMA table_info({db_table_name})").fetchall()]
+        stationsInDb = colsInDb_names[2:]           # First two columns from left are entry_id and date_time
+        # Check if df has columns (stations) not present in database yet
+        for i in range(len(incoming_stations)):
+            if incoming_stations[i] not in stationsInDb:
+                # Add the incoming station name as a column into the existing database. The horizontal location where the incoming station name is inserted does not matter.
+                sql_add_station = """ALTER TABLE {}
+                                    ADD COLUMN {} TEXT ;
+                                """.format(db_table_name, incoming_stations[i])
+                cur.execute(sql_add_station)
+                if dbTable_empty:
                     print(f"Station {incoming_stations[i]} added to {db_table_name} table in database as a column. Table was empty previously.")
-            else:
-                colsInDb_descriptions = self.cur.execute("SELECT * FROM {}".format(db_table_name)).description
-                colsInDb_names = [colsInDb_descriptions[x][0] for x in range(len(colsInDb_descriptions))]
-                stationsInDb = colsInDb_names[2:]           # First two columns from left are entry_id and date_time
-                # Check if df has columns (stations) not present in database yet
-                for i in range(len(incoming_stations)):
-                    if incoming_stations[i] not in stationsInDb:
-                        # Add the incoming station name as a column into the existing database. The horizontal location where the incoming station name is inserted does not matter.
-                        sql_add_station = """ALTER TABLE {}
-                                            ADD COLUMN {} TEXT ;
-                                        """.format(db_table_name, incoming_stations[i])
-                        self.cur.execute(sql_add_station)
-                        print(f"Incoming station {incoming_stations[i]} added to {db_table_name} table in database as a column. Previously not present.")
+                else:
+                    print(f"Incoming station {incoming_stations[i]} added to {db_table_name} table in database as a column. Previously not present.")
+        # The new columns are already committed (ALTER TABLE outside of a transaction), so the registry is committed with them right away
+        station_registry.register(cur, path_to_db, db_table_name, set_hash, stationsInDb + [station for station in incoming_stations if station not in stationsInDb])
+        cur.connection.commit()
+        station_registry.remember(path_to_db, db_table_name, set_hash)
 
-            # 4) Pass modified dataframe to database
-            # Now the stations in the database should be equal to or larger than the number of incoming stations
-            # In other words, the incoming stations should all be represented in the database now
-            # It is possible however, that the dataframe is empty at this stage, if only one entry was made and that entry pruned in step 2 above due to matching with the latest entry in the target table in the database.
-            if df.shape[0] != 0:
-                df.to_sql(db_table_name, self.con, if_exists='append', index_label='date_time')
-                print(f"\nAdded DataFrame to (dbTable: {db_table_name}): \n")
-                print(df, "\n")
-            else:
-                print("DataFrame not added due to it being empty from pruning!")
-            self.con.close()
-            
-        else:
-            print("DataFrame construction completed! Constructed DataFrame not passed into database.")
-            return df
+    ## Send a built DataFrame to the long-format readings table in the database (upserted in a single transaction)
+    def _send_to_narrow_db(self, df, path_to_db, con=None, stations=None):
+        with metrics.timer('vault_stage_seconds', stage='schema', data_type=self.data_name):
+            store = NarrowStore(path_to_db, con=con)
+        with metrics.timer('vault_stage_seconds', stage='insert', data_type=self.data_name):
+            num_readings = store.write_df(self.data_name, df, stations=stations, cache=self.cache)
+        if con is None:
+            store.close()
+        print(f"\nUpserted {num_readings} readings ({df.shape[0]} entries) of {self.data_name} into the readings table in database.\n")